@@ -0,0 +1,408 @@
+import flask
+import numpy
+
+from app import app
+import co2
+import essentials as ess
+import inverse
+import optimizer
+import registry
+import scenarios
+import scheduler
+import sensitivity
+
+"""
+api.py exposes model calculations as a JSON API on the app's Flask server (app.server), for use by other tools.
+Rooms and human behaviors are selected by their preset names (see essentials.py room_preset_settings and
+human_preset_settings).
+
+Methods:
+def get_error_response: Returns a JSON error response
+def get_sensitivity: GET /api/sensitivity - Sobol sensitivity indices for a preset room
+def get_dataframe_lists: Returns a DataFrame as a dictionary of column lists
+def post_inverse: POST /api/inverse - Least mitigation needed to meet a target, for many rooms at once
+def post_optimize: POST /api/optimize - Pareto frontier of upgrade cost against risk reduction for a portfolio
+def post_schedule: POST /api/schedule - Assign meetings to rooms under the guideline
+def post_co2: POST /api/co2 - Fit air exchange rates per room from an uploaded CO2 log
+def get_rooms: GET /api/rooms - Registered rooms that can host an occupancy for an exposure time
+def get_scenarios: GET /api/scenarios - Saved scenarios with their results for one risk type
+def post_scenarios: POST /api/scenarios - Save many scenarios at once
+def get_scenario: GET /api/scenarios/<id> - A saved scenario with its inputs and results
+def get_scenarios_diff: GET /api/scenarios/diff - The inputs and results that differ between two saved scenarios
+def get_scenarios_comparison: GET /api/scenarios/compare - Several saved scenarios compared in one batch
+"""
+
+risk_types = ['conditional', 'prevalence', 'personal']
+
+max_rooms = 100000
+max_optimize_rooms = 10000  # every room evaluates every candidate upgrade (see optimizer.get_option_grid)
+max_meetings = 100000
+max_schedule_pairs = 50000000  # rooms x meetings
+default_rooms_limit = 1000  # rooms returned by /api/rooms
+max_scenarios = 100000
+default_scenarios_limit = 1000  # scenarios returned by /api/scenarios
+
+
+# Returns a JSON error response with the given message and HTTP status code
+def get_error_response(message, status=400):
+    response = flask.jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+# Sobol sensitivity indices of the log maximum exposure time for a preset room.
+# Query parameters: room (room preset), human (human behavior preset), n (occupancy), risk_type, samples (base
+# sample count, a power of two is recommended)
+@app.server.route('/api/sensitivity')
+def get_sensitivity():
+    args = flask.request.args
+    room_preset = args.get('room', 'classroom')
+    human_preset = args.get('human', 'masks-2')
+    risk_type = args.get('risk_type', 'conditional')
+    if room_preset not in ess.room_preset_settings:
+        return get_error_response("Unknown room preset '{}'".format(room_preset))
+    if human_preset not in ess.human_preset_settings:
+        return get_error_response("Unknown human behavior preset '{}'".format(human_preset))
+    if risk_type not in risk_types:
+        return get_error_response("Unknown risk type '{}'".format(risk_type))
+
+    try:
+        n_max = float(args.get('n', 10))
+        n_base = int(args.get('samples', sensitivity.default_n_base))
+    except ValueError:
+        return get_error_response("n and samples must be numbers")
+    if n_max < 2 or not 16 <= n_base <= 65536:
+        return get_error_response("n must be at least 2, and samples between 16 and 65536")
+
+    sa_model = ess.get_preset_model(room_preset, human_preset)
+    sobol_indices = sensitivity.calc_sobol_indices(sa_model, n_max, risk_type, n_base)
+    return flask.jsonify({
+        'room': room_preset,
+        'human': human_preset,
+        'n': n_max,
+        'risk_type': risk_type,
+        'factors': sobol_indices['factors'],
+        'first_order': sobol_indices['first_order'].tolist(),
+        'total': sobol_indices['total'].tolist(),
+        'n_evals': sobol_indices['n_evals'],
+    })
+
+
+# Returns a DataFrame as a dictionary of column lists, with missing and infinite values as None (null in JSON)
+def get_dataframe_lists(data_frame):
+    data_frame = data_frame.replace([numpy.inf, -numpy.inf], numpy.nan)
+    return data_frame.astype(object).where(data_frame.notna(), None).to_dict(orient='list')
+
+
+# Least mitigation of one lever (see inverse.py levers) needed so that n people may stay t hours, for every room.
+# JSON body: {"lever": ..., "risk_type": ..., "rooms": [{"room": ..., "human": ..., "n": ..., "t": ..., ...}, ...]}
+# Returns the required value of the lever for each room (null where the lever alone cannot meet the target).
+@app.server.route('/api/inverse', methods=['POST'])
+def post_inverse():
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('rooms'), list):
+        return get_error_response("Request body must be a JSON object with a list of rooms")
+    lever = body.get('lever', 'air_exch_rate')
+    risk_type = body.get('risk_type', 'conditional')
+    rooms = body['rooms']
+    if lever not in inverse.levers:
+        return get_error_response("Unknown lever '{}'".format(lever))
+    if risk_type not in risk_types:
+        return get_error_response("Unknown risk type '{}'".format(risk_type))
+    if not 0 < len(rooms) <= max_rooms:
+        return get_error_response("Between 1 and {} rooms may be solved at once".format(max_rooms))
+
+    try:
+        rooms_model, columns = ess.get_rooms_model(rooms)
+    except KeyError as error:
+        return get_error_response("Unknown preset or missing field {}".format(error))
+    except (TypeError, ValueError, AttributeError):
+        return get_error_response("Every room must be an object with numeric fields")
+    if numpy.any(columns['n'] < 2) or numpy.any(columns['t'] <= 0) or numpy.any(columns['air_exchange_rate'] <= 0):
+        return get_error_response("n must be at least 2, and t and air_exchange_rate must be positive")
+
+    solution = inverse.solve_lever(rooms_model, lever, columns['n'], columns['t'], risk_type)
+    response = {
+        'lever': lever,
+        'risk_type': risk_type,
+        'value': [None if numpy.isnan(value) else value for value in solution['value'].tolist()],
+        'feasible': solution['feasible'].tolist(),
+    }
+    if 'merv' in solution:
+        response['merv'] = [None if numpy.isnan(merv) else int(merv) for merv in solution['merv'].tolist()]
+    return flask.jsonify(response)
+
+
+# Pareto frontier of total upgrade cost against total risk reduction for a portfolio of rooms (see optimizer.py).
+# JSON body: {"risk_type": ..., "budget": ..., "format": "json" or "csv", "rooms": [{..., "n": ..., "t": ...,
+# "ach_cost": ..., "merv_cost": ..., "hepa_cost": ..., "hepa_cadr": ..., "cap_cost": ..., "uses": ...}, ...]}
+# Returns the frontier, and the allocation of upgrades to rooms if a budget is given. With "format": "csv", returns
+# the allocation as CSV if a budget is given, and otherwise the frontier.
+@app.server.route('/api/optimize', methods=['POST'])
+def post_optimize():
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('rooms'), list):
+        return get_error_response("Request body must be a JSON object with a list of rooms")
+    risk_type = body.get('risk_type', 'conditional')
+    budget = body.get('budget')
+    output_format = body.get('format', 'json')
+    rooms = body['rooms']
+    if risk_type not in risk_types:
+        return get_error_response("Unknown risk type '{}'".format(risk_type))
+    if output_format not in ['json', 'csv']:
+        return get_error_response("Unknown format '{}'".format(output_format))
+    if budget is not None and not isinstance(budget, (int, float)):
+        return get_error_response("budget must be a number")
+    if not 0 < len(rooms) <= max_optimize_rooms:
+        return get_error_response("Between 1 and {} rooms may be optimized at once".format(max_optimize_rooms))
+
+    try:
+        rooms_model, columns = ess.get_rooms_model(rooms, optimizer.default_costs)
+    except KeyError as error:
+        return get_error_response("Unknown preset or missing field {}".format(error))
+    except (TypeError, ValueError, AttributeError):
+        return get_error_response("Every room must be an object with numeric fields")
+    if numpy.any(columns['n'] < 1) or numpy.any(columns['t'] <= 0) or numpy.any(columns['air_exchange_rate'] <= 0):
+        return get_error_response("n must be at least 1, and t and air_exchange_rate must be positive")
+    if any(numpy.any(columns[name] < 0) for name in optimizer.default_costs):
+        return get_error_response("Costs must not be negative")
+
+    costs = {name: columns[name] for name in optimizer.default_costs}
+    result = optimizer.optimize_portfolio(rooms_model, columns['merv'], columns['n'], columns['t'], costs,
+                                          risk_type=risk_type)
+    if output_format == 'csv':
+        response = flask.make_response(optimizer.frontier_to_csv(result, budget=budget))
+        response.headers['Content-Type'] = 'text/csv'
+        response.headers['Content-Disposition'] = 'attachment; filename=frontier.csv'
+        return response
+
+    response = {
+        'risk_type': risk_type,
+        'frontier': get_dataframe_lists(result['frontier']),
+    }
+    if budget is not None:
+        response['allocation'] = get_dataframe_lists(optimizer.get_allocation(result, budget))
+    return flask.jsonify(response)
+
+
+# Assign meetings to rooms so that every meeting meets the guideline (see scheduler.py).
+# JSON body: {"risk_type": ..., "format": "json" or "csv", "rooms": [{"room": ..., "human": ..., "seats": ..., ...}],
+# "meetings": [{"headcount": ..., "duration": ..., "start": ...}, ...]} (duration and start in hours)
+# Returns the room index of each meeting (-1 if unassigned) and the utilization of each room, or with "format": "csv",
+# the meeting assignments as CSV.
+@app.server.route('/api/schedule', methods=['POST'])
+def post_schedule():
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('rooms'), list) or \
+            not isinstance(body.get('meetings'), list):
+        return get_error_response("Request body must be a JSON object with lists of rooms and meetings")
+    risk_type = body.get('risk_type', 'conditional')
+    output_format = body.get('format', 'json')
+    rooms = body['rooms']
+    meetings = body['meetings']
+    if risk_type not in risk_types:
+        return get_error_response("Unknown risk type '{}'".format(risk_type))
+    if output_format not in ['json', 'csv']:
+        return get_error_response("Unknown format '{}'".format(output_format))
+    if not 0 < len(rooms) <= max_rooms or not 0 < len(meetings) <= max_meetings or \
+            len(rooms) * len(meetings) > max_schedule_pairs:
+        return get_error_response("Between 1 and {} rooms and 1 and {} meetings, with at most {} room-meeting pairs, "
+                                  "may be scheduled at once".format(max_rooms, max_meetings, max_schedule_pairs))
+
+    try:
+        rooms_model, columns = ess.get_rooms_model(rooms, {'seats': numpy.inf}, target_fields=())
+        headcount = numpy.array([float(meeting['headcount']) for meeting in meetings])
+        duration = numpy.array([float(meeting['duration']) for meeting in meetings])
+        start = numpy.array([float(meeting.get('start', 0)) for meeting in meetings])
+    except KeyError as error:
+        return get_error_response("Unknown preset or missing field {}".format(error))
+    except (TypeError, ValueError, AttributeError):
+        return get_error_response("Every room and meeting must be an object with numeric fields")
+    if numpy.any(headcount < 1) or numpy.any(duration <= 0) or numpy.any(columns['air_exchange_rate'] <= 0):
+        return get_error_response("headcount must be at least 1, and duration and air_exchange_rate must be positive")
+
+    schedule = scheduler.schedule_meetings(rooms_model, headcount, duration, start, risk_type, columns['seats'])
+    if output_format == 'csv':
+        response = flask.make_response(schedule['meetings'].to_csv(index=False))
+        response.headers['Content-Type'] = 'text/csv'
+        response.headers['Content-Disposition'] = 'attachment; filename=schedule.csv'
+        return response
+
+    return flask.jsonify({
+        'risk_type': risk_type,
+        'assignment': schedule['meetings']['room'].tolist(),
+        'n_feasible_rooms': schedule['n_feasible_rooms'].tolist(),
+        'rooms': get_dataframe_lists(schedule['rooms']),
+        'assigned': schedule['assigned'],
+        'booked_hours': schedule['booked_hours'],
+        'utilization': schedule['utilization'],
+    })
+
+
+# Fit the outdoor air exchange rate of every room from a CO2 log (see co2.py), streamed as the CSV request body.
+# Query parameters: outdoor_co2 (ppm); room, human (presets) and n (occupancy) to also return the maximum exposure time
+# of each room with its fitted air exchange rate (the room preset's otherwise)
+# Returns the fit of each room (air_exch_rate: /hr, null where no decay period was found).
+@app.server.route('/api/co2', methods=['POST'])
+def post_co2():
+    args = flask.request.args
+    room_preset = args.get('room', 'classroom')
+    human_preset = args.get('human', 'masks-2')
+    if room_preset not in ess.room_preset_settings:
+        return get_error_response("Unknown room preset '{}'".format(room_preset))
+    if human_preset not in ess.human_preset_settings:
+        return get_error_response("Unknown human behavior preset '{}'".format(human_preset))
+    try:
+        outdoor_co2 = float(args.get('outdoor_co2', co2.default_outdoor_co2))
+        n_max = float(args['n']) if 'n' in args else None
+    except ValueError:
+        return get_error_response("outdoor_co2 and n must be numbers")
+    if n_max is not None and n_max < 2:
+        return get_error_response("n must be at least 2")
+
+    try:
+        fits = co2.read_co2_log(flask.request.stream, outdoor_co2=outdoor_co2)
+    except (ValueError, TypeError) as error:
+        return get_error_response("Could not read the CO2 log: {}".format(error))
+    response = {
+        'outdoor_co2': outdoor_co2,
+        'rooms': get_dataframe_lists(fits),
+    }
+    if n_max is not None:
+        preset_model = ess.get_preset_model(room_preset, human_preset)
+        fitted_model = co2.apply_fitted_ach(preset_model, fits['air_exch_rate'].to_numpy())
+        response['max_time'] = numpy.broadcast_to(fitted_model.calc_max_time(n_max), (len(fits),)).tolist()
+    return flask.jsonify(response)
+
+
+# Registered rooms (see registry.py) that can host n people for t hours under the guideline, from the lowest risk rate.
+# Query parameters: n, t (hours), risk_type, building, floor, room_type (optional filters), limit (rooms returned)
+# Returns the number of matching rooms and the metadata, rates and maximum occupancy of the first limit of them.
+@app.server.route('/api/rooms')
+def get_rooms():
+    room_registry = registry.get_room_registry()
+    if room_registry is None:
+        return get_error_response("No room registry is configured", 404)
+    args = flask.request.args
+    risk_type = args.get('risk_type', 'conditional')
+    if risk_type not in risk_types:
+        return get_error_response("Unknown risk type '{}'".format(risk_type))
+    if 'n' not in args or 't' not in args:
+        return get_error_response("n and t are required")
+    try:
+        n_max = float(args['n'])
+        exp_time = float(args['t'])
+        limit = int(args.get('limit', default_rooms_limit))
+    except ValueError:
+        return get_error_response("n, t and limit must be numbers")
+    if n_max < 2 or exp_time <= 0 or limit < 0:
+        return get_error_response("n must be at least 2, t must be positive and limit must not be negative")
+
+    rows = room_registry.find_rows(n_max, exp_time, risk_type, args.get('building'), args.get('floor'),
+                                   args.get('room_type'))
+    return flask.jsonify({
+        'n': n_max,
+        't': exp_time,
+        'risk_type': risk_type,
+        'count': len(rows),
+        'rooms': get_dataframe_lists(room_registry.get_rooms_frame(rows[:limit], exp_time, risk_type)),
+    })
+
+
+# Saved scenarios (see scenarios.py), newest first, with their key parameters and the results of one risk type.
+# Query parameters: risk_type, room_type, human_type (optional filters), limit (scenarios returned)
+@app.server.route('/api/scenarios')
+def get_scenarios():
+    args = flask.request.args
+    risk_type = args.get('risk_type', 'conditional')
+    if risk_type not in risk_types:
+        return get_error_response("Unknown risk type '{}'".format(risk_type))
+    try:
+        limit = int(args.get('limit', default_scenarios_limit))
+    except ValueError:
+        return get_error_response("limit must be a number")
+    scenario_list = scenarios.get_scenario_store().list_scenarios(risk_type, args.get('room_type'),
+                                                                  args.get('human_type'), max(limit, 0))
+    return flask.jsonify({'risk_type': risk_type, 'scenarios': get_dataframe_lists(scenario_list)})
+
+
+# Save many scenarios at once (evaluated as one batch and written in one transaction).
+# JSON body: {"scenarios": [{"name": ..., "units": "british" or "metric", "inputs": {...}}, ...]}, with inputs named
+# as in scenarios.py scenario_defaults (missing inputs take their defaults). Returns the ids of the saved scenarios.
+@app.server.route('/api/scenarios', methods=['POST'])
+def post_scenarios():
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('scenarios'), list):
+        return get_error_response("Request body must be a JSON object with a list of scenarios")
+    scenario_list = body['scenarios']
+    if not 0 < len(scenario_list) <= max_scenarios:
+        return get_error_response("Between 1 and {} scenarios may be saved at once".format(max_scenarios))
+    for scenario in scenario_list:
+        if not isinstance(scenario, dict) or 'name' not in scenario or not isinstance(scenario.get('inputs', {}), dict):
+            return get_error_response("Every scenario must be an object with a name and an object of inputs")
+        if scenario.get('units', 'british') not in ['british', 'metric']:
+            return get_error_response("units must be 'british' or 'metric'")
+        scenario.pop('outputs', None)  # displayed outputs are only cached by the app itself
+
+    try:
+        scenario_ids = scenarios.get_scenario_store().save_scenarios(scenario_list)
+    except (TypeError, ValueError):
+        return get_error_response("Every input must be a number")
+    return flask.jsonify({'ids': scenario_ids})
+
+
+# A saved scenario with its inputs and the results of every risk type
+@app.server.route('/api/scenarios/<int:scenario_id>')
+def get_scenario(scenario_id):
+    scenario = scenarios.get_scenario_store().get_scenario(scenario_id)
+    if scenario is None:
+        return get_error_response("No scenario {}".format(scenario_id), 404)
+    for results in scenario['results'].values():
+        for name in ['max_time', 'n_max']:
+            results[name] = results[name] if numpy.isfinite(results[name]) else None
+    return flask.jsonify(scenario)
+
+
+# The inputs and results that differ between two saved scenarios.
+# Query parameters: a, b (scenario ids)
+@app.server.route('/api/scenarios/diff')
+def get_scenarios_diff():
+    args = flask.request.args
+    try:
+        scenario_id_a = int(args['a'])
+        scenario_id_b = int(args['b'])
+    except (KeyError, ValueError):
+        return get_error_response("a and b must be scenario ids")
+    try:
+        diff = scenarios.get_scenario_store().diff_scenarios(scenario_id_a, scenario_id_b)
+    except KeyError as error:
+        return get_error_response("No scenario {}".format(error), 404)
+    return flask.jsonify({'a': scenario_id_a, 'b': scenario_id_b, 'diff': get_dataframe_lists(diff)})
+
+
+# Several saved scenarios compared under one risk type, evaluated as one batch (see scenarios.py).
+# Query parameters: ids (comma-separated scenario ids, the first is the baseline), risk_type
+# Returns each scenario's maximum exposure time and occupancy with their change from the baseline, and its curve of
+# maximum occupancy over the exposure times.
+@app.server.route('/api/scenarios/compare')
+def get_scenarios_comparison():
+    args = flask.request.args
+    risk_type = args.get('risk_type', 'conditional')
+    if risk_type not in risk_types:
+        return get_error_response("Unknown risk type '{}'".format(risk_type))
+    try:
+        scenario_ids = [int(scenario_id) for scenario_id in args.get('ids', '').split(',')]
+    except ValueError:
+        return get_error_response("ids must be comma-separated scenario ids")
+    if len(scenario_ids) > scenarios.max_compared_scenarios:
+        return get_error_response("At most {} scenarios may be compared".format(scenarios.max_compared_scenarios))
+    try:
+        comparison = scenarios.get_scenario_store().compare_scenarios(scenario_ids, risk_type)
+    except KeyError as error:
+        return get_error_response("No scenario {}".format(error), 404)
+    return flask.jsonify({
+        'risk_type': risk_type,
+        'scenarios': get_dataframe_lists(comparison['scenarios']),
+        'exp_times': comparison['exp_times'].tolist(),
+        'curves': comparison['curves'].tolist(),
+    })
@@ -1,13 +1,46 @@
+import collections
+import gzip
+import hashlib
+import threading
+
 import dash
+import flask
 from flask_talisman import Talisman
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 """
 app.py is to be imported by other files (default.py, advanced.py, index.py) to be referenced in setup.
 
+It also caches and compresses the server's responses. Text responses (JSON, HTML, CSS and scripts) above a size
+threshold are compressed with brotli (if installed) or gzip, as the client accepts. The responses that are the same
+for every user (the page layout at /_dash-layout, the callback graph at /_dash-dependencies, Dash's scripts, and the
+localized texts returned by the text callbacks) are compressed once per worker and kept in memory. Those of GET
+requests get a strong ETag, computed from their content, conditional requests for them are answered with 304 Not
+Modified, and they are served from memory without generating them again. The text callbacks get no ETag: they answer
+POST requests, which browsers never make conditional.
+
+Properties:
+Dash App Setup
+HTTP Caching Settings
+
+Methods:
+def is_static_path: Check whether a path is served the same to every user.
+def is_static_response: Check whether a response is the same for every user.
+def get_encoding: Get the compression the client accepts.
+def compress: Compress a response body.
+def get_compressed: Get a response body compressed, from the cache if it is the same for every user.
+def cache_and_compress: Flask after_request hook adding ETags and compressing responses.
+def serve_static_response: Flask before_request hook serving the layout and callback graph from memory.
 """
 
 # Dash App Setup
-app = dash.Dash(__name__, suppress_callback_exceptions=True)
+# Responses are compressed by cache_and_compress, rather than by Dash (Flask-Compress, which compresses each response
+# again on every request)
+app = dash.Dash(__name__, suppress_callback_exceptions=True, compress=False)
 
 csp = {
     'default-src': ['\'self\'',
@@ -28,3 +61,140 @@ csp = {
 Talisman(app.server, content_security_policy=csp)
 
 curr_units = 'british'
+
+# HTTP Caching Settings
+static_paths = ['/_dash-layout', '/_dash-dependencies']
+static_prefixes = ['/_dash-component-suites/']  # the scripts of Dash and its components, by version
+text_callbacks = ['update_header_and_footer', 'update_lang', 'update_lang_adv', 'update_lang_scenarios',
+                  'update_lang_live']  # callbacks returning only localized texts, by function name
+update_path = '/_dash-update-component'
+compress_min_size = 1024  # bytes; smaller responses are sent as they are
+compress_mimetypes = ['application/json', 'text/html', 'text/css', 'application/javascript', 'text/javascript']
+encodings = ['br', 'gzip'] if brotli is not None else ['gzip']  # in order of preference
+static_levels = {'br': 9, 'gzip': 9}  # for responses compressed once and cached (br 11 takes 20 s for plotly.js)
+dynamic_levels = {'br': 4, 'gzip': 6}  # for responses compressed on every request
+compressed_cache_size = 64  # compressed responses kept per worker
+
+# Compressed responses by (cache key, encoding), least recently used first (see get_compressed)
+compressed_cache = collections.OrderedDict()
+compressed_cache_lock = threading.Lock()
+# The responses of static paths by (path, encoding accepted): their ETag, body, mimetype and Cache-Control header,
+# served without generating them again
+static_responses = {}
+
+
+# Returns whether a path is served the same to every user, until the app is deployed again: the layout, the callback
+# graph and Dash's scripts
+def is_static_path(path):
+    return path in static_paths or any(path.startswith(prefix) for prefix in static_prefixes)
+
+
+# Returns whether the current request's response is the same for every user: that of a static path (see
+# is_static_path), or of a text callback
+def is_static_response():
+    request = flask.request
+    if is_static_path(request.path):
+        return request.method in ['GET', 'HEAD']
+    if request.path != update_path:
+        return False
+    body = request.get_json(silent=True)
+    callback = app.callback_map.get(body.get('output'), {}).get('callback') if isinstance(body, dict) else None
+    return callback is not None and callback.__name__ in text_callbacks
+
+
+# Returns the compression of the current request's response: the preferred encoding the client accepts, or None
+def get_encoding(response):
+    if response.mimetype not in compress_mimetypes or 'Content-Encoding' in response.headers:
+        return None
+    return flask.request.accept_encodings.best_match(encodings)
+
+
+# Returns data compressed with the given encoding ('br' or 'gzip'), at the given levels (see static_levels)
+def compress(data, encoding, levels):
+    if encoding == 'br':
+        return brotli.compress(data, quality=levels['br'])
+    return gzip.compress(data, compresslevel=levels['gzip'], mtime=0)
+
+
+# Returns a response body compressed with the given encoding. The bodies of responses that are the same for every user
+# are compressed once, at the highest level, and cached by cache_key (their ETag, or the request body of a text
+# callback, which determines its response); others (cache_key None) are compressed every time.
+def get_compressed(data, encoding, cache_key):
+    if cache_key is None:
+        return compress(data, encoding, dynamic_levels)
+    key = (cache_key, encoding)
+    with compressed_cache_lock:
+        if key in compressed_cache:
+            compressed_cache.move_to_end(key)
+            return compressed_cache[key]
+    compressed = compress(data, encoding, static_levels)
+    with compressed_cache_lock:
+        compressed_cache[key] = compressed
+        while len(compressed_cache) > compressed_cache_size:
+            compressed_cache.popitem(last=False)
+    return compressed
+
+
+# Adds a strong ETag to the GET responses that are the same for every user (one per encoding, as the representations
+# differ), answers conditional requests for them with 304 Not Modified, and compresses text responses the client
+# accepts compressed (a Flask after_request hook). Text callback responses get no ETag: they answer POST requests,
+# which browsers do not make conditional.
+@app.server.after_request
+def cache_and_compress(response):
+    if response.status_code != 200 or response.direct_passthrough or flask.g.get('static_response', False):
+        return response
+    if response.mimetype in compress_mimetypes:
+        response.vary.add('Accept-Encoding')
+    encoding = get_encoding(response)
+    static = is_static_response()
+    if encoding is None and not static:
+        return response
+    data = response.get_data()
+    if len(data) < compress_min_size:
+        encoding = None
+    etag = None
+    cache_key = None
+    if static and flask.request.method in ['GET', 'HEAD']:
+        etag = hashlib.sha1(data).hexdigest() + ('-' + encoding if encoding is not None else '')
+        cache_key = etag
+        response.set_etag(etag)
+        if etag in flask.request.if_none_match:
+            response.status_code = 304
+            response.set_data(b'')
+            return response
+    elif static:
+        cache_key = flask.request.get_data()
+    if encoding is not None:
+        response.set_data(get_compressed(data, encoding, cache_key))
+        response.headers['Content-Encoding'] = encoding
+    if is_static_path(flask.request.path) and flask.request.method == 'GET':
+        accepted = flask.request.accept_encodings.best_match(encodings)
+        static_responses[(flask.request.path, accepted)] = (etag, response.get_data(), response.mimetype,
+                                                            response.headers.get('Cache-Control'))
+    return response
+
+
+# Serves the responses of static paths (see is_static_path) from memory once they have been generated and compressed,
+# or 304 Not Modified to a conditional request for them (a Flask before_request hook)
+@app.server.before_request
+def serve_static_response():
+    request = flask.request
+    if not is_static_path(request.path) or request.method not in ['GET', 'HEAD']:
+        return None
+    encoding = request.accept_encodings.best_match(encodings)
+    cached = static_responses.get((request.path, encoding))
+    if cached is None:
+        return None
+    etag, data, mimetype, cache_control = cached
+    if etag in request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(data, mimetype=mimetype)
+        if etag.endswith('-' + str(encoding)):
+            response.headers['Content-Encoding'] = encoding
+    if cache_control is not None:
+        response.headers['Cache-Control'] = cache_control
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    flask.g.static_response = True  # finished: not to be compressed again
+    return response
@@ -1,3 +1,5 @@
+import time
+
 import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
@@ -6,6 +8,9 @@ from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 import indoors as ind
 from indoors import Indoors
+import uncertainty
+import sensitivity
+import scenarios
 
 from app import app
 import descriptions as desc
@@ -26,16 +31,25 @@ Main App (Advanced Mode)
 
 Methods: 
 def update_figure: Calculate model & update displayed values
+def calc_figure_outputs: Calculates the model & every displayed value for valid inputs
 def update_t_output: Returns transient exposure time based on n max value
 def update_n_output: Returns transient n max based on exposure time
 def update_presets: Updates options based on selected presets
 def update_risk_tol_disp: Update risk tolerance display value
 def update_mask_fit_disp: Updates mask fit/compliance filtration display based on slider value
+def update_sensitivity: Runs the global sensitivity analysis for the current inputs
+def update_inverse: Finds the least mitigation needed to meet the target occupancy and exposure time
+def get_input_model: Returns the model for the current room and human behavior inputs
+def update_scenario_list: Saves the current inputs as a scenario and lists the saved scenarios
+def load_scenario: Loads a saved scenario into the inputs
+def update_scenario_diff: Compares two saved scenarios
+def update_scenario_comparison: Compares several saved scenarios on one figure and table
 """
 
 # COVID-19 Calculator Setup
 myInd = ind.Indoors()
 fig = ess.get_model_figure(myInd, "en")
+ach_merv_fig = ess.get_ach_merv_figure(myInd, 0, 10, 'conditional', ess.covid_recovery_time, "en")
 
 
 # Main App
@@ -197,6 +211,36 @@ layout = html.Div(children=[
                                                         step=0.1,
                                                         type='number')]),
                                     html.Br(),
+                                    html.H6(html.Span(desc.mc_header, id='adv-mc-header')),
+                                    html.Div(desc.mc_desc, id='adv-mc-desc'),
+                                    dcc.Checklist(id='adv-mc-enable',
+                                                  options=desc.mc_enable_options,
+                                                  value=[]),
+                                    html.Div([html.Span(desc.mc_cq_gsd_text, id='adv-mc-cq-gsd-text'),
+                                              dcc.Input(id='adv-mc-cq-gsd', value=2,
+                                                        min=1, step=0.1,
+                                                        type='number')]),
+                                    html.Div([html.Span(desc.mc_qb_gsd_text, id='adv-mc-qb-gsd-text'),
+                                              dcc.Input(id='adv-mc-qb-gsd', value=1.3,
+                                                        min=1, step=0.1,
+                                                        type='number')]),
+                                    html.Div([html.Span(desc.mc_mask_fit_text, id='adv-mc-mask-fit-text'),
+                                              dcc.Input(id='adv-mc-mask-fit-range', value=0.15,
+                                                        min=0, max=1, step=0.05,
+                                                        type='number')]),
+                                    html.Div([html.Span(desc.mc_deact_text, id='adv-mc-deact-text'),
+                                              dcc.Input(id='adv-mc-deact-min', value=0.3,
+                                                        min=0, step=0.1,
+                                                        type='number'),
+                                              " - ",
+                                              dcc.Input(id='adv-mc-deact-max', value=1.0,
+                                                        min=0, step=0.1,
+                                                        type='number')]),
+                                    html.Div([html.Span(desc.mc_samples_text, id='adv-mc-samples-text'),
+                                              dcc.Input(id='adv-mc-samples', value=uncertainty.default_n_samples,
+                                                        min=1000, max=1000000, step=1000,
+                                                        type='number')]),
+                                    html.Br(),
                                     html.H6(html.Span(desc.values_interest_header, id='adv-val-interest-header')),
                                     html.Div([
                                         html.Div([html.Span(desc.relative_sus_label, id='adv-sr-label'),
@@ -270,6 +314,104 @@ layout = html.Div(children=[
                                         ),
                                     ]),
                                 ]
+                            ),
+                            dcc.Tab(
+                                id='adv-tab-e',
+                                label=desc.ach_merv_header,
+                                className='custom-tab',
+                                children=[
+                                    html.H6(html.Span(desc.ach_merv_header, id='adv-ach-merv-header')),
+                                    html.Div(desc.ach_merv_desc, id='adv-ach-merv-desc'),
+                                    html.Div([
+                                        dcc.Graph(
+                                            id='adv-ach-merv-graph',
+                                            figure=ach_merv_fig
+                                        ),
+                                    ]),
+                                ]
+                            ),
+                            dcc.Tab(
+                                id='adv-tab-f',
+                                label=desc.sa_header,
+                                className='custom-tab',
+                                children=[
+                                    html.H6(html.Span(desc.sa_header, id='adv-sa-header')),
+                                    html.Div(desc.sa_desc, id='adv-sa-desc'),
+                                    html.Br(),
+                                    html.Button(desc.sa_run_text, id='adv-sa-run', n_clicks=0),
+                                    dcc.Loading(
+                                        id='adv-sa-loading',
+                                        type='circle',
+                                        children=[dcc.Graph(id='adv-sa-graph')],
+                                        color='#de1616',
+                                    ),
+                                ]
+                            ),
+                            dcc.Tab(
+                                id='adv-tab-g',
+                                label=desc.inv_header,
+                                className='custom-tab',
+                                children=[
+                                    html.H6(html.Span(desc.inv_header, id='adv-inv-header')),
+                                    html.Div(desc.inv_desc, id='adv-inv-desc'),
+                                    html.Br(),
+                                    html.Div([html.Span(desc.inv_lever_text, id='adv-inv-lever-text'),
+                                              dcc.Dropdown(id='adv-inv-lever',
+                                                           options=desc.inv_lever_options,
+                                                           value='air_exch_rate',
+                                                           searchable=False,
+                                                           clearable=False)]),
+                                    html.Div([html.Span(desc.inv_risk_text, id='adv-inv-risk-text'),
+                                              dcc.Dropdown(id='adv-inv-risk-type',
+                                                           options=desc.inv_risk_options,
+                                                           value='conditional',
+                                                           searchable=False,
+                                                           clearable=False)]),
+                                    html.Div([html.Span(desc.inv_n_text, id='adv-inv-n-text'),
+                                              dcc.Input(id='adv-inv-n', value=25,
+                                                        min=2, step=1,
+                                                        type='number')]),
+                                    html.Div([html.Span(desc.inv_t_text, id='adv-inv-t-text'),
+                                              dcc.Input(id='adv-inv-t', value=3,
+                                                        min=0.1, step=0.5,
+                                                        type='number')]),
+                                    html.Br(),
+                                    html.H4(className='model-output-text', id='adv-inv-output'),
+                                ]
+                            ),
+                            dcc.Tab(
+                                id='adv-tab-h',
+                                label=desc.scen_header,
+                                className='custom-tab',
+                                children=[
+                                    html.H6(html.Span(desc.scen_header, id='adv-scen-header')),
+                                    html.Div(desc.scen_desc, id='adv-scen-desc'),
+                                    html.Br(),
+                                    html.Div([html.Span(desc.scen_name_text, id='adv-scen-name-text'),
+                                              dcc.Input(id='adv-scen-name', type='text', debounce=True),
+                                              html.Button(desc.scen_save_text, id='adv-scen-save', n_clicks=0)]),
+                                    html.Div(id='adv-scen-status'),
+                                    html.Br(),
+                                    html.Div([html.Span(desc.scen_select_text, id='adv-scen-select-text'),
+                                              dcc.Dropdown(id='adv-scen-select', options=[])]),
+                                    html.Button(desc.scen_load_text, id='adv-scen-load', n_clicks=0),
+                                    html.Br(),
+                                    html.Div([html.Span(desc.scen_compare_text, id='adv-scen-compare-text'),
+                                              dcc.Dropdown(id='adv-scen-compare', options=[])]),
+                                    html.Div(id='adv-scen-diff'),
+                                    html.Br(),
+                                    html.Div([html.Span(desc.scen_multi_text, id='adv-scen-multi-text'),
+                                              dcc.Dropdown(id='adv-scen-multi', options=[], multi=True)]),
+                                    html.Div([html.Span(desc.scen_risk_text, id='adv-scen-risk-text'),
+                                              dcc.Dropdown(id='adv-scen-risk-type',
+                                                           options=desc.inv_risk_options,
+                                                           value='conditional',
+                                                           searchable=False,
+                                                           clearable=False)]),
+                                    dcc.Graph(id='adv-scen-graph'),
+                                    html.Div(id='adv-scen-table'),
+                                    dcc.Store(id='adv-scen-loaded'),
+                                ]
                             )
                         ],
                                            colors={
@@ -644,7 +786,31 @@ layout = html.Div(children=[
      Output('adv-main-panel-s2-c', 'children'),
      Output('adv-main-airb-trans-desc-c', 'children'),
      Output('adv-incidence-rate-refs-c', 'children'),
-     Output('adv-lang-break-age', 'children')],
+     Output('adv-lang-break-age', 'children'),
+     Output('adv-tab-e', 'label'),
+     Output('adv-ach-merv-header', 'children'),
+     Output('adv-ach-merv-desc', 'children'),
+     Output('adv-mc-header', 'children'),
+     Output('adv-mc-desc', 'children'),
+     Output('adv-mc-enable', 'options'),
+     Output('adv-mc-cq-gsd-text', 'children'),
+     Output('adv-mc-qb-gsd-text', 'children'),
+     Output('adv-mc-mask-fit-text', 'children'),
+     Output('adv-mc-deact-text', 'children'),
+     Output('adv-mc-samples-text', 'children'),
+     Output('adv-tab-f', 'label'),
+     Output('adv-sa-header', 'children'),
+     Output('adv-sa-desc', 'children'),
+     Output('adv-sa-run', 'children'),
+     Output('adv-tab-g', 'label'),
+     Output('adv-inv-header', 'children'),
+     Output('adv-inv-desc', 'children'),
+     Output('adv-inv-lever-text', 'children'),
+     Output('adv-inv-lever', 'options'),
+     Output('adv-inv-risk-text', 'children'),
+     Output('adv-inv-risk-type', 'options'),
+     Output('adv-inv-n-text', 'children'),
+     Output('adv-inv-t-text', 'children')],
     [Input('url', 'search'),
      Input('window-width', 'children')]
 )
@@ -714,6 +880,7 @@ def update_lang_adv(search, window_width):
      Output('adv-t-input-posttext-c', 'children'),
      Output('adv-qb-output', 'children'),
      Output('adv-cq-output', 'children'),
+     Output('adv-ach-merv-graph', 'figure'),
      Output('adv-alert-no-update', 'children'),
      Output('adv-alert-no-update', 'is_open')],
     [Input('adv-floor-area', 'value'),
@@ -740,7 +907,15 @@ def update_lang_adv(search, window_width):
      Input('adv-t-input-c', 'value'),
      Input('adv-prev-input-b', 'value'),
      Input('adv-prev-input-c', 'value'),
-     Input('url', 'search')],
+     Input('adv-mc-enable', 'value'),
+     Input('adv-mc-cq-gsd', 'value'),
+     Input('adv-mc-qb-gsd', 'value'),
+     Input('adv-mc-mask-fit-range', 'value'),
+     Input('adv-mc-deact-min', 'value'),
+     Input('adv-mc-deact-max', 'value'),
+     Input('adv-mc-samples', 'value'),
+     Input('url', 'search'),
+     Input('adv-scen-loaded', 'data')],
     [State('adv-floor-area-text', 'children'),
      State('adv-ceiling-height-text', 'children')]
 )
@@ -748,7 +923,8 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
                   breathing_flow_rate, infectiousness, mask_eff, mask_fit, risk_tolerance, sr_age_factor,
                   sr_strain_factor, pim_input, def_aerosol_radius,
                   max_viral_deact_rate, n_max_input, exp_time_input, n_max_input_b, exp_time_input_b, n_max_input_c,
-                  exp_time_input_c, prevalence_b, prevalence_c, search, floor_area_text, ceiling_height_text):
+                  exp_time_input_c, prevalence_b, prevalence_c, mc_enable, mc_cq_gsd, mc_qb_gsd, mc_mask_fit_range,
+                  mc_deact_min, mc_deact_max, mc_samples, search, loaded_inputs, floor_area_text, ceiling_height_text):
     language = ess.get_lang(search)
     error_msg = ess.get_err_msg(floor_area, ceiling_height, air_exchange_rate, merv, recirc_rate, def_aerosol_radius,
                                 max_viral_deact_rate, language, n_max_input, exp_time_input, n_max_input_b,
@@ -764,7 +940,7 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
                dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
                dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
                dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, \
-               dash.no_update, dash.no_update, dash.no_update, dash.no_update, error_msg, True
+               dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, error_msg, True
 
     # Check our units! Did we switch? If so, convert values before calculating
     my_units = ess.get_units(search)
@@ -772,6 +948,34 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
     if curr_units != "":
         [floor_area, ceiling_height] = ess.convert_units(curr_units, my_units, floor_area, ceiling_height)
 
+    scenario_values = [floor_area, ceiling_height, air_exchange_rate, recirc_rate, merv, relative_humidity,
+                       breathing_flow_rate, infectiousness, mask_eff, mask_fit, risk_tolerance, sr_age_factor,
+                       sr_strain_factor, pim_input, def_aerosol_radius, max_viral_deact_rate, n_max_input,
+                       exp_time_input, n_max_input_b, exp_time_input_b, n_max_input_c, exp_time_input_c, prevalence_b,
+                       prevalence_c, mc_enable, mc_cq_gsd, mc_qb_gsd, mc_mask_fit_range, mc_deact_min, mc_deact_max,
+                       mc_samples]
+    if not is_scenario_loaded():
+        return calc_figure_outputs(language, my_units, *scenario_values)
+
+    # A loaded scenario (see scenarios.py) shows the outputs saved with it instead of recalculating, and keeps the
+    # outputs of a language it was not shown in before
+    inputs_key = scenarios.get_inputs_key(dict(zip(scenarios.scenario_inputs, scenario_values)), my_units)
+    scenario_store = scenarios.get_scenario_store()
+    outputs = scenario_store.get_outputs(inputs_key, language)
+    if outputs is None:
+        outputs = calc_figure_outputs(language, my_units, *scenario_values)
+        scenario_store.cache_outputs(inputs_key, language, outputs)
+    return outputs
+
+
+# Calculate the model and every displayed output of update_figure for valid inputs (the scenario inputs, in the order of
+# scenarios.scenario_inputs, with floor area and ceiling height in my_units)
+def calc_figure_outputs(language, my_units, floor_area, ceiling_height, air_exchange_rate, recirc_rate, merv,
+                        relative_humidity, breathing_flow_rate, infectiousness, mask_eff, mask_fit, risk_tolerance,
+                        sr_age_factor, sr_strain_factor, pim_input, def_aerosol_radius, max_viral_deact_rate,
+                        n_max_input, exp_time_input, n_max_input_b, exp_time_input_b, n_max_input_c, exp_time_input_c,
+                        prevalence_b, prevalence_c, mc_enable, mc_cq_gsd, mc_qb_gsd, mc_mask_fit_range, mc_deact_min,
+                        mc_deact_max, mc_samples):
     # Check if we just moved to a preset; if not, change the preset dropdown to custom
     preset_dd_value = ess.get_room_preset_dd_value(floor_area, ceiling_height, air_exchange_rate, recirc_rate, merv,
                                                    relative_humidity, my_units)
@@ -811,8 +1015,23 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
     qb_text = ess.get_qb_text(myInd, my_units)
     cq_text = ess.get_cq_text(myInd, my_units)
 
+    # Monte Carlo uncertainty bands, sampled around the current inputs
+    percentile_bands = None
+    mc_inputs = [mc_cq_gsd, mc_qb_gsd, mc_mask_fit_range, mc_deact_min, mc_deact_max, mc_samples]
+    if 'on' in mc_enable and None not in mc_inputs:
+        mc_spec = {
+            'exhaled_air_inf': ('lognormal', infectiousness, max(mc_cq_gsd, 1)),
+            'breathing_flow_rate': ('lognormal', breathing_flow_rate, max(mc_qb_gsd, 1)),
+            'mask_passage_prob': ('uniform', 1 - mask_eff * min(mask_fit + mc_mask_fit_range, 1),
+                                  1 - mask_eff * max(mask_fit - mc_mask_fit_range, 0)),
+            'max_viral_deact_rate': ('uniform', min(mc_deact_min, mc_deact_max), max(mc_deact_min, mc_deact_max)),
+        }
+        mc_samples = int(Indoors.clamp(mc_samples, 1000, 1000000))
+        percentile_bands = uncertainty.run_monte_carlo(myInd, mc_spec, ess.graph_exp_times, 'n_max', 'conditional',
+                                                       mc_samples)
+
     # Update the figure with a new model calculation
-    new_fig = ess.get_model_figure(myInd, language)
+    new_fig = ess.get_model_figure(myInd, language, percentile_bands)
 
     # Update the red text output with new model calculations
     # Model values of interest
@@ -827,6 +1046,9 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
                                      language)
     n_max_text = ess.get_n_max_text(myInd.calc_n_max(exp_time_input, 'conditional'), myInd.get_n_max(), language)
 
+    # Ventilation vs. filtration tradeoff for the current room and occupants
+    ach_merv_fig = ess.get_ach_merv_figure(myInd, merv, n_max_input, 'conditional', ess.covid_recovery_time, language)
+
     # Get n pretext and posttext
     desc_file = ess.get_desc_file(language)
     n_input_pretext = ""
@@ -898,7 +1120,7 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
         t_input_posttext_c = desc_file.tn_bridge_string + n_max_text_c
 
     # Update all relevant display items (figure, red output text)
-    return new_fig, model_output_text[0], model_output_text[1], model_output_text[2], model_output_text[3], \
+    outputs = new_fig, model_output_text[0], model_output_text[1], model_output_text[2], model_output_text[3], \
            model_output_text[4], model_output_text_b[0], model_output_text_b[1], model_output_text_b[2], \
            model_output_text_b[3], model_output_text_b[4], model_output_text_c[0], model_output_text_c[1], \
            model_output_text_c[2], model_output_text_c[3], model_output_text_c[4], six_ft_text, six_ft_exp_time, \
@@ -910,8 +1132,9 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
            n_input_pretext, n_input_posttext, t_input_pretext, t_input_posttext,\
            n_input_pretext_b, n_input_posttext_b, t_input_pretext_b, t_input_posttext_b, \
            n_input_pretext_c, n_input_posttext_c, t_input_pretext_c, t_input_posttext_c, \
-           qb_text, cq_text, \
-           error_msg, False
+           qb_text, cq_text, ach_merv_fig, \
+           "", False
+    return outputs
 
 
 # Update options based on selected presets, also if units changed
@@ -926,13 +1149,14 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
      Output('adv-floor-area-text', 'children'),
      Output('adv-ceiling-height-text', 'children')],
     [Input('adv-presets', 'value'),
-     Input('url', 'search')],
+     Input('url', 'search'),
+     Input('adv-scen-loaded', 'data')],
     [State('adv-floor-area-text', 'children'),
      State('adv-ceiling-height-text', 'children'),
      State('adv-floor-area', 'value'),
      State('adv-ceiling-height', 'value')]
 )
-def update_room_presets_and_units(preset, search, floor_area_text, ceiling_height_text, curr_floor_area,
+def update_room_presets_and_units(preset, search, loaded_inputs, floor_area_text, ceiling_height_text, curr_floor_area,
                                   curr_ceiling_height):
     desc_file = ess.get_desc_file(ess.get_lang(search))
     my_units = ess.get_units(search)
@@ -947,6 +1171,12 @@ def update_room_presets_and_units(preset, search, floor_area_text, ceiling_heigh
     else:
         text_output = [desc_file.floor_area_text_metric, desc_file.ceiling_height_text_metric]
 
+    # A loaded scenario sets every room input (already in the current units)
+    if is_scenario_loaded():
+        return loaded_inputs['floor_area'], loaded_inputs['ceiling_height'], loaded_inputs['air_exchange_rate'], \
+               loaded_inputs['recirc_rate'], loaded_inputs['merv'], loaded_inputs['relative_humidity'], \
+               text_output[0], text_output[1]
+
     # Update the room and behavior options based on the selected preset
     if preset == 'custom':
         if did_switch:
@@ -976,9 +1206,14 @@ def update_room_presets_and_units(preset, search, floor_area_text, ceiling_heigh
      Output('adv-exp-activity', 'value'),
      Output('adv-mask-type', 'value'),
      Output('adv-mask-fit', 'value')],
-    [Input('adv-presets-human', 'value')]
+    [Input('adv-presets-human', 'value'),
+     Input('adv-scen-loaded', 'data')]
 )
-def update_human_presets(preset):
+def update_human_presets(preset, loaded_inputs):
+    if is_scenario_loaded():
+        return loaded_inputs['breathing_flow_rate'], loaded_inputs['infectiousness'], loaded_inputs['mask_eff'], \
+               loaded_inputs['mask_fit']
+
     # Update the room and behavior options based on the selected preset
     if preset == 'custom':
         return dash.no_update, dash.no_update, dash.no_update, dash.no_update
@@ -993,10 +1228,13 @@ def update_human_presets(preset):
     [Output('adv-pim-input', 'max'),
      Output('adv-pim-input', 'value')],
     [Input('adv-prev-input-b', 'value'),
-     Input('adv-prev-input-c', 'value')],
+     Input('adv-prev-input-c', 'value'),
+     Input('adv-scen-loaded', 'data')],
     [State('adv-pim-input', 'value')]
 )
-def update_pim_slider_max(prev_b, prev_c, curr_pim):
+def update_pim_slider_max(prev_b, prev_c, loaded_inputs, curr_pim):
+    if is_scenario_loaded():
+        prev_b, prev_c, curr_pim = [loaded_inputs[name] for name in ['prevalence_b', 'prevalence_c', 'pim_input']]
     prev_b = prev_b / 100000
     prev_c = prev_c / 100000
     pim_max = 1 - max(prev_b, prev_c) - 0.001
@@ -1070,3 +1308,239 @@ def update_mask_type_disp(mask_eff):
 )
 def update_mask_fit_disp(mask_fit):
     return ["{:.0f}%".format(mask_fit * 100)]
+
+
+# Room and human behavior inputs shared by the on-demand analyses, in the argument order of get_input_model
+model_input_ids = ['adv-floor-area', 'adv-ceiling-height', 'adv-ventilation-type', 'adv-recirc-rate',
+                   'adv-filter-type', 'adv-relative-humidity', 'adv-exertion-level', 'adv-exp-activity',
+                   'adv-mask-type', 'adv-mask-fit', 'adv-risk-tolerance', 'adv-age-group', 'adv-viral-strain',
+                   'adv-pim-input', 'adv-aerosol-radius', 'adv-viral-deact-rate']
+
+
+# Returns the model for the given room and human behavior inputs (see model_input_ids), or None if they are invalid
+def get_input_model(search, n_max_input, exp_time_input, floor_area, ceiling_height, air_exchange_rate, recirc_rate,
+                    merv, relative_humidity, breathing_flow_rate, infectiousness, mask_eff, mask_fit, risk_tolerance,
+                    sr_age_factor, sr_strain_factor, pim_input, def_aerosol_radius, max_viral_deact_rate):
+    language = ess.get_lang(search)
+    error_msg = ess.get_err_msg(floor_area, ceiling_height, air_exchange_rate, merv, recirc_rate, def_aerosol_radius,
+                                max_viral_deact_rate, language, n_max_input, exp_time_input)
+    if error_msg != "":
+        return None
+
+    # If metric, convert floor_area and ceiling_height to feet
+    if ess.get_units(search) == "metric":
+        floor_area = floor_area * 10.764
+        ceiling_height = ceiling_height * 3.281
+
+    return ess.get_indoor_model(floor_area, ceiling_height, air_exchange_rate, recirc_rate, merv, relative_humidity,
+                                breathing_flow_rate, infectiousness, mask_eff, mask_fit, risk_tolerance, sr_age_factor,
+                                sr_strain_factor, def_aerosol_radius, max_viral_deact_rate, 1 - pim_input)
+
+
+# Global sensitivity analysis of the current room, run on demand
+@app.callback(
+    [Output('adv-sa-graph', 'figure')],
+    [Input('adv-sa-run', 'n_clicks'),
+     Input('url', 'search')],
+    [State('adv-n-input', 'value')] + [State(input_id, 'value') for input_id in model_input_ids]
+)
+def update_sensitivity(n_clicks, search, n_max_input, *model_inputs):
+    if n_clicks == 0:
+        raise PreventUpdate
+
+    sa_model = get_input_model(search, n_max_input, 1, *model_inputs)
+    if sa_model is None:
+        raise PreventUpdate
+
+    sobol_indices = sensitivity.calc_sobol_indices(sa_model, n_max_input, 'conditional')
+    return [ess.get_sensitivity_figure(sobol_indices, ess.get_lang(search))]
+
+
+# Least mitigation of the chosen lever needed for the target occupancy and exposure time
+@app.callback(
+    [Output('adv-inv-output', 'children')],
+    [Input('adv-inv-lever', 'value'),
+     Input('adv-inv-risk-type', 'value'),
+     Input('adv-inv-n', 'value'),
+     Input('adv-inv-t', 'value'),
+     Input('adv-prev-input-b', 'value'),
+     Input('adv-prev-input-c', 'value'),
+     Input('url', 'search')] + [Input(input_id, 'value') for input_id in model_input_ids]
+)
+def update_inverse(lever, risk_type, n_max_input, exp_time_input, prevalence_b, prevalence_c, search, *model_inputs):
+    if n_max_input is None or exp_time_input is None or exp_time_input <= 0:
+        raise PreventUpdate
+
+    inv_model = get_input_model(search, n_max_input, exp_time_input, *model_inputs)
+    if inv_model is None:
+        raise PreventUpdate
+
+    # Prevalence and personal risk use the incidence rate (per 100,000) of their output tabs
+    pim_input = model_inputs[model_input_ids.index('adv-pim-input')]
+    if risk_type == 'prevalence':
+        if prevalence_b is None or prevalence_b <= 0:
+            raise PreventUpdate
+        inv_model.prevalence = prevalence_b / 100000
+        inv_model.percentage_sus = 1 - (inv_model.prevalence + pim_input)
+    elif risk_type == 'personal':
+        if prevalence_c is None or prevalence_c <= 0:
+            raise PreventUpdate
+        inv_model.prevalence = prevalence_c / 100000
+        inv_model.percentage_sus = 1 - (inv_model.prevalence + pim_input)
+
+    return [ess.get_inverse_text(inv_model, lever, n_max_input, exp_time_input, risk_type, ess.get_lang(search))]
+
+
+# Components of the update_figure inputs, in the order of scenarios.scenario_inputs
+scenario_input_ids = model_input_ids + ['adv-n-input', 'adv-t-input', 'adv-n-input-b', 'adv-t-input-b',
+                                        'adv-n-input-c', 'adv-t-input-c', 'adv-prev-input-b', 'adv-prev-input-c',
+                                        'adv-mc-enable', 'adv-mc-cq-gsd', 'adv-mc-qb-gsd', 'adv-mc-mask-fit-range',
+                                        'adv-mc-deact-min', 'adv-mc-deact-max', 'adv-mc-samples']
+
+# Inputs set directly by load_scenario; room and human behavior inputs, and the pim slider, are set by the callbacks
+# that already own them (see is_scenario_loaded)
+scenario_direct_inputs = ['risk_tolerance', 'sr_age_factor', 'sr_strain_factor', 'def_aerosol_radius',
+                          'max_viral_deact_rate', 'n_max_input', 'exp_time_input', 'n_max_input_b', 'exp_time_input_b',
+                          'n_max_input_c', 'exp_time_input_c', 'prevalence_b', 'prevalence_c', 'mc_enable', 'mc_cq_gsd',
+                          'mc_qb_gsd', 'mc_mask_fit_range', 'mc_deact_min', 'mc_deact_max', 'mc_samples']
+
+
+# Returns whether the running callback was triggered by loading a saved scenario
+def is_scenario_loaded():
+    return any(trigger['prop_id'] == 'adv-scen-loaded.data' for trigger in dash.callback_context.triggered)
+
+
+# Updates the saved scenarios text based on language
+@app.callback(
+    [Output('adv-tab-h', 'label'),
+     Output('adv-scen-header', 'children'),
+     Output('adv-scen-desc', 'children'),
+     Output('adv-scen-name-text', 'children'),
+     Output('adv-scen-save', 'children'),
+     Output('adv-scen-select-text', 'children'),
+     Output('adv-scen-load', 'children'),
+     Output('adv-scen-compare-text', 'children'),
+     Output('adv-scen-multi-text', 'children'),
+     Output('adv-scen-risk-text', 'children'),
+     Output('adv-scen-risk-type', 'options')],
+    [Input('url', 'search')]
+)
+def update_lang_scenarios(search):
+    language = ess.get_lang(search)
+    return [ess.get_desc_text(language, name) for name in ['scen_header', 'scen_header', 'scen_desc', 'scen_name_text',
+                                                            'scen_save_text', 'scen_select_text', 'scen_load_text',
+                                                            'scen_compare_text', 'scen_multi_text', 'scen_risk_text',
+                                                            'inv_risk_options']]
+
+
+# Saves the current inputs as a named scenario, with its displayed outputs in the current language, and lists the saved
+# scenarios
+@app.callback(
+    [Output('adv-scen-status', 'children'),
+     Output('adv-scen-select', 'options'),
+     Output('adv-scen-compare', 'options'),
+     Output('adv-scen-multi', 'options')],
+    [Input('adv-scen-save', 'n_clicks'),
+     Input('url', 'search')],
+    [State('adv-scen-name', 'value')] + [State(input_id, 'value') for input_id in scenario_input_ids]
+)
+def update_scenario_list(n_clicks, search, name, *scenario_values):
+    language = ess.get_lang(search)
+    scenario_store = scenarios.get_scenario_store()
+    status = ""
+    if any(trigger['prop_id'] == 'adv-scen-save.n_clicks' for trigger in dash.callback_context.triggered):
+        inputs = dict(zip(scenarios.scenario_inputs, scenario_values))
+        error_msg = ess.get_err_msg(inputs['floor_area'], inputs['ceiling_height'], inputs['air_exchange_rate'],
+                                    inputs['merv'], inputs['recirc_rate'], inputs['def_aerosol_radius'],
+                                    inputs['max_viral_deact_rate'], language, inputs['n_max_input'],
+                                    inputs['exp_time_input'], inputs['n_max_input_b'], inputs['exp_time_input_b'],
+                                    inputs['n_max_input_c'], inputs['exp_time_input_c'], inputs['prevalence_b'],
+                                    inputs['prevalence_c'])
+        if not name:
+            status = ess.get_desc_text(language, 'scen_no_name')
+        elif error_msg != "":
+            status = error_msg
+        else:
+            units = ess.get_units(search)
+            outputs = calc_figure_outputs(language, units, *scenario_values)
+            scenario_store.save_scenarios([{'name': name, 'inputs': inputs, 'units': units, 'language': language,
+                                            'outputs': outputs}])
+            status = ess.get_desc_text(language, 'scen_saved').format(name=name)
+
+    scenario_list = scenario_store.list_scenarios()
+    options = [{'label': ess.get_desc_text(language, 'scen_option').format(
+        name=scenario_name, room_type=room_type, created=time.strftime('%Y-%m-%d %H:%M', time.localtime(created))),
+        'value': scenario_id} for scenario_id, scenario_name, room_type, created in
+        zip(scenario_list['id'], scenario_list['name'], scenario_list['room_type'], scenario_list['created'])]
+    return [status, options, options, options]
+
+
+# Loads a saved scenario: sets every input, converting its room size to the current units. Its outputs are cached
+# with it, so update_figure shows them without recalculating.
+@app.callback(
+    [Output('adv-scen-loaded', 'data')] +
+    [Output(scenario_input_ids[scenarios.scenario_inputs.index(name)], 'value') for name in scenario_direct_inputs],
+    [Input('adv-scen-load', 'n_clicks')],
+    [State('adv-scen-select', 'value'),
+     State('url', 'search')]
+)
+def load_scenario(n_clicks, scenario_id, search):
+    if n_clicks == 0 or scenario_id is None:
+        raise PreventUpdate
+    scenario = scenarios.get_scenario_store().get_scenario(scenario_id)
+    if scenario is None:
+        raise PreventUpdate
+
+    inputs = scenario['inputs']
+    [inputs['floor_area'], inputs['ceiling_height']] = ess.convert_units(scenario['units'], ess.get_units(search),
+                                                                         inputs['floor_area'], inputs['ceiling_height'])
+    return [inputs] + [inputs[name] for name in scenario_direct_inputs]
+
+
+# Compares two saved scenarios: a table of the settings and results that differ
+@app.callback(
+    [Output('adv-scen-diff', 'children')],
+    [Input('adv-scen-select', 'value'),
+     Input('adv-scen-compare', 'value'),
+     Input('url', 'search')]
+)
+def update_scenario_diff(scenario_id_a, scenario_id_b, search):
+    if scenario_id_a is None or scenario_id_b is None:
+        return [""]
+    scenario_store = scenarios.get_scenario_store()
+    try:
+        diff = scenario_store.diff_scenarios(scenario_id_a, scenario_id_b)
+    except KeyError:
+        raise PreventUpdate
+    language = ess.get_lang(search)
+    if len(diff) == 0:
+        return [ess.get_desc_text(language, 'scen_same')]
+
+    names = [scenario_store.get_scenario(scenario_id)['name'] for scenario_id in [scenario_id_a, scenario_id_b]]
+    header = html.Tr([html.Th(ess.get_desc_text(language, 'scen_field_header'))] + [html.Th(name) for name in names])
+    rows = [html.Tr([html.Td(field)] + [html.Td('{:.4g}'.format(value) if isinstance(value, float) else str(value))
+                                        for value in [value_a, value_b]])
+            for field, value_a, value_b in zip(diff['field'], diff['a'], diff['b'])]
+    return [html.Table([header] + rows)]
+
+
+# Compares several saved scenarios at once: their maximum occupancy curves on one figure, and a table of their
+# maximum exposure times and occupancies with the change from the first scenario
+@app.callback(
+    [Output('adv-scen-graph', 'figure'),
+     Output('adv-scen-table', 'children')],
+    [Input('adv-scen-multi', 'value'),
+     Input('adv-scen-risk-type', 'value'),
+     Input('url', 'search')]
+)
+def update_scenario_comparison(scenario_ids, risk_type, search):
+    if not scenario_ids:
+        raise PreventUpdate
+    language = ess.get_lang(search)
+    if len(scenario_ids) > scenarios.max_compared_scenarios:
+        return [dash.no_update, ess.get_desc_text(language, 'scen_too_many').format(n=scenarios.max_compared_scenarios)]
+    try:
+        comparison = scenarios.get_scenario_store().compare_scenarios(scenario_ids, risk_type)
+    except KeyError:
+        raise PreventUpdate
+    return [ess.get_comparison_figure(comparison, language), ess.get_comparison_table(comparison, risk_type, language)]
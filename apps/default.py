@@ -10,6 +10,7 @@ from indoors import Indoors
 from app import app
 import descriptions as desc
 import essentials as ess
+import presets
 
 """
 default.py contains the core functionality of the Dash app Basic Mode. It is responsible for taking inputs,
@@ -559,6 +560,13 @@ def update_figure(floor_area, ceiling_height, air_exchange_rate, recirc_rate, me
     human_preset_dd_value = ess.get_human_preset_dd_value(breathing_flow_rate, infectiousness, mask_eff, mask_fit,
                                                           my_units)
 
+    # Preset combinations are served from the precomputed table (see presets.py), unless the units are being switched
+    if curr_units == "":
+        preset_outputs = presets.get_preset_outputs(preset_dd_value, human_preset_dd_value, sr_age_factor,
+                                                    sr_strain_factor, n_max_input, exp_time_input, my_units, language)
+        if preset_outputs is not None:
+            return preset_outputs
+
     # If metric, convert floor_area and ceiling_height to feet
     if my_units == "metric":
         floor_area = floor_area * 10.764
@@ -0,0 +1,150 @@
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input, Output, State, ALL
+from dash.exceptions import PreventUpdate
+
+import live
+from app import app
+import descriptions as desc
+import essentials as ess
+
+"""
+live.py contains the Live Monitoring display: a wall of room cards kept up to date from a local sensor feed (see the
+top-level live.py for the monitor). The page polls at the monitor's cadence, and each poll sends only the cards of the
+rooms recalculated since the version the page last saw. The grid of cards is only rebuilt when rooms are added or
+the language changes.
+
+Properties:
+Main App (Live Monitoring)
+
+Methods:
+def get_room_texts: Returns the card class and texts of one room
+def get_room_card: Returns the card of one room
+def update_lang_live: Updates text based on language
+def update_live_grid: Rebuilds the grid of room cards when rooms are added
+def update_live_rooms: Sends the cards of the rooms that changed since the last poll
+"""
+
+# Main App (Live Monitoring)
+layout = html.Div(children=[
+    html.Div(
+        className='main-content',
+        children=[
+            html.Div(
+                className='card',
+                children=[
+                    html.H6(html.Span(desc.live_header, id='live-header')),
+                    html.Div(desc.live_desc, id='live-desc'),
+                    html.Div(id='live-grid', className='grid-live'),
+                ]
+            ),
+        ]
+    ),
+    dcc.Interval(id='live-interval', interval=live.get_cadence() * 1000),
+    dcc.Store(id='live-version', data=0),
+    dcc.Store(id='live-rooms-version', data=-1),
+])
+
+# Rooms version of the grid shown without a feed (the grid of a page not yet built has -1)
+no_feed_version = -2
+
+
+# Returns the card class, occupancy text and limit text of one room of a monitor delta (see LiveMonitor.get_delta)
+def get_room_texts(delta, index, exp_time, language):
+    occupancy = delta['occupancy'][index]
+    n_max = delta['n_max'][index]
+    limit_text = ess.get_desc_text(language, 'live_limit').format(t=exp_time, n_max=max(n_max, 0))
+    if occupancy < 2:
+        occupancy_text = ess.get_desc_text(language, 'live_empty') if occupancy == 0 else \
+            ess.get_desc_text(language, 'live_occupancy').format(n=occupancy)
+        time_text = ""
+    else:
+        occupancy_text = ess.get_desc_text(language, 'live_occupancy').format(n=occupancy)
+        time_text = ess.get_desc_text(language, 'live_max_time').format(
+            time=ess.time_to_text(delta['max_time'][index], True, ess.covid_recovery_time, language))
+    class_name = 'card-live' if delta['safe'][index] else 'card-live-over'
+    return class_name, occupancy_text, html.Div([limit_text, html.Br(), time_text])
+
+
+# Returns the card of one room of a monitor delta
+def get_room_card(delta, index, exp_time, language):
+    room = delta['room'][index]
+    class_name, occupancy_text, limit_text = get_room_texts(delta, index, exp_time, language)
+    return html.Div(id={'type': 'live-room', 'index': room}, className=class_name, children=[
+        html.H6(delta['name'][index]),
+        html.H4(occupancy_text, id={'type': 'live-occupancy', 'index': room}, className='model-output-text-small'),
+        html.Div(limit_text, id={'type': 'live-limit', 'index': room}),
+    ])
+
+
+# Updates text based on language
+@app.callback(
+    [Output('live-header', 'children'),
+     Output('live-desc', 'children')],
+    [Input('url', 'search')]
+)
+def update_lang_live(search):
+    language = ess.get_lang(search)
+    return [ess.get_desc_text(language, 'live_header'), ess.get_desc_text(language, 'live_desc')]
+
+
+# Rebuilds the grid of room cards, with every room's current values, when rooms are added or the language changes
+@app.callback(
+    [Output('live-grid', 'children'),
+     Output('live-rooms-version', 'data')],
+    [Input('live-interval', 'n_intervals'),
+     Input('url', 'search')],
+    [State('live-rooms-version', 'data')]
+)
+def update_live_grid(n_intervals, search, rooms_version):
+    language = ess.get_lang(search)
+    monitor = live.get_live_monitor()
+    language_changed = any(trigger['prop_id'] == 'url.search' for trigger in dash.callback_context.triggered)
+    if monitor is None:
+        if rooms_version == no_feed_version and not language_changed:
+            raise PreventUpdate
+        return [html.Div(ess.get_desc_text(language, 'live_no_feed')), no_feed_version]
+
+    if monitor.rooms_version == rooms_version and not language_changed:
+        raise PreventUpdate
+
+    delta = monitor.get_delta()
+    cards = [get_room_card(delta, index, monitor.exp_time, language) for index in range(len(delta['room']))]
+    return [cards, delta['rooms_version']]
+
+
+# Sends the class and texts of only the rooms recalculated since the version this page last saw (dash.no_update for
+# every other card, so unchanged cards are neither sent nor redrawn)
+@app.callback(
+    [Output({'type': 'live-room', 'index': ALL}, 'className'),
+     Output({'type': 'live-occupancy', 'index': ALL}, 'children'),
+     Output({'type': 'live-limit', 'index': ALL}, 'children'),
+     Output('live-version', 'data')],
+    [Input('live-interval', 'n_intervals')],
+    [State('live-version', 'data'),
+     State('url', 'search')]
+)
+def update_live_rooms(n_intervals, version, search):
+    monitor = live.get_live_monitor()
+    if monitor is None:
+        raise PreventUpdate
+    delta = monitor.get_delta(version)
+    if delta['version'] == version:
+        raise PreventUpdate
+
+    language = ess.get_lang(search)
+    changed = {room: index for index, room in enumerate(delta['room'])}
+    card_rooms = [output['id']['index'] for output in dash.callback_context.outputs_list[0]]
+    class_names = []
+    occupancy_texts = []
+    limit_texts = []
+    for room in card_rooms:
+        if room in changed:
+            class_name, occupancy_text, limit_text = get_room_texts(delta, changed[room], monitor.exp_time, language)
+        else:
+            class_name = occupancy_text = limit_text = dash.no_update
+        class_names.append(class_name)
+        occupancy_texts.append(occupancy_text)
+        limit_texts.append(limit_text)
+    return [class_names, occupancy_texts, limit_texts, delta['version']]
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+"""
+benchmark.py times the model, the text and figure formatting, and the Dash callbacks of both modes end to end, and
+keeps a JSON history of the results so that a release that makes the servers slower is caught.
+
+Every benchmark runs the same inputs: after warmup calls, it is timed for a number of rounds, each of enough calls to
+last at least min_round_time, and the median time per call over the rounds is kept (with the minimum, and the
+interquartile range as a measure of noise). A run is compared with the median of the recent runs in the history
+made on the same machine and Python version; a benchmark slower than that by more than its threshold is a regression,
+and the script exits with status 1.
+
+Usage: python benchmark.py [--filter NAME] [--rounds N] [--history FILE] [--threshold RATIO] [--no-save]
+
+Properties:
+Benchmark Settings
+benchmarks: list of (name, function, setup, threshold)
+
+Methods:
+def get_model: Get the model used by the model benchmarks.
+def get_figure_payload: Get the request of update_figure in a mode, as the renderer sends it.
+def time_benchmark: Time one benchmark.
+def get_environment: Get the machine and versions a run was made on.
+def load_history: Load the benchmark history.
+def find_regressions: Compare a run with the recent runs in the history.
+def run_benchmarks: Run the benchmarks, compare them with the history and save the run.
+"""
+
+# Benchmark Settings
+default_rounds = 15
+warmup_calls = 3
+min_round_time = 0.05  # seconds
+default_history = 'benchmark_history.json'
+default_threshold = 1.25  # slowdown (ratio of median times) counted as a regression
+noisy_threshold = 1.5  # for benchmarks that go through the server or plotly
+history_window = 5  # recent runs on the same environment forming the baseline
+max_history = 200  # runs kept in the history file
+
+# Callbacks go through the server with a scenario database of their own, so saved scenarios do not change the results
+os.environ.setdefault('SCENARIO_DB', os.path.join(tempfile.gettempdir(), 'benchmark_scenarios.db'))
+
+import essentials as ess  # noqa: E402 (after the environment is set)
+from indoors import Indoors  # noqa: E402
+
+
+# Returns the model used by the model benchmarks: Basic Mode's default room (a classroom, masks while speaking)
+def get_model():
+    return ess.get_preset_model('classroom', 'masks-2')
+
+
+# Returns the request body of update_figure in a mode ('basic' or 'advanced') after a floor area change, as the renderer
+# sends it
+def get_figure_payload(mode):
+    import payloads
+    prefix = payloads.page_prefixes[mode]
+    values = payloads.get_page_values(mode)
+    values[prefix + 'floor-area', 'value'] = 1000
+    return payloads.make_payload(payloads.get_callback_key(prefix + 'safety-graph.figure'), values,
+                                 [prefix + 'floor-area.value'])
+
+
+# Clears the result caches the callbacks use, so every timed call recalculates
+def clear_caches():
+    ess.ach_merv_cache.clear()
+
+
+# Returns the benchmarks: (name, function to time, setup run before every call or None, regression threshold)
+def get_benchmarks():
+    model = get_model()
+    merv_values = numpy.arange(0, 21)
+    benchmarks = [
+        ('indoors.calc_vars', model.calc_vars, None, default_threshold),
+        ('indoors.calc_n_max', lambda: model.calc_n_max(4, 'conditional'), None, default_threshold),
+        ('indoors.calc_max_time', lambda: model.calc_max_time(25, 'conditional'), None, default_threshold),
+        ('indoors.calc_n_max_series', lambda: model.calc_n_max_series(2, 100, 1.0), None, default_threshold),
+        ('indoors.merv_to_eff', lambda: [Indoors.merv_to_eff(merv, 2) for merv in merv_values], None,
+         default_threshold),
+        ('essentials.get_model_figure', lambda: ess.get_model_figure(model, 'en'), None, noisy_threshold),
+        ('essentials.get_model_output_text',
+         lambda: ess.get_model_output_text(model, 'conditional', ess.covid_recovery_time, 'en'), None,
+         default_threshold),
+        ('essentials.time_to_text', lambda: [ess.time_to_text(hours, True, ess.covid_recovery_time, 'en')
+                                             for hours in [0.2, 3.5, 30, 500, 5000]], None, default_threshold),
+        ('essentials.build_lang_text_adv', lambda: ess.build_lang_text_adv('fr', 1300), None, default_threshold),
+    ]
+
+    # End to end through the Flask test client
+    import index
+    import payloads
+    client = index.app.server.test_client()
+    for mode in ['basic', 'advanced']:
+        payload = get_figure_payload(mode)
+        benchmarks.append(('callback.update_figure.' + mode,
+                           lambda payload=payload: payloads.post_payload(client, payload).get_data(),
+                           clear_caches, noisy_threshold))
+    return benchmarks
+
+
+# Time one benchmark: rounds of calls (each round long enough to time reliably), with the setup run untimed before
+# every call. Returns the median, minimum and interquartile range of the time per call (seconds), and the calls made.
+def time_benchmark(function, setup=None, rounds=default_rounds):
+    for _ in range(warmup_calls):
+        if setup is not None:
+            setup()
+        function()
+
+    # Calls per round, so that a round lasts at least min_round_time
+    start = time.perf_counter()
+    if setup is not None:
+        setup()
+    function()
+    calls = max(1, int(min_round_time / max(time.perf_counter() - start, 1e-9)))
+
+    round_times = []
+    for _ in range(rounds):
+        if setup is None:
+            # Time the round as a whole, so the timer's own cost does not swamp the fastest calls
+            start = time.perf_counter()
+            for _ in range(calls):
+                function()
+            elapsed = time.perf_counter() - start
+        else:
+            elapsed = 0
+            for _ in range(calls):
+                setup()
+                start = time.perf_counter()
+                function()
+                elapsed += time.perf_counter() - start
+        round_times.append(elapsed / calls)
+    quartiles = numpy.percentile(round_times, [25, 50, 75])
+    return {'median': float(quartiles[1]), 'min': float(numpy.min(round_times)),
+            'iqr': float(quartiles[2] - quartiles[0]), 'calls': calls * rounds}
+
+
+# Returns the machine, Python and library versions, and git commit of a run. Runs are only compared with runs made
+# in the same environment (see find_regressions).
+def get_environment():
+    import dash
+    import pandas as pd
+    import plotly
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'machine': platform.node(),
+        'processor': platform.processor() or platform.machine(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'pandas': pd.__version__,
+        'plotly': plotly.__version__,
+        'dash': dash.__version__,
+        'commit': commit,
+    }
+
+
+# Returns the runs in a history file (a list, oldest first), or an empty history if the file does not exist
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as history_file:
+        return json.load(history_file)['runs']
+
+
+# Compare a run's results with the median of the recent runs in the history made in the same environment (machine,
+# processor and versions, ignoring the commit). Returns a dictionary of benchmark name to (ratio to the baseline,
+# regressed), for the benchmarks with a baseline.
+def find_regressions(results, environment, history, thresholds):
+    same_environment = [run for run in history if {key: value for key, value in run['environment'].items()
+                                                   if key != 'commit'} ==
+                        {key: value for key, value in environment.items() if key != 'commit'}]
+    comparisons = {}
+    for name, result in results.items():
+        baseline = [run['results'][name]['median'] for run in same_environment if name in run['results']]
+        if len(baseline) == 0:
+            continue
+        ratio = result['median'] / numpy.median(baseline[-history_window:])
+        comparisons[name] = (float(ratio), bool(ratio > thresholds[name]))
+    return comparisons
+
+
+# Run the benchmarks whose names contain name_filter, print a report, compare them with the history (see
+# find_regressions) and append the run to it. Returns the number of regressions.
+def run_benchmarks(name_filter='', rounds=default_rounds, history_path=default_history, threshold=None, save=True):
+    benchmarks = [benchmark for benchmark in get_benchmarks() if name_filter in benchmark[0]]
+    thresholds = {name: threshold or benchmark_threshold for name, _, _, benchmark_threshold in benchmarks}
+    results = {}
+    for name, function, setup, _ in benchmarks:
+        results[name] = time_benchmark(function, setup, rounds)
+
+    environment = get_environment()
+    history = load_history(history_path)
+    comparisons = find_regressions(results, environment, history, thresholds)
+    print('{:<36} {:>12} {:>12} {:>10} {:>9}'.format('benchmark', 'median (ms)', 'min (ms)', 'iqr (ms)', 'change'))
+    for name, result in results.items():
+        change = ''
+        if name in comparisons:
+            ratio, regressed = comparisons[name]
+            change = '{:+.0%}{}'.format(ratio - 1, ' !' if regressed else '')
+        print('{:<36} {:>12.4f} {:>12.4f} {:>10.4f} {:>9}'.format(name, result['median'] * 1000, result['min'] * 1000,
+                                                                  result['iqr'] * 1000, change))
+
+    regressions = [name for name, (_, regressed) in comparisons.items() if regressed]
+    for name in regressions:
+        print('Regression: {} is {:.0%} slower than its baseline (threshold {:.0%})'.format(
+            name, comparisons[name][0] - 1, thresholds[name] - 1))
+
+    if save:
+        history.append({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment,
+                        'thresholds': thresholds, 'results': results, 'regressions': regressions})
+        with open(history_path + '.tmp', 'w') as history_file:
+            json.dump({'runs': history[-max_history:]}, history_file, indent=1)
+        os.replace(history_path + '.tmp', history_path)
+    return len(regressions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the model, formatting and callbacks.')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose names contain this text')
+    parser.add_argument('--rounds', type=int, default=default_rounds, help='timed rounds per benchmark')
+    parser.add_argument('--history', default=default_history, help='JSON history file')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='slowdown ratio counted as a regression (overrides the per-benchmark thresholds)')
+    parser.add_argument('--no-save', action='store_true', help='do not add this run to the history')
+    args = parser.parse_args()
+    sys.exit(1 if run_benchmarks(args.filter, args.rounds, args.history, args.threshold, not args.no_save) else 0)
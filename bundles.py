@@ -0,0 +1,149 @@
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import flask
+
+from app import app, compress, compress_min_size, encodings, static_levels
+
+"""
+bundles.py serves the files of assets/ so that browsers keep them: when the app starts, the stylesheets are
+concatenated (in the order Dash includes them) and minified into one bundle, and the bundle, the scripts and the
+images are given file names with a hash of their content (fingerprinted), precompressed with brotli and gzip, and held
+in memory. They are served at /bundles/ with immutable cache headers, so a repeat visit requests none of them, and a
+deployment that changes a file changes its name. Dash is told to include the bundle and scripts rather than the files
+of assets/, which are still served at /assets/ (e.g. the og:image of index.py).
+
+The same files can be written to a directory for a web server or CDN (e.g. nginx's gzip_static), as a build step.
+
+Usage: python bundles.py --out DIR
+
+Properties:
+Bundle Settings
+
+Methods:
+def minify_css: Minify a stylesheet.
+def build_bundles: Bundle, fingerprint and precompress the files of the assets directory.
+def get_url: Get the URL of a file of the assets directory as bundled.
+def serve_bundle: GET /bundles/<name> - A bundled file, with immutable cache headers
+def write_bundles: Write the bundled files and their compressed variants to a directory.
+"""
+
+# Bundle Settings
+bundle_url_path = '/bundles/'
+bundled_css = 'bundle.css'  # the name of the stylesheet bundle, before fingerprinting
+fingerprint_length = 12  # hex digits of the content hash in file names
+immutable_cache_control = 'public, max-age=31536000, immutable'  # one year, never revalidated
+text_mimetypes = ['text/css', 'application/javascript', 'text/javascript', 'image/vnd.microsoft.icon',
+                  'image/x-icon']  # precompressed
+assets_ignore = r'\.(css|js)$|^favicon\.ico$'  # the files of assets/ Dash leaves to the bundles
+asset_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+
+css_token_pattern = re.compile(r'(/\*.*?\*/|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', re.S)
+css_import_pattern = re.compile(r'@import\s+(?:url\(\s*)?(?:"[^"]*"|\'[^\']*\'|[^\s;)]+)\s*\)?[^;]*;')
+
+
+# Returns a stylesheet minified: without comments, and without the whitespace that does not separate anything.
+# Strings are kept as they are.
+def minify_css(css):
+    parts = css_token_pattern.split(css)
+    css = ''.join(part for index, part in enumerate(parts) if index % 2 == 0 or not part.startswith('/*'))
+    minified = []
+    for index, part in enumerate(css_token_pattern.split(css)):
+        if index % 2 == 0:  # not a string
+            part = re.sub(r'\s+', ' ', part)
+            part = re.sub(r'\s*([{};,>])\s*', r'\1', part)
+            part = re.sub(r':\s+', ':', part)
+        minified.append(part)
+    return ''.join(minified).replace(';}', '}').strip()
+
+
+# Returns the files of the assets directory as they are served: a dictionary of their fingerprinted names to their
+# mimetype and their bodies by encoding (None for uncompressed), and a dictionary of the names in the assets directory
+# (bundle.css for the stylesheets) to their fingerprinted names
+def build_bundles(directory):
+    sources = {}
+    stylesheets = []
+    for file_name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file_name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as asset:
+            data = asset.read()
+        if file_name.endswith('.css'):
+            stylesheets.append(data.decode('utf-8'))
+        else:
+            sources[file_name] = data
+    # @import rules only apply at the start of a stylesheet
+    css = '\n'.join(stylesheets)
+    imports = css_import_pattern.findall(css)
+    sources[bundled_css] = minify_css(''.join(imports) + css_import_pattern.sub('', css)).encode('utf-8')
+
+    files = {}
+    manifest = {}
+    for file_name, data in sources.items():
+        stem, extension = os.path.splitext(file_name)
+        fingerprinted = '{}.{}{}'.format(stem, hashlib.sha256(data).hexdigest()[:fingerprint_length], extension)
+        mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+        bodies = {None: data}
+        if mimetype in text_mimetypes and len(data) >= compress_min_size:
+            for encoding in encodings:
+                bodies[encoding] = compress(data, encoding, static_levels)
+        files[fingerprinted] = (mimetype, bodies)
+        manifest[file_name] = fingerprinted
+    return files, manifest
+
+
+bundle_files, bundle_manifest = build_bundles(asset_dir)
+
+
+# Returns the URL of a file of the assets directory (or of bundle.css) as bundled, with its fingerprinted name
+def get_url(file_name):
+    return bundle_url_path + bundle_manifest[file_name]
+
+
+# Dash includes the bundle and the scripts instead of the files of assets/ (see index.py for the favicon)
+app.config.assets_ignore = assets_ignore
+app.config.external_stylesheets.append(get_url(bundled_css))
+app.config.external_scripts.extend(get_url(file_name) for file_name in sorted(bundle_manifest)
+                                   if file_name.endswith('.js'))
+
+
+# A bundled file, compressed as the client accepts, with immutable cache headers: its name changes with its content
+@app.server.route(bundle_url_path + '<name>')
+def serve_bundle(name):
+    if name not in bundle_files:
+        flask.abort(404)
+    mimetype, bodies = bundle_files[name]
+    encoding = flask.request.accept_encodings.best_match([encoding for encoding in encodings if encoding in bodies])
+    response = flask.Response(bodies[encoding], mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = immutable_cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# Write the bundled files to a directory, with their compressed variants beside them (name.br, name.gz), and the
+# manifest of their names (manifest.json)
+def write_bundles(out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    extensions = {None: '', 'br': '.br', 'gzip': '.gz'}
+    for name, (_, bodies) in bundle_files.items():
+        for encoding, data in bodies.items():
+            with open(os.path.join(out_dir, name + extensions[encoding]), 'wb') as bundle:
+                bundle.write(data)
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(bundle_manifest, manifest_file, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bundle, fingerprint and precompress the files of assets/.')
+    parser.add_argument('--out', required=True, help='directory to write the bundled files to')
+    args = parser.parse_args()
+    write_bundles(args.out)
+    for asset_name, bundle_name in sorted(bundle_manifest.items()):
+        print('{:<22} {:<40} {:>7} bytes'.format(asset_name, bundle_name, len(bundle_files[bundle_name][1][None])))
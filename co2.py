@@ -0,0 +1,233 @@
+import numpy
+import pandas as pd
+
+"""
+co2.py estimates the effective outdoor air exchange rate of rooms from CO2 sensor logs, to replace guessed ventilation
+presets in the model (indoors.py). When a room empties, its CO2 excess over outdoor air decays exponentially at the
+outdoor air exchange rate (CO2 is not filtered, settled or deactivated):
+
+    ln(CO2 - outdoor_co2) = ln(initial excess) - air_exch_rate * t
+
+Logs are read in chunks and never held in memory at once. Readings are split into occupied periods (CO2 rising) and
+decay periods (CO2 falling from a clear excess), and each room's decay periods are fitted together by least squares,
+with a common slope and a separate intercept per period. Only the sufficient statistics of each room are kept, so a
+year of one-minute readings for a thousand rooms needs memory for a chunk and a few numbers per room.
+
+Properties:
+Log Format
+Detection Defaults
+
+Methods:
+class DecayFitter: Accumulates decay fits per room from readings added in chunks.
+def read_co2_log: Read a CO2 log in chunks and fit every room's air exchange rate.
+def apply_fitted_ach: Set fitted air exchange rates in a batch model.
+"""
+
+# Log Format
+# Long format CSV with one reading per row. Timestamps may be datetimes (with or without a UTC offset) or numbers
+# (seconds since the epoch). Readings of each room must be in chronological order across the log, but rooms may be
+# interleaved.
+default_columns = {'room': 'room', 'time': 'timestamp', 'co2': 'co2'}
+default_chunk_size = 1000000  # rows
+
+# Detection Defaults
+default_outdoor_co2 = 420  # ppm
+default_min_excess = 100  # ppm over outdoor air, for both ends of every decay step
+default_noise = 3  # ppm, changes this small still count as decaying
+default_max_gap = 10 / 60  # hours between readings before a period is broken
+default_min_decay_time = 0.25  # hours
+default_min_decay_points = 10
+default_min_log_drop = 0.2  # fitted fall of ln(excess) over a period, to reject plateaus
+default_min_r_squared = 0.9  # of each period's own fit, to reject plateaus running into decays
+
+
+class DecayFitter:
+    # Fit settings (see Detection Defaults). outdoor_co2 may also be a dictionary of room to outdoor CO2 (ppm).
+    def __init__(self, outdoor_co2=default_outdoor_co2, min_excess=default_min_excess, noise=default_noise,
+                 max_gap=default_max_gap, min_decay_time=default_min_decay_time,
+                 min_decay_points=default_min_decay_points, min_log_drop=default_min_log_drop,
+                 min_r_squared=default_min_r_squared):
+        self.outdoor_co2 = outdoor_co2
+        self.min_excess = min_excess
+        self.noise = noise
+        self.max_gap = max_gap
+        self.min_decay_time = min_decay_time
+        self.min_decay_points = min_decay_points
+        self.min_log_drop = min_log_drop
+        self.min_r_squared = min_r_squared
+
+        self.room_index = {}
+        self.room_labels = []
+        self.room_outdoor_co2 = numpy.zeros(0)
+        self.sums = numpy.zeros((0, 7))  # per room: Sxx, Sxy, Syy, decays, decay hours, occupied hours, readings
+
+        # Readings held back from the last chunk: the open decay period (or last readings) of each room
+        self.carry_rooms = numpy.zeros(0, dtype=int)
+        self.carry_times = numpy.zeros(0)
+        self.carry_co2 = numpy.zeros(0)
+
+    # Returns the index of each room label, registering new rooms
+    def get_room_ids(self, rooms):
+        codes, labels = pd.factorize(rooms)
+        label_ids = numpy.empty(len(labels), dtype=int)
+        for index, label in enumerate(labels):
+            if label not in self.room_index:
+                self.room_index[label] = len(self.room_labels)
+                self.room_labels.append(label)
+            label_ids[index] = self.room_index[label]
+
+        n_rooms = len(self.room_labels)
+        if n_rooms > len(self.sums):
+            self.sums = numpy.concatenate((self.sums, numpy.zeros((n_rooms - len(self.sums), 7))))
+            new_labels = self.room_labels[len(self.room_outdoor_co2):]
+            if isinstance(self.outdoor_co2, dict):
+                new_outdoor = [self.outdoor_co2.get(label, default_outdoor_co2) for label in new_labels]
+            else:
+                new_outdoor = [self.outdoor_co2] * len(new_labels)
+            self.room_outdoor_co2 = numpy.concatenate((self.room_outdoor_co2, new_outdoor))
+        return label_ids[codes]
+
+    # Add a chunk of readings: room labels, times (hours, any origin) and CO2 (ppm)
+    def add_readings(self, rooms, times, co2):
+        room_ids = self.get_room_ids(numpy.asarray(rooms))
+        self.sums[:, 6] += numpy.bincount(room_ids, minlength=len(self.sums))
+        new = numpy.concatenate((numpy.zeros(len(self.carry_rooms), dtype=bool), numpy.ones(len(room_ids), dtype=bool)))
+        self.process(numpy.concatenate((self.carry_rooms, room_ids)),
+                     numpy.concatenate((self.carry_times, numpy.asarray(times, dtype=float))),
+                     numpy.concatenate((self.carry_co2, numpy.asarray(co2, dtype=float))), new, final=False)
+
+    # Close every open decay period (call once the log has been read)
+    def finish(self):
+        self.process(self.carry_rooms, self.carry_times, self.carry_co2, numpy.zeros(len(self.carry_rooms), dtype=bool),
+                     final=True)
+
+    # Detect periods in a batch of readings (new: readings not carried from the last batch) and accumulate the fits
+    # of every finished decay period
+    def process(self, room_ids, times, co2, new, final):
+        order = numpy.lexsort((times, room_ids))
+        room_ids = room_ids[order]
+        times = times[order]
+        co2 = co2[order]
+        new = new[order]
+        if len(room_ids) == 0:
+            return
+        n_rooms = len(self.sums)
+        excess = co2 - self.room_outdoor_co2[room_ids]
+
+        # Steps between consecutive readings of the same room
+        step_dt = numpy.diff(times)
+        step_dc = numpy.diff(co2)
+        contiguous = (room_ids[1:] == room_ids[:-1]) & (step_dt > 0) & (step_dt <= self.max_gap)
+        # A decaying reading is within the noise of the last one and below the one before (flat stretches rarely
+        # stay below their second-last reading for long)
+        below_second_last = numpy.concatenate(([False], contiguous[:-1] & (co2[2:] < co2[:-2])))
+        decaying = contiguous & (step_dc <= self.noise) & below_second_last & (excess[:-1] >= self.min_excess) & \
+            (excess[1:] >= self.min_excess)
+        rising = contiguous & (step_dc > self.noise) & new[1:]
+        self.sums[:, 5] += numpy.bincount(room_ids[1:][rising], weights=step_dt[rising], minlength=n_rooms)
+
+        # Decay periods: runs of decaying steps, each with its first reading and every step's second reading
+        prev_decaying = numpy.concatenate(([False], decaying[:-1]))
+        next_decaying = numpy.concatenate((decaying[1:], [False]))
+        start_steps = numpy.nonzero(decaying & ~prev_decaying)[0]
+        end_steps = numpy.nonzero(decaying & ~next_decaying)[0]
+        step_run = numpy.cumsum(decaying & ~prev_decaying) - 1
+        decay_steps = numpy.nonzero(decaying)[0]
+        points = numpy.concatenate((start_steps, decay_steps + 1))
+        point_runs = numpy.concatenate((numpy.arange(len(start_steps)), step_run[decay_steps]))
+        n_runs = len(start_steps)
+
+        # Least squares sums of each period, with time measured from the period start
+        t = times[points] - times[start_steps][point_runs]
+        y = numpy.log(excess[points])
+        count = numpy.bincount(point_runs, minlength=n_runs)
+        sum_t = numpy.bincount(point_runs, weights=t, minlength=n_runs)
+        sum_y = numpy.bincount(point_runs, weights=y, minlength=n_runs)
+        sum_tt = numpy.bincount(point_runs, weights=t * t, minlength=n_runs)
+        sum_ty = numpy.bincount(point_runs, weights=t * y, minlength=n_runs)
+        sum_yy = numpy.bincount(point_runs, weights=y * y, minlength=n_runs)
+        duration = times[end_steps + 1] - times[start_steps]
+        run_rooms = room_ids[start_steps]
+
+        # A period still running at a room's last reading may continue in the next chunk
+        last_points = numpy.nonzero(numpy.concatenate((room_ids[1:] != room_ids[:-1], [True])))[0]
+        open_runs = numpy.zeros(n_runs, dtype=bool)
+        if not final:
+            open_runs = numpy.isin(end_steps + 1, last_points)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            sxx = sum_tt - sum_t * sum_t / count
+            sxy = sum_ty - sum_t * sum_y / count
+            syy = sum_yy - sum_y * sum_y / count
+            # Noise within the tolerance lets flat stretches through, so each period must also fall clearly and fit
+            # a single exponential well
+            log_drop = -sxy / sxx * duration
+            r_squared = sxy * sxy / (sxx * syy)
+        done = ~open_runs & (duration >= self.min_decay_time) & (count >= self.min_decay_points) & \
+            (log_drop >= self.min_log_drop) & (r_squared >= self.min_r_squared)
+        for column, values in enumerate([sxx, sxy, syy, numpy.ones(n_runs), duration]):
+            self.sums[:, column] += numpy.bincount(run_rooms[done], weights=values[done], minlength=n_rooms)
+
+        # Carry each room's open period (or only its last reading) into the next chunk, with the reading before it
+        if final:
+            carry = numpy.zeros(0, dtype=int)
+        else:
+            carry_starts = last_points.copy()
+            open_starts = start_steps[open_runs]
+            carry_starts[numpy.searchsorted(last_points, open_starts)] = open_starts
+            has_previous = carry_starts > 0
+            has_previous[has_previous] = room_ids[carry_starts[has_previous] - 1] == room_ids[carry_starts[has_previous]]
+            carry_starts -= has_previous
+            counts = last_points - carry_starts + 1
+            carry = numpy.repeat(carry_starts - numpy.cumsum(numpy.concatenate(([0], counts[:-1]))), counts) + \
+                numpy.arange(counts.sum())
+        self.carry_rooms = room_ids[carry]
+        self.carry_times = times[carry]
+        self.carry_co2 = co2[carry]
+
+    # Get the fitted air exchange rate (/hr) of every room, with the fit quality and period statistics
+    def get_results(self):
+        sxx, sxy, syy, n_decays, decay_hours, occupied_hours, n_readings = self.sums.T
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            air_exch_rate = numpy.where(n_decays > 0, -sxy / sxx, numpy.nan)
+            r_squared = numpy.where(n_decays > 0, (sxy * sxy / sxx) / syy, numpy.nan)
+        return pd.DataFrame({
+            'room': self.room_labels,
+            'air_exch_rate': air_exch_rate,
+            'r_squared': r_squared,
+            'n_decays': n_decays.astype(int),
+            'decay_hours': decay_hours,
+            'occupied_hours': occupied_hours,
+            'n_readings': n_readings.astype(int),
+        })
+
+
+# Read a CO2 log (path or file object, see Log Format) in chunks and fit every room's air exchange rate.
+# columns: names of the room, time and CO2 columns; fit_settings: keyword arguments for DecayFitter
+# Returns a DataFrame with one row per room (see DecayFitter.get_results).
+def read_co2_log(source, columns=None, chunk_size=default_chunk_size, **fit_settings):
+    columns = dict(default_columns, **(columns or {}))
+    fitter = DecayFitter(**fit_settings)
+    for chunk in pd.read_csv(source, usecols=list(columns.values()), chunksize=chunk_size):
+        time_values = chunk[columns['time']]
+        if pd.api.types.is_numeric_dtype(time_values):
+            times = time_values.to_numpy(dtype=float) / 3600  # hours
+        else:
+            # Timestamps with a UTC offset are converted to UTC; those without one are taken as UTC
+            times = pd.to_datetime(time_values, utc=True, infer_datetime_format=True).dt.tz_convert(None)
+            times = times.to_numpy().astype('int64') / 3.6e12
+        fitter.add_readings(chunk[columns['room']].to_numpy(), times, chunk[columns['co2']].to_numpy())
+    fitter.finish()
+    return fitter.get_results()
+
+
+# Returns a copy of a batch model (one entry per room, in the order of fitted_ach) with each room's outdoor air
+# exchange rate replaced by its fitted value, keeping its recirculation rate (/hr). Rooms without a fit (nan) keep
+# their current rate.
+def apply_fitted_ach(indoor_model, fitted_ach):
+    air_exch_rate = indoor_model.physical_params[2]
+    recirc_ach = air_exch_rate * (1 / indoor_model.physical_params[3] - 1)
+    new_air_exch_rate = numpy.where(numpy.isnan(fitted_ach), air_exch_rate, fitted_ach)
+    return indoor_model.copy_with_params(air_exch_rate=new_air_exch_rate,
+                                         primary_outdoor_air_fraction=new_air_exch_rate / (new_air_exch_rate +
+                                                                                            recirc_ach))
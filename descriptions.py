@@ -193,6 +193,108 @@ graph_ytitle = "Maximum Occupancy N"
 transient_text = "Transient"
 steady_state_text = "Steady-State"
 
+ach_merv_header = "Ventilation vs. Filtration"
+ach_merv_desc = '''Maximum exposure time in the current room as the ventilation rate (outdoor ACH) and the
+filtration system (MERV) vary. The recirculation rate is held at its current value, and the number of occupants is
+taken from the "If an infected person enters..." output panel. The marker shows the current settings.'''
+ach_merv_title = "Maximum Exposure Time for {n_val} People"
+ach_merv_xtitle = "Ventilation (outdoor ACH, /hr)"
+ach_merv_ytitle = "Filtration System (MERV)"
+ach_merv_colorbar = "Hours"
+ach_merv_current = "Current Settings"
+
+mc_header = "Uncertainty (Monte Carlo): "
+mc_desc = html.Div('''Several inputs, such as the infectiousness of exhaled air and the breathing rate, are highly 
+uncertain. When enabled, the model is evaluated for many samples of these inputs and the graph shows percentile bands 
+around the transient curve. Samples are drawn around the current input values using the spreads below.''')
+mc_enable_options = [{'label': " Show uncertainty bands on the graph", 'value': 'on'}]
+mc_cq_gsd_text = html.Span(["Infectiousness of exhaled air C", html.Sub('q'), ", geometric standard deviation: "])
+mc_qb_gsd_text = html.Span(["Breathing flow rate Q", html.Sub('b'), ", geometric standard deviation: "])
+mc_mask_fit_text = "Mask fit/compliance, \u00B1 range: "
+mc_deact_text = html.Span(["Maximum viral deactivation rate \u03BB", html.Sub('vmax'), ", range (/hr): "])
+mc_samples_text = "Number of samples: "
+mc_band_outer = "5th-95th Percentile"
+mc_band_inner = "25th-75th Percentile"
+mc_median_text = "Median"
+
+sa_header = "Sensitivity"
+sa_desc = html.Div('''Which lever matters most in this room? Ventilation, filtration, masks, humidity and occupancy are 
+varied together over wide ranges around the current settings, and each bar shows the share of the variation in the 
+(logarithm of the) maximum exposure time explained by that lever: on its own (first-order index), or including its 
+interactions with the other levers (total index).''')
+sa_run_text = "Run Sensitivity Analysis"
+sa_graph_title = "Global Sensitivity (Sobol Indices)"
+sa_graph_ytitle = "Share of Variance"
+sa_first_order_text = "First-Order"
+sa_total_text = "Total"
+sa_factor_labels = {
+    'ventilation': "Ventilation",
+    'filtration': "Filtration",
+    'masks': "Masks",
+    'humidity': "Humidity",
+    'occupancy': "Occupancy",
+}
+
+inv_header = "Required Mitigation"
+inv_desc = html.Div('''How much mitigation does this room need? Choose an occupancy, an exposure time and a risk type, 
+and the calculator finds the least amount of the chosen lever needed to meet the guideline, with every other setting 
+held at its current value.''')
+inv_lever_text = "Lever: "
+inv_lever_options = [
+    {'label': "Outdoor air exchange rate (ACH)", 'value': 'air_exch_rate'},
+    {'label': "Filtration (MERV)", 'value': 'aerosol_filtration_eff'},
+    {'label': "Recirculation rate (ACH)", 'value': 'recirc_rate'},
+    {'label': "Masks", 'value': 'mask_passage_prob'},
+]
+inv_risk_text = "Risk type: "
+inv_risk_options = [
+    {'label': "Conditional (one infected person present)", 'value': 'conditional'},
+    {'label': "Prevalence (uses the prevalence tab's incidence rate)", 'value': 'prevalence'},
+    {'label': "Personal (uses the personal tab's incidence rate)", 'value': 'personal'},
+]
+inv_n_text = "Number of people: "
+inv_t_text = "Exposure time (hours): "
+inv_result_prefix = "To host {n_val} people for {t_val} hours, you need "
+inv_result_air_exch_rate = "an outdoor air exchange rate of at least {value:.2f} ACH."
+inv_result_aerosol_filtration_eff = "a filtration efficiency of at least {value:.0f}% (MERV {merv:.0f} or higher)."
+inv_result_recirc_rate = "a recirculation rate of at least {value:.2f} ACH through the filter."
+inv_result_mask_passage_prob = "masks that let through at most {value:.0f}% of exhaled aerosols."
+inv_result_none = "no additional mitigation: the current settings already meet the guideline."
+inv_result_infeasible = "more than this lever alone can provide. Try another lever, or fewer people."
+
+scen_header = "Saved Scenarios"
+scen_desc = html.Div('''Save the current settings as a named scenario to come back to it later. Saved scenarios
+reload with their results, and any two of them can be compared side by side.''')
+scen_name_text = "Scenario name: "
+scen_save_text = "Save"
+scen_saved = "Saved \"{name}\"."
+scen_no_name = "Enter a name to save this scenario."
+scen_select_text = "Saved scenario: "
+scen_load_text = "Load"
+scen_compare_text = "Compare with: "
+scen_option = "{name} ({room_type}, {created})"
+scen_same = "These scenarios have the same settings and results."
+scen_field_header = "Setting"
+scen_multi_text = "Compare several scenarios: "
+scen_risk_text = "Risk type: "
+scen_graph_title = "Maximum Occupancy by Scenario"
+scen_table_name = "Scenario"
+scen_table_n = "People"
+scen_table_max_time = "Maximum exposure time"
+scen_table_change = "Change"
+scen_table_t = "Hours"
+scen_table_n_max = "Maximum occupancy"
+scen_too_many = "Choose at most {n} scenarios to compare."
+
+live_header = "Live Monitoring"
+live_desc = html.Div('''Occupancy limits of every room, recalculated from its sensors (ventilation, humidity and 
+occupancy) as readings arrive. Rooms turn red when more people are present than the guideline allows.''')
+live_no_feed = "No sensor feed is configured. Set LIVE_FEED to a file or local socket to start live monitoring."
+live_occupancy = "{n:.0f} present"
+live_limit = "Limit for {t:g} hours: {n_max:.0f} people"
+live_max_time = "Present occupancy may stay {time}"
+live_empty = "Empty"
+
 main_airb_trans_only_disc = html.Div(["*The guideline restricts the probability of ",
                                       html.Span(html.A(href=links.link_docs,
                                                        children="airborne transmissions",
@@ -212,6 +314,8 @@ other_risk_modes_desc = html.Div('''Other risk scenarios are considered in Advan
 consider the prevalence of infection in the population, immunity acquired through vaccination or previous exposure, 
 and the risk to a specific individual.''')
 
+static_custom_inputs = "For other rooms and behaviors, enter your own values in the interactive calculator."
+
 main_airb_trans_only_desc_b = html.Div(["*The guideline restricts the probability of one ",
                                         html.Span(html.A(href=links.link_docs,
                                                          children="airborne transmission",
@@ -1,6 +1,10 @@
+import numpy
 import plotly.graph_objects as go
 import dash_html_components as html
 
+from indoors import Indoors
+import inverse
+
 import descriptions as desc
 import descriptions_cs as desc_cs
 import descriptions_da as desc_da
@@ -198,6 +202,28 @@ ventilation_default = room_preset_settings['classroom']['ventilation']
 filter_default = room_preset_settings['classroom']['filtration']
 recirc_default = room_preset_settings['classroom']['recirc-rate']
 
+# Room fields accepted in room dictionaries (see get_rooms_model; floor_area: ft2, ceiling_height: ft, rates: /hr),
+# with the keys of the room and human behavior presets they default to
+room_fields = {
+    'floor_area': 'floor-area',
+    'ceiling_height': 'ceiling-height',
+    'air_exchange_rate': 'ventilation',
+    'recirc_rate': 'recirc-rate',
+    'merv': 'filtration',
+    'relative_humidity': 'rh',
+    'breathing_flow_rate': 'exertion',
+    'infectiousness': 'expiratory',
+    'mask_eff': 'masks',
+    'mask_fit': 'mask-fit',
+}
+room_extra_fields = {
+    'risk_tolerance': 0.1,
+    'sr_age_factor': 0.68,
+    'sr_strain_factor': 1,
+    'prevalence': 0.001,
+    'percentage_sus': 1,
+}
+
 # Nmax values for main red text output
 model_output_n_vals = [2, 5, 10, 25, 100]
 model_output_n_vals_big = [25, 100, 250, 500, 1000]
@@ -205,6 +231,22 @@ model_output_n_vals_big = [25, 100, 250, 500, 1000]
 # Max time reported in the big red text output
 covid_recovery_time = 14  # Days
 
+# Exposure times shown on the occupancy vs. exposure time graph (see get_model_figure)
+graph_exp_times = numpy.arange(2, 100, 1.0)  # hours
+
+# Grid of ventilation (ACH) and filtration (MERV) values for the ACH x MERV graph in Advanced Mode
+ach_merv_grid_ach = numpy.arange(0.5, 30.5, 0.5)  # /hr
+ach_merv_grid_merv = numpy.arange(0, 21)  # 0 = no filter
+
+# Cache of ACH x MERV grids, keyed by scenario. Oldest entries are dropped first once the cache is full.
+ach_merv_cache = {}
+ach_merv_cache_size = 256
+
+# Localized texts of the pages (see get_lang_text_basic, get_lang_text_adv and get_header_and_footer_text), keyed by
+# page, descriptions file and whether the display is narrow. Built once per process, or before forking (see warmup.py).
+lang_text_cache = {}
+mobile_width = 1200  # pixels
+
 
 # Determines what error message we should use, if any
 def get_err_msg(floor_area, ceiling_height, air_exchange_rate, merv, recirc_rate, max_aerosol_radius,
@@ -298,12 +340,107 @@ def get_human_preset_dd_value(exertion, expiratory_activity, masks, mask_fit, un
     return preset_dd_value
 
 
+# Returns a new model for the given inputs, converting mask, filtration and recirculation inputs the same way as
+# Basic and Advanced Mode. floor_area: ft2, ceiling_height: ft, air_exchange_rate and recirc_rate: /hr
+def get_indoor_model(floor_area, ceiling_height, air_exchange_rate, recirc_rate, merv, relative_humidity,
+                     breathing_flow_rate, infectiousness, mask_eff, mask_fit, risk_tolerance=0.1, sr_age_factor=1,
+                     sr_strain_factor=1, def_aerosol_radius=2, max_viral_deact_rate=0.6, percentage_sus=1):
+    indoor_model = Indoors()
+    indoor_model.physical_params = [floor_area, ceiling_height, air_exchange_rate,
+                                    air_exchange_rate / (air_exchange_rate + recirc_rate),
+                                    get_merv_eff(merv, def_aerosol_radius), relative_humidity]
+    indoor_model.physio_params = [breathing_flow_rate, def_aerosol_radius]
+    indoor_model.disease_params = [infectiousness, max_viral_deact_rate]
+    indoor_model.prec_params = [1 - mask_eff * mask_fit, risk_tolerance]
+    indoor_model.sr_age_factor = sr_age_factor
+    indoor_model.sr_strain_factor = sr_strain_factor
+    indoor_model.percentage_sus = percentage_sus
+    indoor_model.calc_vars()
+    return indoor_model
+
+
+# Returns the aerosol filtration efficiency of the given MERV rating, or of each rating if merv is an array (one entry
+# per room)
+def get_merv_eff(merv, def_aerosol_radius):
+    if numpy.ndim(merv) == 0:
+        return Indoors.merv_to_eff(merv, def_aerosol_radius)
+    return Indoors.merv_to_eff_array(merv, def_aerosol_radius)
+
+
+# Returns a new model for the given room and human behavior presets (see room_preset_settings and
+# human_preset_settings), with the remaining inputs at their Basic Mode values.
+def get_preset_model(room_preset, human_preset, sr_age_factor=0.68, sr_strain_factor=1):
+    room = room_preset_settings[room_preset]
+    human = human_preset_settings[human_preset]
+    return get_indoor_model(room['floor-area'], room['ceiling-height'], room['ventilation'], room['recirc-rate'],
+                            room['filtration'], room['rh'], human['exertion'], human['expiratory'], human['masks'],
+                            human['mask-fit'], sr_age_factor=sr_age_factor, sr_strain_factor=sr_strain_factor)
+
+
+# Returns one batch model (see Indoors.copy_with_params) for a list of room dictionaries, together with a dictionary of
+# per-room arrays of every field, including occupancy (n) and exposure time (t). Each room may name its room and human
+# behavior presets ('room', 'human'), and any field of room_fields or room_extra_fields overrides the preset value.
+# Fields named in extra_defaults are also collected, with the given defaults, and every room must give the fields in
+# target_fields.
+def get_rooms_model(rooms, extra_defaults=None, target_fields=('n', 't')):
+    if extra_defaults is None:
+        extra_defaults = {}
+    extra_defaults = dict(room_extra_fields, **extra_defaults)
+    columns = {name: [] for name in list(room_fields) + list(extra_defaults) + list(target_fields)}
+    for room in rooms:
+        room_preset = room_preset_settings[room.get('room', 'classroom')]
+        human_preset = human_preset_settings[room.get('human', 'masks-2')]
+        for name, preset_key in room_fields.items():
+            preset = room_preset if preset_key in room_preset else human_preset
+            columns[name].append(float(room.get(name, preset[preset_key])))
+        for name, default in extra_defaults.items():
+            columns[name].append(float(room.get(name, default)))
+        for name in target_fields:
+            columns[name].append(float(room[name]))
+    columns = {name: numpy.array(values) for name, values in columns.items()}
+    return get_columns_model(columns), columns
+
+
+# Returns one batch model for a dictionary of per-room arrays of every field of room_fields and room_extra_fields
+def get_columns_model(columns):
+    rooms_model = get_indoor_model(columns['floor_area'], columns['ceiling_height'], columns['air_exchange_rate'],
+                                   columns['recirc_rate'], columns['merv'], columns['relative_humidity'],
+                                   columns['breathing_flow_rate'], columns['infectiousness'], columns['mask_eff'],
+                                   columns['mask_fit'], columns['risk_tolerance'], columns['sr_age_factor'],
+                                   columns['sr_strain_factor'], percentage_sus=columns['percentage_sus'])
+    rooms_model.prevalence = columns['prevalence']
+    return rooms_model
+
+
 # Returns the plotly figure based on the supplied indoor model.
-def get_model_figure(indoor_model, language):
+# percentile_bands: Optional Monte Carlo output (see uncertainty.py def run_monte_carlo) with the 5th, 25th, 50th,
+#                   75th and 95th percentiles of occupancy, drawn as bands around the transient curve.
+def get_model_figure(indoor_model, language, percentile_bands=None):
     desc_file = get_desc_file(language)
     new_df = indoor_model.calc_n_max_series(2, 100, 1.0)
 
     new_fig = go.Figure()
+    if percentile_bands is not None:
+        band_names = [get_desc_text(language, 'mc_band_outer'), get_desc_text(language, 'mc_band_inner')]
+        for [low, high], band_name, band_color in zip([[5, 95], [25, 75]], band_names,
+                                                      ["rgba(138, 212, 237, 0.25)", "rgba(138, 212, 237, 0.5)"]):
+            new_fig.add_trace(go.Scatter(x=graph_exp_times, y=percentile_bands[low],
+                                         mode='lines',
+                                         line=dict(width=0),
+                                         legendgroup=band_name,
+                                         showlegend=False,
+                                         hoverinfo='skip'))
+            new_fig.add_trace(go.Scatter(x=graph_exp_times, y=percentile_bands[high],
+                                         mode='lines',
+                                         name=band_name,
+                                         line=dict(width=0),
+                                         legendgroup=band_name,
+                                         fill='tonexty',
+                                         fillcolor=band_color))
+        new_fig.add_trace(go.Scatter(x=graph_exp_times, y=percentile_bands[50],
+                                     mode='lines',
+                                     name=get_desc_text(language, 'mc_median_text'),
+                                     line=go.scatter.Line(color="#8ad4ed", dash='dash')))
     new_fig.add_trace(go.Scatter(x=new_df["exposure_time"], y=new_df["occupancy_trans"],
                                  mode='lines',
                                  name=desc_file.transient_text,
@@ -325,6 +462,140 @@ def get_model_figure(indoor_model, language):
     return new_fig
 
 
+# Returns the maximum exposure time (hours) over the ACH x MERV grid for the given model, cached per scenario.
+def get_ach_merv_grid(indoor_model, n_max, risk_type):
+    key = (indoor_model.get_scenario_key(), n_max, risk_type)
+    grid = ach_merv_cache.get(key)
+    if grid is None:
+        grid = indoor_model.calc_max_time_grid(ach_merv_grid_ach, ach_merv_grid_merv, n_max, risk_type)
+        if len(ach_merv_cache) >= ach_merv_cache_size:
+            ach_merv_cache.pop(next(iter(ach_merv_cache)))
+        ach_merv_cache[key] = grid
+
+    return grid
+
+
+# Returns the plotly figure of maximum exposure time over the ACH x MERV grid, marking the current settings.
+# recovery_time: Time to recovery in days
+# If recovery time is -1, will not limit the output.
+def get_ach_merv_figure(indoor_model, merv, n_max, risk_type, recovery_time, language):
+    grid = get_ach_merv_grid(indoor_model, n_max, risk_type)
+    if recovery_time != -1:
+        grid = numpy.minimum(grid, recovery_time * 24)
+
+    # Color by order of magnitude, since exposure times span minutes to months
+    tick_vals = numpy.array([0.1, 0.5, 1, 2, 4, 8, 24, 72, 168, 336, 730, 8760])
+    tick_vals = tick_vals[(tick_vals >= grid.min()) & (tick_vals <= grid.max())]
+
+    new_fig = go.Figure()
+    new_fig.add_trace(go.Contour(x=ach_merv_grid_ach, y=ach_merv_grid_merv, z=numpy.log10(grid),
+                                 customdata=grid,
+                                 hovertemplate='ACH: %{x:.1f}<br>MERV: %{y}<br>%{customdata:,.1f} h<extra></extra>',
+                                 contours_coloring='heatmap',
+                                 colorscale='RdYlGn',
+                                 colorbar=dict(title=get_desc_text(language, 'ach_merv_colorbar'),
+                                               tickvals=numpy.log10(tick_vals),
+                                               ticktext=['{:g}'.format(val) for val in tick_vals])))
+    new_fig.add_trace(go.Scatter(x=[indoor_model.physical_params[2]], y=[merv],
+                                 mode='markers',
+                                 name=get_desc_text(language, 'ach_merv_current'),
+                                 marker=dict(color="#000000", size=10, symbol='x')))
+    new_fig.update_layout(title=get_desc_text(language, 'ach_merv_title').format(n_val=n_max), height=400,
+                          xaxis_title=get_desc_text(language, 'ach_merv_xtitle'),
+                          yaxis_title=get_desc_text(language, 'ach_merv_ytitle'),
+                          font_family="Barlow",
+                          template="simple_white",
+                          showlegend=False,
+                          hoverlabel=dict(
+                              font_family="Barlow"
+                          ))
+    return new_fig
+
+
+# Returns the bar chart of first-order and total Sobol indices (see sensitivity.py def calc_sobol_indices).
+def get_sensitivity_figure(sobol_indices, language):
+    factor_labels = get_desc_text(language, 'sa_factor_labels')
+    factor_names = [factor_labels[name] for name in sobol_indices['factors']]
+
+    new_fig = go.Figure()
+    new_fig.add_trace(go.Bar(x=factor_names, y=sobol_indices['first_order'],
+                             name=get_desc_text(language, 'sa_first_order_text'),
+                             marker_color="#8ad4ed"))
+    new_fig.add_trace(go.Bar(x=factor_names, y=sobol_indices['total'],
+                             name=get_desc_text(language, 'sa_total_text'),
+                             marker_color="#2490b5"))
+    new_fig.update_layout(barmode='group',
+                          title=get_desc_text(language, 'sa_graph_title'), height=400,
+                          yaxis_title=get_desc_text(language, 'sa_graph_ytitle'),
+                          yaxis_range=[0, 1],
+                          font_family="Barlow",
+                          template="simple_white",
+                          hoverlabel=dict(
+                              font_family="Barlow"
+                          ))
+    return new_fig
+
+
+# Returns the plotly figure overlaying the maximum occupancy curves of several scenarios (see
+# scenarios.py ScenarioStore.compare_scenarios).
+def get_comparison_figure(comparison, language):
+    new_fig = go.Figure()
+    for name, curve in zip(comparison['scenarios']['name'], comparison['curves']):
+        new_fig.add_trace(go.Scatter(x=comparison['exp_times'], y=curve,
+                                     mode='lines',
+                                     name=name))
+    new_fig.update_layout(title=get_desc_text(language, 'scen_graph_title'), height=400,
+                          xaxis_title=get_desc_text(language, 'graph_xtitle'),
+                          yaxis_title=get_desc_text(language, 'graph_ytitle'),
+                          yaxis_type='log',
+                          font_family="Barlow",
+                          template="simple_white",
+                          hoverlabel=dict(
+                              font_family="Barlow"
+                          ))
+    return new_fig
+
+
+# Returns the table of maximum exposure times and occupancies of several scenarios, with their change from the first
+# (see scenarios.py ScenarioStore.compare_scenarios).
+def get_comparison_table(comparison, risk_type, language):
+    recovery_time = covid_recovery_time if risk_type == 'conditional' else -1
+    header = html.Tr([html.Th(get_desc_text(language, name)) for name in
+                      ['scen_table_name', 'scen_table_n', 'scen_table_max_time', 'scen_table_change', 'scen_table_t',
+                       'scen_table_n_max', 'scen_table_change']])
+    rows = []
+    for index, scenario in comparison['scenarios'].iterrows():
+        changes = ['' if index == 0 or not numpy.isfinite(change) else '{:+.0%}'.format(change)
+                   for change in [scenario['max_time_change'], scenario['n_max_change']]]
+        rows.append(html.Tr([html.Td(scenario['name']),
+                             html.Td('{:g}'.format(scenario['n'])),
+                             html.Td(time_to_text(scenario['max_time'], True, recovery_time, language)),
+                             html.Td(changes[0]),
+                             html.Td('{:g}'.format(scenario['t'])),
+                             html.Td('{:.0f}'.format(scenario['n_max'])),
+                             html.Td(changes[1])]))
+    return html.Table([header] + rows)
+
+
+# Returns the text describing the least mitigation of the given lever needed so that n_max people may stay exp_time
+# hours (see inverse.py def solve_lever).
+def get_inverse_text(indoor_model, lever, n_max, exp_time, risk_type, language):
+    solution = inverse.solve_lever(indoor_model, lever, n_max, exp_time, risk_type)
+    value = float(solution['value'])
+    text = get_desc_text(language, 'inv_result_prefix').format(n_val=n_max, t_val=exp_time)
+    if not solution['feasible']:
+        return text + get_desc_text(language, 'inv_result_infeasible')
+    if (lever == 'mask_passage_prob' and value >= 1) or (lever != 'mask_passage_prob' and value <= 0):
+        return text + get_desc_text(language, 'inv_result_none')
+
+    result_text = get_desc_text(language, 'inv_result_' + lever)
+    if lever == 'aerosol_filtration_eff':
+        return text + result_text.format(value=value * 100, merv=float(solution['merv']))
+    if lever == 'mask_passage_prob':
+        return text + result_text.format(value=value * 100)
+    return text + result_text.format(value=value)
+
+
 # Returns the big red output text.
 # recovery_time: Time to recovery in days
 # If recovery time is -1, will not limit the output.
@@ -553,13 +824,22 @@ def search_to_params(search):
     return output_dict
 
 
-# Returns text for updating language from the given descriptions file.
+# Returns text for updating language from the given descriptions file, built once per descriptions file and display
+# size (see build_lang_text_basic)
 def get_lang_text_basic(language, disp_width):
+    key = ('basic', get_desc_file(language).__name__, disp_width < mobile_width)
+    if key not in lang_text_cache:
+        lang_text_cache[key] = build_lang_text_basic(language, disp_width)
+    return lang_text_cache[key]
+
+
+# Builds text for updating language from the given descriptions file.
+def build_lang_text_basic(language, disp_width):
     desc_file = get_desc_file(language)
 
     humidity_marks = desc_file.humidity_marks
     risk_tol_marks = desc_file.risk_tol_marks
-    if disp_width < 1200:
+    if disp_width < mobile_width:
         # use our mobile marks
         humidity_marks = {
             0.01: desc_file.humidity_marks[0.01],
@@ -642,14 +922,23 @@ def get_lang_text_basic(language, disp_width):
             desc_file.t_input_text_3]
 
 
-# Returns text for updating language from the given descriptions file.
+# Returns text for updating language from the given descriptions file, built once per descriptions file and display
+# size (see build_lang_text_adv)
 def get_lang_text_adv(language, disp_width):
+    key = ('adv', get_desc_file(language).__name__, disp_width < mobile_width)
+    if key not in lang_text_cache:
+        lang_text_cache[key] = build_lang_text_adv(language, disp_width)
+    return lang_text_cache[key]
+
+
+# Builds text for updating language from the given descriptions file.
+def build_lang_text_adv(language, disp_width):
     desc_file = get_desc_file(language)
 
     humidity_marks = desc_file.humidity_marks
     risk_tol_marks = desc_file.risk_tol_marks
     mask_type_marks = desc_file.mask_type_marks
-    if disp_width < 1200:
+    if disp_width < mobile_width:
         # use our mobile marks
         humidity_marks = {
             0.01: desc_file.humidity_marks[0.01],
@@ -762,11 +1051,43 @@ def get_lang_text_adv(language, disp_width):
             desc_file.main_panel_s2_c,
             desc_file.main_airb_trans_only_disc,
             desc_file.incidence_rate_refs,
-            lang_break_age]
+            lang_break_age,
+            get_desc_text(language, 'ach_merv_header'),
+            get_desc_text(language, 'ach_merv_header'),
+            get_desc_text(language, 'ach_merv_desc'),
+            get_desc_text(language, 'mc_header'),
+            get_desc_text(language, 'mc_desc'),
+            get_desc_text(language, 'mc_enable_options'),
+            get_desc_text(language, 'mc_cq_gsd_text'),
+            get_desc_text(language, 'mc_qb_gsd_text'),
+            get_desc_text(language, 'mc_mask_fit_text'),
+            get_desc_text(language, 'mc_deact_text'),
+            get_desc_text(language, 'mc_samples_text'),
+            get_desc_text(language, 'sa_header'),
+            get_desc_text(language, 'sa_header'),
+            get_desc_text(language, 'sa_desc'),
+            get_desc_text(language, 'sa_run_text'),
+            get_desc_text(language, 'inv_header'),
+            get_desc_text(language, 'inv_header'),
+            get_desc_text(language, 'inv_desc'),
+            get_desc_text(language, 'inv_lever_text'),
+            get_desc_text(language, 'inv_lever_options'),
+            get_desc_text(language, 'inv_risk_text'),
+            get_desc_text(language, 'inv_risk_options'),
+            get_desc_text(language, 'inv_n_text'),
+            get_desc_text(language, 'inv_t_text')]
+
+
+# Get header and footer based on language, built once per descriptions file (see build_header_and_footer_text)
+def get_header_and_footer_text(language):
+    key = ('header', get_desc_file(language).__name__)
+    if key not in lang_text_cache:
+        lang_text_cache[key] = build_header_and_footer_text(language)
+    return lang_text_cache[key]
 
 
-# Get header and footer based on language
-def get_header_and_footer_text(language):
+# Builds header and footer based on language
+def build_header_and_footer_text(language):
     desc_file = get_desc_file(language)
     footer = html.Div([desc_file.footer,
                        html.Div(normal_credits),
@@ -814,6 +1135,15 @@ def get_desc_file(language):
     return desc_file
 
 
+# Returns the named text from the language's descriptions file, or the English text if it is not translated yet.
+def get_desc_text(language, name):
+    desc_file = get_desc_file(language)
+    if hasattr(desc_file, name):
+        return getattr(desc_file, name)
+    else:
+        return getattr(desc, name)
+
+
 # Converts floor area and ceiling height from one system to another system
 def convert_units(from_units, to_units, floor_area, ceiling_height):
     if from_units != to_units:
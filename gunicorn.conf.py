@@ -0,0 +1,41 @@
+import os
+
+"""
+gunicorn.conf.py configures gunicorn to serve the app (gunicorn reads it from the working directory, see Procfile).
+The app is imported once in the master (preload_app) and warmed up there before the workers are forked (see
+warmup.py), so workers share its memory copy-on-write and serve their first requests at full speed. Without a current
+preset table (built by bin/post_compile, see presets.py), Basic Mode calculates its presets on every request, and a
+warning is logged.
+
+Settings can be overridden on the command line, and the number of workers with the WEB_CONCURRENCY environment
+variable (set by Heroku). Workers listen on the PORT environment variable if it is set. With a live feed configured
+(LIVE_FEED, see live.py), a single worker runs whatever the settings: the live monitor and its feed belong to one
+process.
+
+Methods:
+def when_ready: Run a single worker with a live feed, and warm up the preloaded app before the first workers are forked.
+"""
+
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+timeout = 60  # seconds
+
+
+# Warm up the preloaded app in the master, once it is listening and before it forks the first workers. With a live feed,
+# only one worker is forked (see live.py).
+def when_ready(server):
+    if os.environ.get('LIVE_FEED') and server.num_workers > 1:
+        server.log.warning('LIVE_FEED is set: running 1 worker instead of %d, as the live monitor reads the feed in a '
+                           'single process', server.num_workers)
+        server.num_workers = 1
+    if not server.cfg.preload_app:
+        return  # each worker imports the app itself
+    import presets
+    import warmup
+    timings = warmup.warm_up()
+    warmup.freeze()
+    server.log.info('Warmed up in %.1f s (%s)', sum(timings.values()),
+                    ', '.join('{} {:.1f} s'.format(step, seconds) for step, seconds in timings.items()))
+    if presets.preset_table is None:
+        server.log.warning('No preset table built from the current code at %s: Basic Mode presets are calculated on '
+                           'every request (build it with python presets.py)', presets.get_preset_table_path())
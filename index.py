@@ -6,14 +6,18 @@ import dash._callback_context
 import flask
 
 from app import app
-from apps import default, advanced
+from apps import default, advanced, live
+import api
+import bundles
+import metrics
+import profiling
 
 import descriptions as desc
 import essentials as ess
 
 """
 index.py handles the general app functionality related to the HTML header, switching between modes (Basic Mode,
-Advanced Mode), Unit Systems, Languages, and running the app.
+Advanced Mode, and Live Monitoring at /apps/live), Unit Systems, Languages, and running the app.
 
 """
 
@@ -57,7 +61,7 @@ app.index_string = '''
         <title>COVID-19 Indoor Safety Guideline</title>
         <!-- Global site tag (gtag.js) - Google Analytics -->
         <script async src="https://www.googletagmanager.com/gtag/js?id=UA-143756813-2"></script>
-        {%favicon%}
+        <link rel="icon" type="image/x-icon" href="''' + bundles.get_url('favicon.ico') + '''">
         {%css%}
     </head>
     <body>
@@ -173,6 +177,9 @@ def update_header_and_footer(search):
 def display_page(pathname):
     if pathname == '/apps/advanced' or pathname == '/apps/advanced/':
         return [advanced.layout, 'advanced']
+    elif pathname == '/apps/live' or pathname == '/apps/live/':
+        # Live Monitoring is opened by its URL (for wall displays), not from the mode dropdown
+        return [live.layout, dash.no_update]
     else:
         return [default.layout, 'basic']
 
@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy
 import math
+import copy
 
 """
 Indoors is a class which represents the model calculation. A detailed description of
@@ -24,11 +25,23 @@ def calc_n_max: Calculate maximum people allowed in the room given an exposure t
 def calc_n_max_ss: Calculate maximum people allowed in the room given an exposure time (hours), using the steady-state
                    model.
 def calc_max_time: Calculate maximum exposure time allowed given a capacity (# people, transient)
+def calc_exp_trans: Calculate the expected number of airborne transmissions for a given occupancy and exposure time.
 def calc_n_max_series: Calculate maximum people allowed in the room across a range of exposure times
 def get_six_ft_n: Get the maximum number of people allowed in the room, based on the six-foot rule.
 def set_default_params: Sets default parameters.
 def merv_to_eff: Converts a MERV rating to an aerosol filtration efficiency. 
+def merv_to_eff_array: Converts an array of MERV ratings to aerosol filtration efficiencies (vectorized).
 def clamp: Clamps a value within a given range.
+def get_param: Get a model parameter by name.
+def copy_with_params: Copy the model, replacing named parameters (scalars or numpy arrays), and recalculate.
+def get_scenario_key: Get a hashable key describing every model parameter, for caching results.
+def get_room_params: Get the per-room parameters of a batch model as columns, to broadcast against a row of inputs.
+def calc_max_time_grid: Calculate maximum exposure time over a grid of air exchange rates and MERV ratings.
+def calc_rate_grads: Calculate analytic partial derivatives of the concentration relaxation and airborne transmission
+                     rates with respect to each input in grad_params.
+def calc_n_max_grad: Calculate analytic partial derivatives of calc_n_max with respect to each input in grad_params.
+def calc_max_time_grad: Calculate analytic partial derivatives of calc_max_time with respect to each input in
+                        grad_params.
 """
 
 
@@ -80,6 +93,34 @@ class Indoors:
         {'merv': 20, '0.3-1': 0.9999997, '1-3': 0.9999997, '3-10': 0.9999997},
     ]
 
+    # Same table as merv_dict as an array, indexed by [MERV, particle size bin]. Row 0 is "no filter".
+    merv_eff_table = numpy.array([[0, 0, 0]] + [[item['0.3-1'], item['1-3'], item['3-10']] for item in merv_dict])
+
+    # Location of each named model parameter: (attribute, index in the parameter list or None for plain attributes)
+    param_locations = {
+        'floor_area': ('physical_params', 0),
+        'mean_ceiling_height': ('physical_params', 1),
+        'air_exch_rate': ('physical_params', 2),
+        'primary_outdoor_air_fraction': ('physical_params', 3),
+        'aerosol_filtration_eff': ('physical_params', 4),
+        'relative_humidity': ('physical_params', 5),
+        'breathing_flow_rate': ('physio_params', 0),
+        'max_aerosol_radius': ('physio_params', 1),
+        'exhaled_air_inf': ('disease_params', 0),
+        'max_viral_deact_rate': ('disease_params', 1),
+        'mask_passage_prob': ('prec_params', 0),
+        'risk_tolerance': ('prec_params', 1),
+        'prevalence': ('prevalence', None),
+        'percentage_sus': ('percentage_sus', None),
+        'sr_age_factor': ('sr_age_factor', None),
+        'sr_strain_factor': ('sr_strain_factor', None),
+    }
+
+    # Inputs for which analytic partial derivatives are available (see calc_n_max_grad, calc_max_time_grad)
+    grad_params = ['floor_area', 'mean_ceiling_height', 'air_exch_rate', 'primary_outdoor_air_fraction',
+                   'aerosol_filtration_eff', 'relative_humidity', 'breathing_flow_rate', 'exhaled_air_inf',
+                   'max_viral_deact_rate', 'mask_passage_prob', 'risk_tolerance']
+
     def __init__(self):
         self.set_default_params()
         self.calc_vars()
@@ -150,6 +191,20 @@ class Indoors:
         n_max = 1 + risk_tolerance / (self.airb_trans_rate * exp_time)
         return n_max
 
+    # Calculate the expected number of airborne transmissions (transient) for n_max people over exp_time hours. This is
+    # the quantity the guideline limits to the risk tolerance, so calc_n_max(exp_time) people give exactly that value.
+    def calc_exp_trans(self, n_max, exp_time, risk_type='conditional'):
+        transient_factor = 1 / (1 + 1/(self.conc_relax_rate * exp_time))
+        if risk_type == 'conditional':
+            exp_trans = (n_max - 1) * self.percentage_sus * self.airb_trans_rate * exp_time * transient_factor
+        elif risk_type == 'prevalence':
+            exp_trans = n_max * n_max * self.prevalence * self.percentage_sus * self.airb_trans_rate * exp_time * transient_factor
+        elif risk_type == 'personal':
+            exp_trans = (n_max - 1) * self.prevalence * self.airb_trans_rate * exp_time * transient_factor
+        else:
+            exp_trans = 0
+        return exp_trans
+
     # Calculate maximum exposure time allowed given a capacity (# people), transient
     def calc_max_time(self, n_max, risk_type='conditional'):
         risk_tolerance = self.prec_params[1]  # no units
@@ -238,13 +293,189 @@ class Indoors:
 
         return eff
 
+    # Convert an array of MERV ratings to aerosol filtration efficiencies, matching merv_to_eff element-wise.
+    # merv: array of MERV ratings (0 = no filter), floored and clamped to 20
+    # aerosol_radius: must be <= 10, scalar or broadcastable against merv
+    @staticmethod
+    def merv_to_eff_array(merv, aerosol_radius):
+        merv = numpy.asarray(merv, dtype=float)
+        merv_ind = numpy.where(merv == 0, 0, numpy.floor(numpy.clip(merv, 1, 20))).astype(int)
+        size_ind = numpy.digitize(aerosol_radius, [1, 3])
+        return Indoors.merv_eff_table[merv_ind, size_ind]
+
     # Clamp value within range
     @staticmethod
     def clamp(n, smallest, largest):
         return max(smallest, min(n, largest))
 
+    # Get a model parameter by name (see param_locations)
+    def get_param(self, name):
+        attr, index = self.param_locations[name]
+        if index is None:
+            return getattr(self, attr)
+        return getattr(self, attr)[index]
+
+    # Returns a copy of this model with the given named parameters replaced, and all variables recalculated.
+    # Parameters may be numpy arrays; every calculation broadcasts, so the copy evaluates a whole batch at once.
+    def copy_with_params(self, **params):
+        new_model = copy.copy(self)
+        new_model.physical_params = list(self.physical_params)
+        new_model.physio_params = list(self.physio_params)
+        new_model.disease_params = list(self.disease_params)
+        new_model.prec_params = list(self.prec_params)
+        for name in params:
+            attr, index = self.param_locations[name]
+            if index is None:
+                setattr(new_model, attr, params[name])
+            else:
+                getattr(new_model, attr)[index] = params[name]
+
+        new_model.calc_vars()
+        return new_model
+
+    # Get the parameters of rooms[room_slice] from a batch model with one entry per room (see copy_with_params), as
+    # columns (shape [room, 1]). Passing them to copy_with_params gives a model whose outputs broadcast against a row
+    # of inputs (e.g. one entry per meeting or candidate upgrade) to [room, input]. Scalar parameters are omitted, as
+    # they are shared by every room.
+    def get_room_params(self, room_slice=slice(None)):
+        room_params = {}
+        for name in self.param_locations:
+            value = self.get_param(name)
+            if numpy.ndim(value) > 0:
+                room_params[name] = numpy.asarray(value)[room_slice, numpy.newaxis]
+        return room_params
+
+    # Get a hashable key of all model parameters, identifying the scenario this model represents.
+    def get_scenario_key(self):
+        return tuple(float(self.get_param(name)) for name in self.param_locations)
+
+    # Calculate maximum exposure time (hours) across a grid of air exchange rates (/hr) and MERV ratings, for a
+    # given number of occupants. The recirculation rate (/hr) is held fixed while the air exchange rate varies.
+    # Returns a 2D array indexed by [MERV, air exchange rate], computed in a single vectorized pass.
+    def calc_max_time_grid(self, air_exch_rates, mervs, n_max, risk_type='conditional'):
+        air_exch_rate = self.physical_params[2]
+        primary_outdoor_air_fraction = self.physical_params[3]
+        recirc_ach = air_exch_rate * (1 / primary_outdoor_air_fraction - 1)  # /hr
+
+        air_exch_grid = numpy.asarray(air_exch_rates, dtype=float)[numpy.newaxis, :]
+        filt_eff_grid = Indoors.merv_to_eff_array(mervs, self.physio_params[1])[:, numpy.newaxis]
+        grid_model = self.copy_with_params(air_exch_rate=air_exch_grid,
+                                           primary_outdoor_air_fraction=air_exch_grid / (air_exch_grid + recirc_ach),
+                                           aerosol_filtration_eff=filt_eff_grid)
+        return grid_model.calc_max_time(n_max, risk_type)
+
+    # Calculate analytic partial derivatives of conc_relax_rate and airb_trans_rate with respect to each input in
+    # grad_params, using the current calculated variables (calc_vars must have been called).
+    # Returns two dictionaries of input name to derivative; inputs may be numpy arrays.
+    def calc_rate_grads(self):
+        floor_area = self.physical_params[0]  # ft2
+        mean_ceiling_height = self.physical_params[1]  # ft
+        air_exch_rate = self.physical_params[2]  # /hr
+        primary_outdoor_air_fraction = self.physical_params[3]  # no units
+        aerosol_filtration_eff = self.physical_params[4]  # no units
+        relative_humidity = self.physical_params[5]  # no units
+        breathing_flow_rate = self.physio_params[0]  # m3 / hr
+        exhaled_air_inf = self.disease_params[0]  # infection quanta/m3, before relative susceptibility
+        max_viral_deact_rate = self.disease_params[1]  # /hr
+        mask_passage_prob = self.prec_params[0]  # no units
+        mean_ceiling_height_m = mean_ceiling_height * 0.3048
+        sett_rate = self.sett_speed / mean_ceiling_height_m  # /hr
+
+        # conc_relax_rate = air_exch_rate * (1 + aerosol_filtration_eff * (1/primary_outdoor_air_fraction - 1)) +
+        #                   max_viral_deact_rate * relative_humidity + sett_speed / mean_ceiling_height_m,
+        # where sett_speed scales as (1 - relative_humidity) ** (-2/3)
+        zero = 0 * self.conc_relax_rate
+        relax_grads = {
+            'floor_area': zero,
+            'mean_ceiling_height': -sett_rate / mean_ceiling_height + zero,
+            'air_exch_rate': 1 + aerosol_filtration_eff * (1 / primary_outdoor_air_fraction - 1) + zero,
+            'primary_outdoor_air_fraction': -aerosol_filtration_eff * air_exch_rate / primary_outdoor_air_fraction ** 2
+                                            + zero,
+            'aerosol_filtration_eff': air_exch_rate * (1 / primary_outdoor_air_fraction - 1) + zero,
+            'relative_humidity': max_viral_deact_rate + sett_rate * 2 / (3 * (1 - relative_humidity)) + zero,
+            'breathing_flow_rate': zero,
+            'exhaled_air_inf': zero,
+            'max_viral_deact_rate': relative_humidity + zero,
+            'mask_passage_prob': zero,
+            'risk_tolerance': zero,
+        }
+
+        # airb_trans_rate = (breathing_flow_rate * mask_passage_prob) ** 2 * exhaled_air_inf * relative_sus /
+        #                   (room_vol_m * conc_relax_rate)
+        log_grads = {
+            'floor_area': -1 / floor_area,
+            'mean_ceiling_height': -1 / mean_ceiling_height,
+            'breathing_flow_rate': 2 / breathing_flow_rate,
+            'exhaled_air_inf': 1 / exhaled_air_inf,
+            'mask_passage_prob': 2 / mask_passage_prob,
+        }
+        trans_grads = {}
+        for name in self.grad_params:
+            trans_grads[name] = self.airb_trans_rate * (log_grads.get(name, 0) -
+                                                        relax_grads[name] / self.conc_relax_rate)
+
+        return relax_grads, trans_grads
+
+    # Calculate analytic partial derivatives of calc_n_max (transient model) with respect to each input in
+    # grad_params. All inputs may be numpy arrays, so a whole batch of rooms is differentiated at once.
+    # Returns a dictionary of input name to derivative.
+    def calc_n_max_grad(self, exp_time, risk_type='conditional'):
+        risk_tolerance = self.prec_params[1]  # no units
+        relax_grads, trans_grads = self.calc_rate_grads()
+        if risk_type == 'conditional':
+            risk_factor = self.percentage_sus
+        elif risk_type == 'prevalence':
+            risk_factor = self.prevalence * self.percentage_sus
+        elif risk_type == 'personal':
+            risk_tolerance = risk_tolerance / self.prevalence
+            risk_factor = 1
+        else:
+            return {name: 0 * relax_grads[name] for name in self.grad_params}
+
+        # n_max = 1 + g (conditional, personal) or g ** 0.5 (prevalence), where
+        # g = risk_tolerance * (1 + 1/(conc_relax_rate * exp_time)) / (risk_factor * airb_trans_rate * exp_time)
+        g = risk_tolerance * (1 + 1 / (self.conc_relax_rate * exp_time)) / \
+            (risk_factor * self.airb_trans_rate * exp_time)
+        dg_drelax = -risk_tolerance / (risk_factor * self.airb_trans_rate * self.conc_relax_rate ** 2 * exp_time ** 2)
+        if risk_type == 'prevalence':
+            dn_dg = 0.5 / g ** 0.5
+        else:
+            dn_dg = 1 + 0 * g
 
+        n_max_grads = {}
+        for name in self.grad_params:
+            dg = dg_drelax * relax_grads[name] - g * trans_grads[name] / self.airb_trans_rate
+            if name == 'risk_tolerance':
+                dg = dg + g / self.prec_params[1]
+            n_max_grads[name] = dn_dg * dg
 
+        return n_max_grads
 
+    # Calculate analytic partial derivatives of calc_max_time (transient model) with respect to each input in
+    # grad_params. All inputs may be numpy arrays, so a whole batch of rooms is differentiated at once.
+    # Returns a dictionary of input name to derivative.
+    def calc_max_time_grad(self, n_max, risk_type='conditional'):
+        risk_tolerance = self.prec_params[1]  # no units
+        relax_grads, trans_grads = self.calc_rate_grads()
+        if risk_type == 'conditional':
+            risk_tolerance = risk_tolerance / self.percentage_sus
+        elif risk_type == 'prevalence':
+            risk_tolerance = ((n_max - 1) * risk_tolerance) / (n_max * n_max * self.prevalence * self.percentage_sus)
+        elif risk_type == 'personal':
+            risk_tolerance = risk_tolerance / self.prevalence
 
+        # exp_time_trans = exp_time_ss * (1 + u ** 0.5) / 2, where u = 1 + 4 / (conc_relax_rate * exp_time_ss)
+        exp_time_ss = risk_tolerance / ((n_max - 1) * self.airb_trans_rate)  # hrs, steady-state
+        root_u = (1 + 4 / (self.conc_relax_rate * exp_time_ss)) ** 0.5
+        dt_dss = (1 + root_u) / 2 - 1 / (self.conc_relax_rate * exp_time_ss * root_u)
+        dt_drelax = -1 / (self.conc_relax_rate ** 2 * root_u)
+
+        max_time_grads = {}
+        for name in self.grad_params:
+            dss = -exp_time_ss * trans_grads[name] / self.airb_trans_rate
+            if name == 'risk_tolerance':
+                dss = dss + exp_time_ss / self.prec_params[1]
+            max_time_grads[name] = dt_dss * dss + dt_drelax * relax_grads[name]
+
+        return max_time_grads
 
@@ -0,0 +1,103 @@
+import numpy
+
+from indoors import Indoors
+
+"""
+inverse.py answers inverse design questions with the model (indoors.py): what is the least mitigation needed so that
+a target number of people can stay in a room for a target time, under a given risk type? For example, "what ACH or
+MERV do I need so that 25 people can stay 3 hours?"
+
+The guideline n_max(t) >= n is monotone in every lever, and because the airborne transmission rate is inversely
+proportional to the concentration relaxation rate, it reduces to a closed-form bound on the concentration relaxation
+rate. Each lever is then solved exactly, element-wise, so thousands of rooms are solved in one vectorized call.
+
+Levers:
+'air_exch_rate': minimum outdoor air exchange rate (/hr), with the recirculation rate (/hr) held fixed
+'aerosol_filtration_eff': minimum aerosol filtration efficiency (also reported as the minimum MERV rating)
+'recirc_rate': minimum recirculation rate (/hr) through the filter, with the outdoor air exchange rate held fixed
+'mask_passage_prob': maximum mask passage probability
+
+Methods:
+def calc_required_relax_rate: Calculate the concentration relaxation rate needed to meet the target.
+def solve_lever: Calculate the least mitigation of one lever needed to meet the target.
+def eff_to_min_merv: Converts aerosol filtration efficiencies to the minimum MERV ratings achieving them.
+"""
+
+levers = ['air_exch_rate', 'aerosol_filtration_eff', 'recirc_rate', 'mask_passage_prob']
+
+
+# Calculate the concentration relaxation rate (/hr) needed so that n_max people may stay exp_time hours.
+# Uses airb_trans_rate * conc_relax_rate, which does not depend on the concentration relaxation rate.
+def calc_required_relax_rate(indoor_model, n_max, exp_time, risk_type='conditional'):
+    risk_tolerance = indoor_model.prec_params[1]  # no units
+    trans_relax_product = indoor_model.airb_trans_rate * indoor_model.conc_relax_rate
+    if risk_type == 'conditional':
+        risk_factor = indoor_model.percentage_sus
+        g_target = n_max - 1
+    elif risk_type == 'prevalence':
+        risk_factor = indoor_model.prevalence * indoor_model.percentage_sus
+        g_target = n_max * n_max
+    elif risk_type == 'personal':
+        risk_tolerance = risk_tolerance / indoor_model.prevalence
+        risk_factor = 1
+        g_target = n_max - 1
+    else:
+        raise ValueError("Unknown risk type '{}'".format(risk_type))
+
+    # calc_n_max: g = risk_tolerance * (conc_relax_rate + 1/exp_time) / (risk_factor * trans_relax_product * exp_time)
+    return g_target * risk_factor * trans_relax_product * exp_time / risk_tolerance - 1 / exp_time
+
+
+# Calculate the least mitigation of the given lever (see levers) needed so that n_max people may stay exp_time hours
+# under the given risk type. The model, n_max and exp_time may all be numpy arrays (one entry per room).
+# Returns a dictionary with
+#     'value': required lever value (nan where the target cannot be met with this lever alone)
+#     'feasible': whether the target can be met with this lever alone
+#     'merv': minimum MERV rating (only for 'aerosol_filtration_eff'; 0 means no filter, nan if none suffices)
+def solve_lever(indoor_model, lever, n_max, exp_time, risk_type='conditional'):
+    required_relax_rate = calc_required_relax_rate(indoor_model, n_max, exp_time, risk_type)
+    air_exch_rate = indoor_model.physical_params[2]  # /hr
+    aerosol_filtration_eff = indoor_model.physical_params[4]  # no units
+    recirc_ach = air_exch_rate * (1 / indoor_model.physical_params[3] - 1)  # /hr
+    filt_rate = aerosol_filtration_eff * recirc_ach  # /hr, equal to the model's air_filt_rate
+    other_rate = indoor_model.conc_relax_rate - air_exch_rate - filt_rate  # /hr, deactivation and settling
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if lever == 'air_exch_rate':
+            value = numpy.maximum(required_relax_rate - filt_rate - other_rate, 0)
+            feasible = numpy.isfinite(value)
+        elif lever == 'aerosol_filtration_eff':
+            needed_rate = required_relax_rate - air_exch_rate - other_rate
+            value = numpy.where(needed_rate <= 0, 0, needed_rate / recirc_ach)
+            feasible = value <= 1
+        elif lever == 'recirc_rate':
+            needed_rate = required_relax_rate - air_exch_rate - other_rate
+            value = numpy.where(needed_rate <= 0, 0, needed_rate / aerosol_filtration_eff)
+            feasible = numpy.isfinite(value)
+        elif lever == 'mask_passage_prob':
+            # airb_trans_rate scales as mask_passage_prob ** 2, and the relaxation rate is unaffected by masks
+            mask_passage_prob = indoor_model.prec_params[0]
+            scale = (indoor_model.conc_relax_rate + 1 / exp_time) / (required_relax_rate + 1 / exp_time)
+            value = numpy.minimum(mask_passage_prob * numpy.sqrt(scale), 1)
+            feasible = value > 0
+        else:
+            raise ValueError("Unknown lever '{}'".format(lever))
+
+    feasible = feasible & numpy.isfinite(value)
+    solution = {
+        'value': numpy.where(feasible, value, numpy.nan),
+        'feasible': feasible,
+    }
+    if lever == 'aerosol_filtration_eff':
+        solution['merv'] = eff_to_min_merv(solution['value'], indoor_model.physio_params[1])
+
+    return solution
+
+
+# Converts aerosol filtration efficiencies to the minimum MERV ratings (see Indoors.merv_dict) achieving them.
+# Returns 0 where no filter is needed, and nan where no MERV rating is efficient enough.
+def eff_to_min_merv(aerosol_filtration_eff, aerosol_radius):
+    mervs = numpy.arange(0, 21)
+    merv_effs = Indoors.merv_to_eff_array(mervs, aerosol_radius)  # non-decreasing in MERV
+    merv_ind = numpy.searchsorted(merv_effs, numpy.nan_to_num(aerosol_filtration_eff, nan=numpy.inf), side='left')
+    return numpy.where(merv_ind < len(mervs), mervs[numpy.minimum(merv_ind, len(mervs) - 1)], numpy.nan)
@@ -0,0 +1,340 @@
+import errno
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+
+import numpy
+
+import co2
+import essentials as ess
+
+"""
+live.py keeps the model (indoors.py) of many rooms up to date from a local sensor feed, for live wall displays. Each
+reading updates a room's outdoor air exchange rate (given directly, or fitted from CO2 decays, see co2.py), relative
+humidity or occupancy. Readings are queued as they arrive and applied at a fixed cadence; only the rooms whose inputs
+changed are recomputed, and each recomputation stamps those rooms with a new version number, so a display can ask for
+just the rooms that changed since the version it last saw.
+
+Feeds are lines of JSON, one reading per line, e.g.
+    {"room": "101", "time": 1615000000, "co2": 812, "relative_humidity": 0.45, "occupancy": 12}
+read either by tailing a file or from a local datagram socket (each datagram holds one or more lines). time is in
+seconds (epoch) and is needed for CO2 readings; relative_humidity may be a fraction or a percentage.
+
+The monitor lives in the process serving the display, so the app must run in a single process when a feed is
+configured (gunicorn.conf.py runs one worker if LIVE_FEED is set): other processes would start monitors of their own,
+competing for the feed and numbering their versions differently. A feed that fails (e.g. a socket already bound by
+another process) is reported on stderr.
+
+Properties:
+Live Defaults
+live_fields: reading fields, with the model inputs they set
+
+Methods:
+class LiveMonitor: Room inputs and outputs updated from queued readings.
+def get_reading_value: Get a numeric field of a reading.
+def parse_readings: Parse feed lines into readings.
+def tail_file: Feed readings appended to a file into a monitor.
+def read_socket: Feed readings sent to a local datagram socket into a monitor.
+def start_feed: Start the feed and update threads of a monitor.
+def get_live_monitor: Get the monitor configured by environment variables, starting it on first use.
+def get_cadence: Get the update cadence of the live display.
+"""
+
+# Live Defaults
+default_cadence = 5  # seconds between updates
+default_exp_time = 2  # hours, the exposure time the displayed occupancy limit is for
+default_occupancy = 0
+poll_interval = 0.5  # seconds between checks of a tailed file
+
+# Reading fields, with the model inputs they set (see essentials.room_fields)
+live_fields = {
+    'air_exchange_rate': 'air_exchange_rate',
+    'relative_humidity': 'relative_humidity',
+    'occupancy': 'occupancy',
+}
+
+# Environment variables configuring the monitor of the live display (see get_live_monitor)
+env_feed = 'LIVE_FEED'  # file path, udp://host:port or unix:///path/to/socket
+env_rooms = 'LIVE_ROOMS'  # optional JSON file with a list of room dictionaries (see essentials.get_rooms_model)
+env_cadence = 'LIVE_CADENCE'  # seconds
+
+live_monitor = None
+live_monitor_lock = threading.Lock()
+
+
+class LiveMonitor:
+    # rooms: list of room dictionaries (see essentials.get_rooms_model), each with a 'name' and optionally its starting
+    # 'occupancy'. Readings of rooms not listed add them with their presets' defaults.
+    # exp_time: exposure time (hours) the occupancy limit of each room is calculated for
+    def __init__(self, rooms=(), exp_time=default_exp_time, risk_type='conditional', **fit_settings):
+        self.exp_time = exp_time
+        self.risk_type = risk_type
+        self.fitter = co2.DecayFitter(**fit_settings)
+        self.fitted_decays = {}
+
+        self.names = []
+        self.room_index = {}
+        self.columns = None
+        self.occupancy = numpy.zeros(0)
+        self.max_time = numpy.zeros(0)  # hours at the current occupancy
+        self.n_max = numpy.zeros(0)  # people for exp_time hours
+        self.versions = numpy.zeros(0, dtype=int)
+        self.dirty = numpy.zeros(0, dtype=bool)
+        self.version = 0
+        self.rooms_version = 0  # bumped whenever rooms are added
+
+        self.lock = threading.Lock()  # guards pending readings
+        self.state_lock = threading.Lock()  # guards room inputs and outputs
+        self.pending = []
+        self.add_rooms(list(rooms))
+
+    # Register new rooms (room dictionaries with a 'name'), with outputs to be calculated at the next update
+    def add_rooms(self, rooms):
+        rooms = [room for room in rooms if str(room['name']) not in self.room_index]
+        if len(rooms) == 0:
+            return
+        _, columns = ess.get_rooms_model(rooms, target_fields=())
+        for room in rooms:
+            self.room_index[str(room['name'])] = len(self.names)
+            self.names.append(str(room['name']))
+        if self.columns is None:
+            self.columns = columns
+        else:
+            self.columns = {name: numpy.concatenate((self.columns[name], values)) for name, values in columns.items()}
+        n_new = len(rooms)
+        self.occupancy = numpy.concatenate((self.occupancy,
+                                            [float(room.get('occupancy', default_occupancy)) for room in rooms]))
+        self.max_time = numpy.concatenate((self.max_time, numpy.full(n_new, numpy.nan)))
+        self.n_max = numpy.concatenate((self.n_max, numpy.full(n_new, numpy.nan)))
+        self.versions = numpy.concatenate((self.versions, numpy.zeros(n_new, dtype=int)))
+        self.dirty = numpy.concatenate((self.dirty, numpy.ones(n_new, dtype=bool)))
+        self.rooms_version += 1
+
+    # Queue readings (dictionaries, see the feed format) to be applied at the next update. Safe to call from any thread.
+    def add_readings(self, readings):
+        with self.lock:
+            self.pending.extend(readings)
+
+    # Apply the queued readings, marking rooms whose inputs changed
+    def apply_readings(self):
+        with self.lock:
+            readings = self.pending
+            self.pending = []
+        self.add_rooms([{'name': name} for name in {str(reading['room']) for reading in readings}])
+
+        co2_rooms = []
+        co2_times = []
+        co2_values = []
+        for reading in readings:
+            room = self.room_index[str(reading['room'])]
+            for field, column in live_fields.items():
+                value = get_reading_value(reading, field)
+                if value is None or value < 0:
+                    continue
+                if field == 'relative_humidity' and value > 1:
+                    value = value / 100
+                values = self.occupancy if column == 'occupancy' else self.columns[column]
+                if values[room] != value:
+                    values[room] = value
+                    self.dirty[room] = True
+            reading_time = get_reading_value(reading, 'time')
+            reading_co2 = get_reading_value(reading, 'co2')
+            if reading_time is not None and reading_co2 is not None:
+                co2_rooms.append(str(reading['room']))
+                co2_times.append(reading_time / 3600)
+                co2_values.append(reading_co2)
+
+        # Rooms with newly finished CO2 decays take their updated fitted air exchange rate
+        if len(co2_rooms) > 0:
+            self.fitter.add_readings(co2_rooms, co2_times, co2_values)
+            fits = self.fitter.get_results()
+            for name, air_exch_rate, n_decays in zip(fits['room'], fits['air_exch_rate'], fits['n_decays']):
+                if n_decays > self.fitted_decays.get(name, 0) and air_exch_rate > 0:
+                    self.fitted_decays[name] = n_decays
+                    room = self.room_index[name]
+                    self.columns['air_exchange_rate'][room] = air_exch_rate
+                    self.dirty[room] = True
+
+    # Recompute the outputs of the rooms whose inputs changed, stamping them with a new version
+    def recompute(self):
+        rooms = numpy.nonzero(self.dirty)[0]
+        if len(rooms) == 0:
+            return 0
+        rooms_model = ess.get_columns_model({name: values[rooms] for name, values in self.columns.items()})
+        occupancy = self.occupancy[rooms]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            max_time = rooms_model.calc_max_time(numpy.maximum(occupancy, 2), self.risk_type)
+        self.max_time[rooms] = numpy.where(occupancy < 2, numpy.inf, max_time)
+        self.n_max[rooms] = numpy.floor(rooms_model.calc_n_max(self.exp_time, self.risk_type))
+        self.version += 1
+        self.versions[rooms] = self.version
+        self.dirty[rooms] = False
+        return len(rooms)
+
+    # Apply queued readings and recompute changed rooms. Returns the number of rooms recomputed.
+    def update(self):
+        with self.state_lock:
+            self.apply_readings()
+            return self.recompute()
+
+    # Get the rooms recomputed after the given version, as a dictionary of lists (room index, name, occupancy,
+    # max_time, n_max, and whether the room is within its occupancy limit), with the current version. A version ahead of
+    # the monitor's was seen from an earlier monitor (e.g. before a restart), so every room is returned.
+    def get_delta(self, since_version=0):
+        with self.state_lock:
+            if since_version > self.version:
+                since_version = 0
+            rooms = numpy.nonzero(self.versions > since_version)[0]
+            return {
+                'version': self.version,
+                'rooms_version': self.rooms_version,
+                'room': rooms.tolist(),
+                'name': [self.names[room] for room in rooms],
+                'occupancy': self.occupancy[rooms].tolist(),
+                'max_time': self.max_time[rooms].tolist(),
+                'n_max': self.n_max[rooms].tolist(),
+                'safe': (self.occupancy[rooms] <= self.n_max[rooms]).tolist(),
+            }
+
+
+# Returns a numeric field of a reading, or None if it is missing or not a number
+def get_reading_value(reading, field):
+    try:
+        value = float(reading[field])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return value if numpy.isfinite(value) else None
+
+
+# Parse feed lines (JSON objects) into readings, skipping lines that are not readings of a named room
+def parse_readings(lines):
+    readings = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            reading = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(reading, dict) and 'room' in reading:
+            readings.append(reading)
+    return readings
+
+
+# Feed the readings appended to a file into the monitor until stop is set (like tail -f: lines already in the file are
+# skipped, and the file is reopened if it is truncated or replaced)
+def tail_file(path, monitor, stop, from_start=False):
+    feed_file = None
+    partial = ''
+    while not stop.is_set():
+        if feed_file is None:
+            try:
+                feed_file = open(path, 'r')
+            except OSError:
+                stop.wait(poll_interval)
+                continue
+            if not from_start:
+                feed_file.seek(0, os.SEEK_END)
+            from_start = True  # files replaced later are read from their start
+        text = feed_file.read()
+        if text:
+            lines = (partial + text).split('\n')
+            partial = lines.pop()
+            monitor.add_readings(parse_readings(lines))
+            continue
+        try:
+            replaced = os.stat(path).st_ino != os.fstat(feed_file.fileno()).st_ino or \
+                os.stat(path).st_size < feed_file.tell()
+        except OSError:
+            replaced = True
+        if replaced:
+            feed_file.close()
+            feed_file = None
+            partial = ''
+        stop.wait(poll_interval)
+    if feed_file is not None:
+        feed_file.close()
+
+
+# Feed the readings sent to a local datagram socket (udp://host:port or unix:///path) into the monitor until stop is
+# set. A unix socket file left by a process that exited is replaced, but one still bound by another process is not:
+# like a udp port in use, it raises OSError (EADDRINUSE).
+def read_socket(address, monitor, stop):
+    if address.startswith('unix://'):
+        path = address[len('unix://'):]
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as probe:
+                try:
+                    probe.connect(path)
+                except OSError:
+                    os.remove(path)  # stale: nothing is bound to it
+                else:
+                    raise OSError(errno.EADDRINUSE, 'Live feed socket bound by another process', path)
+        feed_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        feed_socket.bind(path)
+    else:
+        host, port = address[len('udp://'):].rsplit(':', 1)
+        feed_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        feed_socket.bind((host, int(port)))
+    feed_socket.settimeout(poll_interval)
+    with feed_socket:
+        while not stop.is_set():
+            try:
+                data = feed_socket.recv(65536)
+            except socket.timeout:
+                continue
+            monitor.add_readings(parse_readings(data.decode('utf-8', 'replace').split('\n')))
+
+
+# Start the threads reading the feed (see tail_file and read_socket) into the monitor and updating it every cadence
+# seconds. Returns the event that stops both threads.
+def start_feed(monitor, feed, cadence=default_cadence):
+    stop = threading.Event()
+    read_feed = read_socket if feed.startswith('udp://') or feed.startswith('unix://') else tail_file
+
+    def run_reader():
+        try:
+            read_feed(feed, monitor, stop)
+        except Exception:
+            traceback.print_exc()
+            print('Live feed {} stopped: the display keeps its last readings'.format(feed), file=sys.stderr)
+
+    def run_updates():
+        while not stop.wait(cadence):
+            try:
+                monitor.update()
+            except Exception:
+                traceback.print_exc()  # keep the display running through a bad batch
+
+    threading.Thread(target=run_reader, daemon=True).start()
+    threading.Thread(target=run_updates, daemon=True).start()
+    return stop
+
+
+# Get the monitor of the live display, configured by the LIVE_FEED, LIVE_ROOMS and LIVE_CADENCE environment variables
+# and started on first use (in the process serving the display, which must be the only one, see above). Returns None if
+# no feed is configured.
+def get_live_monitor():
+    global live_monitor
+    feed = os.environ.get(env_feed)
+    if not feed:
+        return None
+    with live_monitor_lock:
+        if live_monitor is None:
+            rooms = []
+            if os.environ.get(env_rooms):
+                with open(os.environ[env_rooms]) as rooms_file:
+                    rooms = json.load(rooms_file)
+            live_monitor = LiveMonitor(rooms)
+            live_monitor.update()
+            start_feed(live_monitor, feed, get_cadence())
+    return live_monitor
+
+
+# Get the update cadence (seconds) of the live display
+def get_cadence():
+    return float(os.environ.get(env_cadence, default_cadence))
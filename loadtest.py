@@ -0,0 +1,237 @@
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import numpy
+
+"""
+loadtest.py replays Dash callback traffic against the app, to size deployments by measurement. Traffic is recorded
+from realistic sessions (see payloads.py def get_session_actions: preset changes, slider drags and language switches
+on the Basic and Advanced Mode pages), saved as JSON, and replayed by concurrent simulated users, either in this
+process (through the Flask test client) or over HTTP against a local server such as gunicorn. No other services are
+needed.
+
+Each simulated user replays the recorded sessions request by request, as one browser would, starting at a different
+point so users do not move in lockstep. The report gives the throughput, the p50, p95 and p99 latency, and the same
+for each callback.
+
+Usage:
+    python loadtest.py --record traffic.json
+    python loadtest.py --replay traffic.json --concurrency 8 --duration 30
+    python loadtest.py --replay traffic.json --url http://127.0.0.1:8000 --concurrency 32 --duration 60
+
+Properties:
+Load Test Settings
+
+Methods:
+def record_traffic: Record the requests of realistic sessions on both pages.
+def load_traffic: Load recorded requests.
+def make_in_process_sender: Get a function sending requests to the app in this process.
+def make_http_sender: Get a function sending requests to a server over HTTP.
+def run_user: Replay the recorded requests as one user.
+def run_load: Replay the recorded requests with concurrent users.
+def get_latency_stats: Summarize latencies.
+def print_report: Print the report of a load test.
+"""
+
+# Load Test Settings
+default_concurrency = 4
+default_duration = 10  # seconds
+default_modes = ['basic', 'advanced']
+http_timeout = 60  # seconds
+percentiles = [50, 95, 99]
+
+# Recording and in-process replays use a scenario database of their own, so saved scenarios do not change the results
+os.environ.setdefault('SCENARIO_DB', os.path.join(tempfile.gettempdir(), 'loadtest_scenarios.db'))
+
+
+# Record the requests of a realistic session on each page (see payloads.py def run_session), by running them in this
+# process. Returns a list of requests: dictionaries of the page ('mode'), the user action ('action', -1 for the page
+# load), the 'callback' name and the request body ('payload').
+def record_traffic(modes=default_modes):
+    import plotly.utils
+    import index
+    import metrics
+    import payloads
+    client = index.app.server.test_client()
+    traffic = []
+    for mode in modes:
+        for action, key, payload in payloads.run_session(client, mode, payloads.get_session_actions(mode)):
+            traffic.append({'mode': mode, 'action': action, 'callback': metrics.get_callback_name(key),
+                            'payload': json.loads(json.dumps(payload, cls=plotly.utils.PlotlyJSONEncoder))})
+    return traffic
+
+
+# Returns the requests recorded in a file (see record_traffic)
+def load_traffic(path):
+    with open(path) as traffic_file:
+        return json.load(traffic_file)['requests']
+
+
+# Returns a function sending one request body to the app in this process, for one user (each user has its own test
+# client). The function returns the status code and the response size in bytes.
+def make_in_process_sender():
+    import index
+    import payloads
+    client = index.app.server.test_client()
+
+    def send(body):
+        response = client.post(payloads.update_path, data=body, content_type='application/json',
+                               base_url=payloads.base_url)
+        return response.status_code, len(response.get_data())
+    return send
+
+
+# Returns a function sending one request body to the server at url over HTTP, on one kept-alive connection (one per
+# user). Requests say they were forwarded from HTTPS, as the server redirects plain HTTP (see app.py).
+def make_http_sender(url):
+    parsed = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+    path = parsed.path.rstrip('/') + '/_dash-update-component'
+    headers = {'Content-Type': 'application/json', 'X-Forwarded-Proto': 'https'}
+    state = {'connection': None}
+
+    def send(body):
+        for attempt in range(2):  # reconnect once if the server closed the kept-alive connection
+            if state['connection'] is None:
+                state['connection'] = connection_class(parsed.hostname, parsed.port, timeout=http_timeout)
+            try:
+                state['connection'].request('POST', path, body=body, headers=headers)
+                response = state['connection'].getresponse()
+                return response.status, len(response.read())
+            except (http.client.HTTPException, OSError):
+                state['connection'].close()
+                state['connection'] = None
+                if attempt == 1:
+                    raise
+    return send
+
+
+# Replay the recorded requests (as encoded bodies) with one sender, in order from the given start, until stop is set
+# or the user has made max_requests. Appends (callback index, seconds, status code, bytes) to results.
+def run_user(send, bodies, callback_indexes, start, stop, max_requests, results):
+    index = start
+    made = 0
+    while not stop.is_set() and (max_requests is None or made < max_requests):
+        request_start = time.perf_counter()
+        try:
+            status, size = send(bodies[index])
+        except Exception:
+            status, size = 0, 0  # connection failure
+        results.append((callback_indexes[index], time.perf_counter() - request_start, status, size))
+        index = (index + 1) % len(bodies)
+        made += 1
+
+
+# Replay the recorded requests with concurrent users, against the server at url, or in this process if url is None,
+# for duration seconds or until every user has made requests_per_user requests. Returns the results: the callback
+# names, and arrays of the callback index, latency (seconds), status code and size (bytes) of every request, with the
+# elapsed time.
+def run_load(traffic, concurrency=default_concurrency, duration=default_duration, url=None, requests_per_user=None):
+    bodies = [json.dumps(request['payload']).encode('utf-8') for request in traffic]
+    callback_names = sorted({request['callback'] for request in traffic})
+    callback_indexes = [callback_names.index(request['callback']) for request in traffic]
+    stop = threading.Event()
+    user_results = [[] for _ in range(concurrency)]
+    senders = [make_http_sender(url) if url else make_in_process_sender() for _ in range(concurrency)]
+    users = [threading.Thread(target=run_user, args=(senders[user], bodies, callback_indexes,
+                                                     user * len(bodies) // concurrency, stop, requests_per_user,
+                                                     user_results[user]), daemon=True)
+             for user in range(concurrency)]
+
+    start = time.perf_counter()
+    for user in users:
+        user.start()
+    if requests_per_user is None:
+        stop.wait(duration)
+        stop.set()
+    for user in users:
+        user.join()
+    elapsed = time.perf_counter() - start
+
+    results = [result for results in user_results for result in results]
+    return {
+        'callbacks': callback_names,
+        'callback': numpy.array([result[0] for result in results], dtype=int),
+        'latency': numpy.array([result[1] for result in results]),
+        'status': numpy.array([result[2] for result in results], dtype=int),
+        'size': numpy.array([result[3] for result in results], dtype=int),
+        'elapsed': elapsed,
+    }
+
+
+# Returns the count, mean and percentiles (milliseconds) of latencies (seconds)
+def get_latency_stats(latency):
+    if len(latency) == 0:
+        return {'count': 0, 'mean': numpy.nan, **{'p{}'.format(q): numpy.nan for q in percentiles}}
+    values = numpy.percentile(latency, percentiles) * 1000
+    return {'count': len(latency), 'mean': float(numpy.mean(latency) * 1000),
+            **{'p{}'.format(q): float(value) for q, value in zip(percentiles, values)}}
+
+
+# Print the report of a load test (see run_load): throughput and latency overall and per callback. Returns the report
+# as a dictionary.
+def print_report(results, concurrency):
+    # PreventUpdate answers 204, which is a success
+    errors = int(numpy.sum((results['status'] < 200) | (results['status'] >= 300)))
+    report = {
+        'concurrency': concurrency,
+        'requests': len(results['latency']),
+        'errors': errors,
+        'elapsed': results['elapsed'],
+        'throughput': len(results['latency']) / results['elapsed'],
+        'latency': get_latency_stats(results['latency']),
+        'callbacks': {},
+    }
+    for index, name in enumerate(results['callbacks']):
+        selected = results['callback'] == index
+        report['callbacks'][name] = dict(get_latency_stats(results['latency'][selected]),
+                                         mean_bytes=float(numpy.mean(results['size'][selected]))
+                                         if numpy.any(selected) else 0)
+
+    print('{} users, {} requests in {:.1f} s: {:.1f} requests/s, {} errors'.format(
+        concurrency, report['requests'], report['elapsed'], report['throughput'], errors))
+    print('{:<34} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}'.format('callback', 'count', 'mean ms', 'p50 ms', 'p95 ms',
+                                                              'p99 ms', 'mean bytes'))
+    rows = [('(all)', dict(report['latency'], mean_bytes=float(numpy.mean(results['size']))
+                           if len(results['size']) else 0))]
+    rows += sorted(report['callbacks'].items(), key=lambda item: -item[1]['count'] * item[1]['mean']
+                   if item[1]['count'] else 0)
+    for name, stats in rows:
+        print('{:<34} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.0f}'.format(
+            name, stats['count'], stats['mean'], stats['p50'], stats['p95'], stats['p99'], stats['mean_bytes']))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay Dash callback traffic against the app.')
+    parser.add_argument('--record', help='record realistic sessions to this file (and exit)')
+    parser.add_argument('--replay', help='replay the requests recorded in this file (recorded now if not given)')
+    parser.add_argument('--modes', default=','.join(default_modes), help='pages to record: basic, advanced')
+    parser.add_argument('--url', help='server to load, e.g. http://127.0.0.1:8000 (in this process if not given)')
+    parser.add_argument('--concurrency', type=int, default=default_concurrency, help='simultaneous users')
+    parser.add_argument('--duration', type=float, default=default_duration, help='seconds to run')
+    parser.add_argument('--requests', type=int, help='requests per user (instead of a duration)')
+    parser.add_argument('--json', help='also write the report to this JSON file')
+    args = parser.parse_args()
+
+    if args.record:
+        recorded = record_traffic(args.modes.split(','))
+        with open(args.record, 'w') as record_file:
+            json.dump({'requests': recorded}, record_file)
+        print('Recorded {} requests to {}'.format(len(recorded), args.record))
+        sys.exit(0)
+
+    traffic_requests = load_traffic(args.replay) if args.replay else record_traffic(args.modes.split(','))
+    load_results = print_report(run_load(traffic_requests, args.concurrency, args.duration, args.url, args.requests),
+                                args.concurrency)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(load_results, report_file, indent=1)
+    sys.exit(1 if load_results['errors'] else 0)
@@ -0,0 +1,276 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+"""
+memory.py accounts for the memory a server worker holds, so footprint reductions can be measured and kept.
+
+A worker's baseline is measured in a fresh interpreter, importing the app's subsystems one stage at a time (the
+libraries, the description modules of every language, the model, the app with its page layouts), loading the preset
+table, and then serving the first requests of both pages. After each stage the memory traced by tracemalloc and the
+resident set size (RSS, measured in a separate run without tracemalloc, which adds its own overhead) are recorded, so
+growth is attributed to the subsystem that caused it. The check fails (exit status 1) when a stage or the whole
+worker grows past its budget, or when there is no preset table built from the current code to measure (build it with
+python presets.py). The budgets hold for the environment they were calibrated on (budget_environment); the check
+reports when it runs in another.
+
+A running worker reports its RSS and, if tracemalloc was started (the PYTHONTRACEMALLOC environment variable), the
+memory traced by subsystem and the top allocating lines (see get_memory_report, served at /memory by profiling.py).
+
+Usage: python memory.py [--json FILE] [--scale RATIO]
+
+Properties:
+Memory Settings
+Worker Stages
+Memory Budgets
+
+Methods:
+def get_rss: Get the resident set size of this process.
+def get_environment: Get the versions of Python and the libraries the budgets depend on.
+def get_subsystem: Get the subsystem of a source file.
+def get_memory_report: Report the memory of this process.
+def measure_stages: Measure the memory of this process after each worker stage.
+def measure_worker: Measure a worker's stages in a fresh interpreter.
+def check_budgets: Measure a worker's baseline and compare it with the budgets.
+"""
+
+# Memory Settings
+mib = 2 ** 20
+default_top = 20  # allocating lines reported
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Worker Stages
+# Modules imported at each stage, in order. 'presets' loads the preset table (see presets.py) and 'pages' serves the
+# first requests of both pages.
+worker_stages = [
+    ('numpy', ['numpy']),
+    ('scipy', ['scipy.sparse', 'scipy.sparse.linalg']),
+    ('pandas', ['pandas']),
+    ('plotly', ['plotly.graph_objects', 'plotly.graph_objs._figure', 'plotly.graph_objs.layout', 'plotly.offline',
+                'plotly.utils']),  # plotly imports its submodules on first use
+    ('flask', ['flask', 'flask_talisman']),
+    ('dash', ['dash', 'dash_core_components', 'dash_html_components', 'dash_bootstrap_components']),
+    ('descriptions', sorted(os.path.basename(path)[:-len('.py')]
+                            for path in glob.glob(os.path.join(repo_dir, 'descriptions*.py')))),
+    ('model', ['indoors', 'essentials']),
+    ('app', ['index']),
+    ('presets', []),
+    ('pages', []),
+]
+
+# Memory Budgets
+# MiB traced at each stage, and MiB of RSS of the whole worker: measured with about 15% headroom on Python 3.8
+# (runtime.txt) and the pinned requirements (requirements.txt), with Flask 1.1.2 (requirements.txt leaves Flask
+# unpinned, and Flask 3 does not run Dash 1.16) and without IPython (which plotly imports when it is installed, adding
+# about 27 MiB). Lower them when a reduction lands, so it is kept; other environments can scale them (--scale).
+stage_budgets = {
+    'numpy': 8,
+    'scipy': 5.5,
+    'pandas': 16,
+    'plotly': 2.5,
+    'flask': 8.5,
+    'dash': 5.5,
+    'descriptions': 3.5,
+    'model': 0.5,
+    'app': 20.5,
+    'presets': 11.5,
+    'pages': 1.5,
+}
+rss_budget = 145
+# The environment the budgets were calibrated on (see get_environment)
+budget_environment = {
+    'python': '3.8',
+    'numpy': '1.18.5',
+    'scipy': '1.5.2',
+    'pandas': '1.0.5',
+    'plotly': '4.10.0',
+    'dash': '1.16.0',
+    'Flask': '1.1.2',
+    'IPython': None,
+}
+
+# Subsystems of the source files outside the repository, by top-level package (see get_subsystem)
+package_subsystems = {
+    'dash_core_components': 'dash', 'dash_html_components': 'dash', 'dash_bootstrap_components': 'dash',
+    'dash_table': 'dash', 'dash_renderer': 'dash', '_plotly_utils': 'plotly', 'werkzeug': 'flask', 'jinja2': 'flask',
+    'flask_talisman': 'flask', 'itsdangerous': 'flask', 'click': 'flask', 'markupsafe': 'flask',
+}
+
+
+# Returns the resident set size of this process (bytes), or None where it cannot be read
+def get_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, in KiB on Linux
+    except ImportError:
+        return None
+
+
+# Returns the versions of Python (major.minor) and of the libraries the budgets depend on, as in budget_environment
+# (None for a library that is not installed)
+def get_environment():
+    from importlib import metadata
+    environment = {'python': '.'.join(platform.python_version_tuple()[:2])}
+    for package in ['numpy', 'scipy', 'pandas', 'plotly', 'dash', 'Flask', 'IPython']:
+        try:
+            environment[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            environment[package] = None
+    return environment
+
+
+# Returns the subsystem a source file belongs to: 'descriptions', 'model' or 'app' for the repository's files, the
+# library's name for an installed package, 'import' for the code of imported modules, or 'python'
+def get_subsystem(file_name):
+    if file_name.startswith('<frozen'):
+        return 'import'
+    path = os.path.abspath(file_name)
+    if path.startswith(repo_dir + os.sep) and 'site-packages' not in path:
+        module = os.path.basename(path)
+        if module.startswith('descriptions'):
+            return 'descriptions'
+        if module in ['indoors.py', 'essentials.py']:
+            return 'model'
+        return 'app'
+    parts = path.split(os.sep)
+    if 'site-packages' in parts and parts.index('site-packages') + 1 < len(parts):
+        package = parts[parts.index('site-packages') + 1].split('.')[0]
+        return package_subsystems.get(package, package)
+    return 'python'
+
+
+# Returns a report of the memory of this process: its RSS and, if tracemalloc is tracing, the memory traced (current
+# and peak), by subsystem, and the top allocating source lines
+def get_memory_report(top=default_top):
+    report = {'pid': os.getpid(), 'rss': get_rss(), 'tracing': tracemalloc.is_tracing()}
+    if not report['tracing']:
+        return report
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    subsystems = {}
+    for stat in snapshot.statistics('filename'):
+        subsystem = subsystems.setdefault(get_subsystem(stat.traceback[0].filename), {'size': 0, 'count': 0})
+        subsystem['size'] += stat.size
+        subsystem['count'] += stat.count
+    report.update({
+        'traced': current,
+        'traced_peak': peak,
+        'subsystems': sorted(({'subsystem': name, **values} for name, values in subsystems.items()),
+                             key=lambda subsystem: -subsystem['size']),
+        'top': [{'file': stat.traceback[0].filename, 'line': stat.traceback[0].lineno, 'size': stat.size,
+                 'count': stat.count} for stat in snapshot.statistics('lineno')[:top]],
+    })
+    return report
+
+
+# Runs the worker stages in this process (see worker_stages), and returns the memory after each: a list of
+# dictionaries of the 'stage', the 'rss' and the memory 'traced' (bytes, None if tracemalloc is not tracing). That of
+# the presets stage also has the number of 'combinations' in the preset table (0 if there is no current table).
+def measure_stages():
+    def measure(stage):
+        return {'stage': stage, 'rss': get_rss(),
+                'traced': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None}
+
+    measurements = [measure('python')]
+    for stage, modules in worker_stages:
+        for module in modules:
+            __import__(module)
+        combinations = None
+        if stage == 'presets':
+            import presets
+            combinations = presets.load_preset_table()
+        if stage == 'pages':
+            import index
+            import payloads
+            client = index.app.server.test_client()
+            for mode in payloads.page_layouts:
+                payloads.run_session(client, mode, [])
+        measurements.append(measure(stage))
+        if combinations is not None:
+            measurements[-1]['combinations'] = combinations
+    return measurements
+
+
+# Measures the worker stages in a fresh interpreter, with tracemalloc tracing (for the traced memory) or not (for the
+# RSS). Returns the measurements (see measure_stages).
+def measure_worker(trace):
+    environment = dict(os.environ, SCENARIO_DB=os.path.join(tempfile.gettempdir(), 'memory_scenarios.db'),
+                       PYTHONWARNINGS='ignore')
+    environment.pop('PYTHONTRACEMALLOC', None)
+    command = [sys.executable] + (['-X', 'tracemalloc=1'] if trace else []) + [os.path.abspath(__file__),
+                                                                               '--measure']
+    output = subprocess.check_output(command, cwd=repo_dir, env=environment)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+# Measures a worker's baseline (see measure_worker), prints what each stage adds, and compares it with the budgets
+# (multiplied by scale). Returns the report, with the budgets exceeded in 'failures' (and a missing preset table, whose
+# memory could not be measured).
+def check_budgets(scale=1.0):
+    start = time.perf_counter()
+    traced = measure_worker(True)
+    untraced = measure_worker(False)
+    stages = []
+    failures = []
+    for index in range(1, len(traced)):
+        stage = traced[index]['stage']
+        added = (traced[index]['traced'] - traced[index - 1]['traced']) / mib
+        rss_added = (untraced[index]['rss'] - untraced[index - 1]['rss']) / mib if untraced[index]['rss'] else None
+        budget = stage_budgets[stage] * scale
+        stages.append({'stage': stage, 'traced': added, 'rss': rss_added, 'budget': budget})
+        if added > budget:
+            failures.append('{} adds {:.1f} MiB traced (budget {:.1f} MiB)'.format(stage, added, budget))
+        if traced[index].get('combinations') == 0:
+            failures.append('presets: no preset table built from the current code to measure (build it with python '
+                            'presets.py)')
+    rss = untraced[-1]['rss'] / mib if untraced[-1]['rss'] else None
+    if rss is not None and rss > rss_budget * scale:
+        failures.append('a worker holds {:.1f} MiB RSS (budget {:.1f} MiB)'.format(rss, rss_budget * scale))
+
+    print('{:<14} {:>13} {:>10} {:>12}'.format('stage', 'traced (MiB)', 'RSS (MiB)', 'budget (MiB)'))
+    for stage in stages:
+        print('{:<14} {:>13.1f} {:>10} {:>12.1f}'.format(stage['stage'], stage['traced'], '' if stage['rss'] is None
+                                                          else '{:.1f}'.format(stage['rss']), stage['budget']))
+    print('{:<14} {:>13.1f} {:>10} {:>12.1f}'.format('worker', traced[-1]['traced'] / mib, '' if rss is None
+                                                      else '{:.1f}'.format(rss), rss_budget * scale))
+    print('Measured in {:.1f} s'.format(time.perf_counter() - start))
+    environment = get_environment()
+    if environment != budget_environment:
+        print('The budgets were calibrated on {}; this is {} (scale them with --scale, or recalibrate)'.format(
+            ', '.join('{} {}'.format(name, version) for name, version in budget_environment.items()),
+            ', '.join('{} {}'.format(name, version) for name, version in environment.items()
+                      if version != budget_environment.get(name))))
+    for failure in failures:
+        print('Over budget: ' + failure)
+    return {'stages': stages, 'traced': traced[-1]['traced'], 'rss': untraced[-1]['rss'], 'environment': environment,
+            'failures': failures}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--measure']:
+        # Inside measure_worker's fresh interpreter
+        sys.path.insert(0, repo_dir)
+        print(json.dumps(measure_stages()))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Check a worker's memory baseline against its budgets.")
+    parser.add_argument('--json', help='also write the report to this JSON file')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the budgets (e.g. for other versions)')
+    args = parser.parse_args()
+    memory_report = check_budgets(args.scale)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(memory_report, report_file, indent=1)
+    sys.exit(1 if memory_report['failures'] else 0)
@@ -0,0 +1,227 @@
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+import flask
+
+from app import app
+
+"""
+metrics.py measures every Dash callback request the server answers (the callbacks of index.py, apps/default.py,
+apps/advanced.py and apps/live.py): its wall time, the CPU time of the thread serving it, the size of its response and
+whether it failed. Measurements go into in-process histograms per callback, and are exposed in the Prometheus text
+format at /metrics on the app's Flask server (app.server).
+
+Each gunicorn worker has its own histograms, and writes them to a file of its own in a directory shared by the workers
+(the METRICS_DIR environment variable, by default a temporary directory of the gunicorn master), at most every
+flush_interval seconds. /metrics, whichever worker answers it, adds up the files of every worker, so the totals
+cover the whole server; the files of workers that have exited are kept, so counters never go back. Measuring adds a
+few microseconds to a request, and nothing is measured for other requests.
+
+Properties:
+Metrics Settings
+CallbackMetrics: histograms of this process
+
+Methods:
+class CallbackMetrics: Histograms of callback requests.
+def get_callback_name: Get the name of a callback, for reports and labels.
+def get_metrics_dir: Get the directory shared by the workers.
+def load_worker_metrics: Add up the histograms written by every worker.
+def format_metrics: Format histograms in the Prometheus text format.
+def start_callback_timer: Flask before_request hook starting the measurement of a callback request.
+def record_callback_metrics: Flask after_request hook recording a callback request.
+def get_metrics: GET /metrics - Callback histograms of every worker, in the Prometheus text format
+"""
+
+# Metrics Settings
+env_metrics_dir = 'METRICS_DIR'
+metrics_prefix = 'covid_indoor_callback'
+update_path = '/_dash-update-component'
+flush_interval = 5  # seconds between writes of a worker's histograms
+time_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # seconds
+size_buckets = [100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000]  # bytes
+
+# Histograms measured (their buckets, and their description in the /metrics output)
+histograms = {
+    'wall': ('seconds', time_buckets, 'Wall time of Dash callback requests.'),
+    'cpu': ('cpu_seconds', time_buckets, 'CPU time of the thread serving Dash callback requests.'),
+    'size': ('response_bytes', size_buckets, 'Size of Dash callback responses.'),
+}
+
+
+class CallbackMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recording = True  # off while warming up before forking (see warmup.py)
+        self.reset()
+
+    # Forget every measurement
+    def reset(self):
+        self.pid = os.getpid()
+        self.callbacks = {}  # callback name to its counts, sums and bucket counts (not cumulative)
+        self.last_flush = time.time()
+
+    # Returns empty counts for one callback
+    @staticmethod
+    def new_callback():
+        callback = {'errors': 0}
+        for histogram, (_, buckets, _) in histograms.items():
+            callback[histogram] = {'count': 0, 'sum': 0.0, 'buckets': [0] * (len(buckets) + 1)}
+        return callback
+
+    # Record one request of a callback: wall time and CPU time (seconds), response size (bytes), and whether it failed
+    def observe(self, name, wall, cpu, size, error):
+        with self.lock:
+            if os.getpid() != self.pid:
+                # Forked (gunicorn with preload): the measurements of the parent are not this worker's
+                self.reset()
+            callback = self.callbacks.get(name)
+            if callback is None:
+                callback = self.callbacks[name] = self.new_callback()
+            for histogram, value in (('wall', wall), ('cpu', cpu), ('size', size)):
+                counts = callback[histogram]
+                counts['count'] += 1
+                counts['sum'] += value
+                counts['buckets'][bisect.bisect_left(histograms[histogram][1], value)] += 1
+            if error:
+                callback['errors'] += 1
+
+    # Returns a copy of the histograms
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.callbacks))
+
+    # Write the histograms to this worker's file in the metrics directory. If only_due, only if flush_interval has
+    # passed since the last write.
+    def flush(self, only_due=False):
+        now = time.time()
+        if only_due and now - self.last_flush < flush_interval:
+            return
+        self.last_flush = now
+        metrics_dir = get_metrics_dir()
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = os.path.join(metrics_dir, 'callbacks_{}.json'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as metrics_file:
+            json.dump({'buckets': {histogram: buckets for histogram, (_, buckets, _) in histograms.items()},
+                       'callbacks': self.snapshot()}, metrics_file)
+        os.replace(path + '.tmp', path)
+
+
+# Histograms of this process, written to the metrics directory when the worker exits too
+callback_metrics = CallbackMetrics()
+atexit.register(lambda: callback_metrics.callbacks and callback_metrics.flush())
+
+# callback_map keys to callback names (see get_callback_name)
+callback_names = {}
+
+
+# Returns the name of the callback with the given callback_map key: its module and function, e.g.
+# 'apps.advanced.update_figure' (Basic and Advanced Mode have functions of the same name), or 'unknown'
+def get_callback_name(key):
+    name = callback_names.get(key)
+    if name is None:
+        callback = app.callback_map.get(key, {}).get('callback')
+        name = 'unknown' if callback is None else '{}.{}'.format(callback.__module__, callback.__name__)
+        if key in app.callback_map:
+            callback_names[key] = name  # requests with other keys must not grow the table
+    return name
+
+
+# Returns the directory the workers write their histograms to: the METRICS_DIR environment variable, or a temporary
+# directory of the parent process (the gunicorn master), so the workers of one server share it
+def get_metrics_dir():
+    return os.environ.get(env_metrics_dir) or os.path.join(tempfile.gettempdir(), 'covid-indoor-metrics',
+                                                           str(os.getppid()))
+
+
+# Returns the histograms written by every worker to the metrics directory, added up, and the number of workers.
+# Files written with other buckets (by an older version) are skipped.
+def load_worker_metrics():
+    metrics_dir = get_metrics_dir()
+    buckets = {histogram: list(histogram_buckets) for histogram, (_, histogram_buckets, _) in histograms.items()}
+    totals = {}
+    workers = 0
+    for file_name in sorted(os.listdir(metrics_dir)) if os.path.isdir(metrics_dir) else []:
+        if not (file_name.startswith('callbacks_') and file_name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(metrics_dir, file_name)) as metrics_file:
+                worker = json.load(metrics_file)
+        except (OSError, ValueError):
+            continue  # removed or being replaced
+        if worker.get('buckets') != buckets:
+            continue
+        workers += 1
+        for name, callback in worker['callbacks'].items():
+            total = totals.get(name)
+            if total is None:
+                total = totals[name] = CallbackMetrics.new_callback()
+            total['errors'] += callback['errors']
+            for histogram in histograms:
+                total[histogram]['count'] += callback[histogram]['count']
+                total[histogram]['sum'] += callback[histogram]['sum']
+                total[histogram]['buckets'] = [a + b for a, b in zip(total[histogram]['buckets'],
+                                                                     callback[histogram]['buckets'])]
+    return totals, workers
+
+
+# Returns the histograms (as from load_worker_metrics) in the Prometheus text format
+def format_metrics(callbacks, workers):
+    lines = []
+    for histogram, (suffix, buckets, help_text) in histograms.items():
+        metric = '{}_{}'.format(metrics_prefix, suffix)
+        lines += ['# HELP {} {}'.format(metric, help_text), '# TYPE {} histogram'.format(metric)]
+        for name in sorted(callbacks):
+            counts = callbacks[name][histogram]
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in buckets] + ['+Inf'], counts['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{{callback="{}",le="{}"}} {}'.format(metric, name, bound, cumulative))
+            lines.append('{}_sum{{callback="{}"}} {!r}'.format(metric, name, float(counts['sum'])))
+            lines.append('{}_count{{callback="{}"}} {}'.format(metric, name, counts['count']))
+
+    metric = metrics_prefix + '_errors_total'
+    lines += ['# HELP {} Dash callback requests answered with an error status.'.format(metric),
+              '# TYPE {} counter'.format(metric)]
+    lines += ['{}{{callback="{}"}} {}'.format(metric, name, callbacks[name]['errors']) for name in sorted(callbacks)]
+    lines += ['# HELP {}_workers Workers whose measurements are included.'.format(metrics_prefix),
+              '# TYPE {}_workers gauge'.format(metrics_prefix),
+              '{}_workers {}'.format(metrics_prefix, workers)]
+    return '\n'.join(lines) + '\n'
+
+
+# Starts measuring a Dash callback request (a Flask before_request hook)
+@app.server.before_request
+def start_callback_timer():
+    if flask.request.path == update_path and callback_metrics.recording:
+        flask.g.callback_timer = (time.perf_counter(), time.thread_time())
+
+
+# Records a Dash callback request in the histograms of this worker (a Flask after_request hook, which also runs for
+# the error response of a callback that raised)
+@app.server.after_request
+def record_callback_metrics(response):
+    timer = flask.g.pop('callback_timer', None)
+    if timer is None:
+        return response
+    wall = time.perf_counter() - timer[0]
+    cpu = time.thread_time() - timer[1]
+    body = flask.request.get_json(silent=True)
+    name = get_callback_name(body.get('output')) if isinstance(body, dict) else 'unknown'
+    callback_metrics.observe(name, wall, cpu, response.calculate_content_length() or 0, response.status_code >= 400)
+    try:
+        callback_metrics.flush(only_due=True)
+    except OSError:
+        pass  # the next request or /metrics writes them
+    return response
+
+
+# Callback histograms of every worker, in the Prometheus text format
+@app.server.route('/metrics')
+def get_metrics():
+    callback_metrics.flush()
+    return flask.Response(format_metrics(*load_worker_metrics()), mimetype='text/plain; version=0.0.4')
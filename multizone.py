@@ -0,0 +1,172 @@
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+
+from indoors import Indoors
+
+"""
+multizone.py couples the well-mixed rooms of the model (indoors.py) into a building. Each zone keeps its own outdoor
+air, viral deactivation and settling, but recirculated air returns to an air handler, passes its filter, and is
+shared among all the zones the handler serves. Further inter-zone airflows (transfer air, corridors, open doors) may
+be added as a matrix. The concentration of infectious aerosol in every zone then follows the linear system
+
+    dC/dt = s - A C
+
+where A is a sparse zones x zones matrix of removal (diagonal) and inflow from other zones (off-diagonal), and s is
+the source from the infectors in each zone. Steady states are solved with a sparse LU factorization of A, and
+transients with the exact action of the matrix exponential (no ODE stepping).
+
+When every zone has its own air handler and there are no other airflows, A is diagonal with the conc_relax_rate of
+each zone, and every output reduces to the single-zone model.
+
+Properties:
+zones_model: batch model with one entry per zone
+conc_relax_matrix: the sparse matrix A (/hr)
+emission: quanta exhaled per hour by one infector in each zone (through their mask)
+inhale_rate: m3 inhaled per hour by one susceptible in each zone (through their mask), scaled by relative susceptibility
+
+Methods:
+def __init__: Constructor
+def stack_zones: Combine single-zone models into one batch model with one entry per zone.
+def get_air_handler_flows: Get the recirculation airflows between zones sharing air handlers.
+def get_source: Get the aerosol source in each zone for the given infectors.
+def calc_steady_conc: Calculate steady-state concentrations for the given infectors.
+def calc_trans_rate_matrix: Calculate the steady-state airborne transmission rate from each zone to each zone.
+def calc_conc: Calculate exact transient concentrations and cumulative doses at the given times.
+def calc_exp_trans: Calculate the expected airborne transmissions in each zone over an exposure time.
+"""
+
+
+class MultiZone:
+    # zones_model: batch model (see Indoors.copy_with_params or stack_zones) with one entry per zone; each zone's
+    #              recirculation rate and filtration efficiency describe its air handler supply
+    # handlers: air handler of each zone (zones with the same value share recirculated air); defaults to one air
+    #           handler per zone
+    # airflow: optional further airflows (ft3/min), a dense or sparse matrix with airflow[i, j] flowing from zone j to
+    #          zone i; penetration: fraction of aerosol carried by those airflows (scalar or matrix)
+    def __init__(self, zones_model, handlers=None, airflow=None, penetration=1):
+        self.zones_model = zones_model
+        floor_area = numpy.asarray(zones_model.physical_params[0], dtype=float)
+        self.n_zones = max(numpy.size(zones_model.conc_relax_rate), numpy.size(floor_area))
+        room_vol = numpy.broadcast_to(zones_model.room_vol, (self.n_zones,))  # ft3
+        self.room_vol_m = 0.0283168 * room_vol  # m3
+        if handlers is None:
+            handlers = numpy.arange(self.n_zones)
+
+        # Removal within each zone, other than by recirculation: outdoor air, viral deactivation and settling
+        own_rate = numpy.broadcast_to(zones_model.conc_relax_rate - zones_model.air_filt_rate, (self.n_zones,))
+
+        # Airflows between zones (ft3/min), weighted by the fraction of aerosol they carry
+        flows = self.get_air_handler_flows(zones_model, handlers, self.n_zones)
+        if airflow is not None:
+            airflow = scipy.sparse.csr_matrix(airflow, dtype=float)
+            flows = flows + airflow.multiply(penetration) if numpy.ndim(penetration) > 0 \
+                else flows + airflow * penetration
+            flows = scipy.sparse.csr_matrix(flows)
+            outflow = numpy.asarray(airflow.sum(axis=0)).ravel()
+        else:
+            outflow = numpy.zeros(self.n_zones)
+        recirc_out = numpy.broadcast_to(zones_model.recirc_rate, (self.n_zones,))  # ft3/min
+
+        # A = diag(own removal + outflow / volume) - diag(1 / volume) * inflow
+        inv_vol = 60 / room_vol  # (/hr) / (ft3/min)
+        diagonal = own_rate + (recirc_out + outflow) * inv_vol
+        self.conc_relax_matrix = (scipy.sparse.diags(diagonal) -
+                                  scipy.sparse.diags(inv_vol) @ flows).tocsc()
+        self.lu = scipy.sparse.linalg.splu(self.conc_relax_matrix)
+
+        # Infectors exhale, and susceptible people inhale, through their masks
+        breathing_flow_rate = zones_model.physio_params[0]  # m3/hr
+        mask_passage_prob = zones_model.prec_params[0]
+        self.emission = numpy.broadcast_to(breathing_flow_rate * mask_passage_prob * zones_model.disease_params[0],
+                                           (self.n_zones,))  # quanta/hr
+        self.inhale_rate = numpy.broadcast_to(breathing_flow_rate * mask_passage_prob * zones_model.relative_sus,
+                                              (self.n_zones,))  # m3/hr
+        self.percentage_sus = numpy.broadcast_to(zones_model.percentage_sus, (self.n_zones,))
+
+    # Combine single-zone models into one batch model with one entry per zone
+    @staticmethod
+    def stack_zones(models):
+        params = {name: numpy.array([model.get_param(name) for model in models], dtype=float)
+                  for name in Indoors.param_locations}
+        return models[0].copy_with_params(**params)
+
+    # Get the sparse matrix of recirculation airflows (ft3/min) between zones sharing air handlers, weighted by the
+    # filter penetration. An air handler returns the recirculated air of all its zones, filters it, and supplies it back
+    # in proportion to each zone's recirculation rate: flows[i, j] = (1 - filtration) * recirc[i] * recirc[j] / total.
+    # The filter efficiency of a handler is the recirculation-weighted mean of its zones' efficiencies.
+    @staticmethod
+    def get_air_handler_flows(zones_model, handlers, n_zones):
+        handlers = numpy.asarray(handlers)
+        recirc = numpy.broadcast_to(zones_model.recirc_rate, (n_zones,)).astype(float)  # ft3/min
+        filtration_eff = numpy.broadcast_to(zones_model.physical_params[4], (n_zones,)).astype(float)
+        handler_ids, handler_index = numpy.unique(handlers, return_inverse=True)
+        handler_recirc = numpy.bincount(handler_index, weights=recirc, minlength=len(handler_ids))
+        handler_filtered = numpy.bincount(handler_index, weights=recirc * filtration_eff, minlength=len(handler_ids))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            handler_passage = numpy.where(handler_recirc > 0, 1 - handler_filtered / handler_recirc, 1)
+            supply_share = numpy.where(handler_recirc[handler_index] > 0, recirc / handler_recirc[handler_index], 0)
+
+        # Every pair of zones on the same handler (including each zone with itself)
+        order = numpy.argsort(handler_index, kind='stable')
+        counts = numpy.bincount(handler_index, minlength=len(handler_ids))
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        rows = []
+        cols = []
+        for start, count in zip(starts, counts):
+            members = order[start:start + count]
+            rows.append(numpy.repeat(members, count))
+            cols.append(numpy.tile(members, count))
+        rows = numpy.concatenate(rows)
+        cols = numpy.concatenate(cols)
+        values = handler_passage[handler_index[rows]] * supply_share[rows] * recirc[cols]
+        return scipy.sparse.csr_matrix((values, (rows, cols)), shape=(n_zones, n_zones))
+
+    # Returns the source (quanta/m3/hr) of the given infectors, indexed by [zone] or [zone, scenario]
+    def get_source(self, infectors):
+        infectors = numpy.asarray(infectors, dtype=float)
+        scale = self.emission / self.room_vol_m
+        return scale[:, numpy.newaxis] * infectors if infectors.ndim > 1 else scale * infectors
+
+    # Calculate the steady-state concentration (quanta/m3) in every zone for the given number of infectors in each zone.
+    # infectors: indexed by [zone], or [zone, scenario] to solve many placements at once
+    def calc_steady_conc(self, infectors):
+        return self.lu.solve(self.get_source(infectors))
+
+    # Calculate the steady-state airborne transmission rate (/hr) to one susceptible in zone i from one infector in
+    # zone j, as a dense zones x zones matrix. With one air handler per zone, the diagonal is airb_trans_rate.
+    def calc_trans_rate_matrix(self):
+        return self.inhale_rate[:, numpy.newaxis] * self.lu.solve(numpy.diag(self.emission / self.room_vol_m))
+
+    # Calculate exact transient concentrations (quanta/m3) and cumulative doses (quanta inhaled by one susceptible,
+    # see inhale_rate) at the given times (hours, increasing, from 0), for constant infectors.
+    # initial_conc: concentration in every zone at time 0 (0 for clean air)
+    # Returns (conc, dose), each indexed by [zone, time] or [zone, scenario, time].
+    def calc_conc(self, infectors, times, initial_conc=0):
+        times = numpy.asarray(times, dtype=float)
+        steady_conc = self.calc_steady_conc(infectors)
+        deviation = numpy.broadcast_to(initial_conc, steady_conc.shape) - steady_conc
+        initial_deviation = deviation.copy()
+        conc = numpy.empty(steady_conc.shape + times.shape)
+        dose = numpy.empty(steady_conc.shape + times.shape)
+        prev_time = 0
+        for index, time in enumerate(times):
+            # exp(-A t) applied exactly; the semigroup property carries the deviation from one time to the next
+            if time > prev_time:
+                deviation = scipy.sparse.linalg.expm_multiply(-self.conc_relax_matrix * (time - prev_time), deviation)
+            prev_time = time
+            conc[..., index] = steady_conc + deviation
+            # Integral of the concentration: steady * t + A^-1 (initial deviation - deviation)
+            conc_integral = steady_conc * time + self.lu.solve(initial_deviation - deviation)
+            inhale_rate = self.inhale_rate[:, numpy.newaxis] if steady_conc.ndim > 1 else self.inhale_rate
+            dose[..., index] = inhale_rate * conc_integral
+        return conc, dose
+
+    # Calculate the expected airborne transmissions in each zone over exp_time hours, starting from clean air, for the
+    # given infectors and occupancy (people, including infectors) in each zone, indexed by [zone] or [zone, scenario].
+    def calc_exp_trans(self, infectors, occupancy, exp_time):
+        infectors = numpy.asarray(infectors, dtype=float)
+        dose = self.calc_conc(infectors, [exp_time])[1][..., 0]
+        percentage_sus = self.percentage_sus[:, numpy.newaxis] if infectors.ndim > 1 else self.percentage_sus
+        susceptible = numpy.maximum(numpy.asarray(occupancy, dtype=float) - infectors, 0) * percentage_sus
+        return susceptible * dose
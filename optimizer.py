@@ -0,0 +1,289 @@
+import numpy
+import pandas as pd
+
+from indoors import Indoors
+
+"""
+optimizer.py budgets mitigation upgrades across a portfolio of rooms with the model (indoors.py). Every room has a
+grid of candidate upgrades (added outdoor air, a better MERV filter, portable HEPA units and an occupancy cap), each
+with a per-room cost. The optimizer traces the Pareto frontier of total cost against total risk reduction, where the
+risk of a room is the expected number of airborne transmissions during its typical use (Indoors.calc_exp_trans).
+
+All candidates are evaluated in vectorized batches. Each room's candidates are pruned to its own Pareto set and then
+to the lower convex hull of that set; the hull segments of all rooms are merged by their marginal risk reduction per
+unit cost. Each step of the frontier is a real allocation (one candidate per room), and no allocation of the same
+cost has a larger risk reduction than the frontier's convex interpolation at that cost.
+
+Properties:
+Candidate Upgrades
+Costs
+
+Methods:
+def get_option_grid: Get the candidate upgrades as flat arrays (one entry per candidate).
+def get_room_column: Get a per-room input of a range of rooms, shaped to broadcast against candidates.
+def evaluate_options: Evaluate the cost and risk of every candidate upgrade for every room.
+def prune_options: Prune each room's candidates to its Pareto set of cost and risk.
+def calc_lower_hull: Get the lower convex hull of one room's Pareto set.
+def optimize_portfolio: Calculate the Pareto frontier of total cost against total risk reduction.
+def get_allocation: Get the upgrades chosen for each room at a given budget.
+def frontier_to_csv: Export the frontier (or an allocation) to CSV.
+"""
+
+# Candidate Upgrades
+# ach_steps: outdoor air exchange rate increases (/hr), with the recirculation rate held fixed
+# merv_levels: MERV ratings of replacement filters (0 keeps the current filter; lower ratings than the current one are
+#              never installed, and outputs report the installed rating)
+# hepa_units: numbers of portable HEPA units
+# cap_fractions: occupancy caps, as fractions of the room's typical occupancy
+option_ach_steps = [0, 1, 2, 4, 6]
+option_merv_levels = [0, 8, 11, 13, 14, 16]
+option_hepa_units = [0, 1, 2, 3, 4]
+option_cap_fractions = [1, 0.9, 0.75, 0.5]
+
+# Costs
+# Per-room cost keys and their defaults: ach_cost per added ACH, merv_cost per MERV level of upgrade, hepa_cost per
+# portable HEPA unit, cap_cost per person of capacity removed. hepa_cadr is the clean air delivery rate (ft3/min) of
+# one HEPA unit, and uses weighs each room's risk (e.g. uses per week).
+default_costs = {
+    'ach_cost': 500,
+    'merv_cost': 50,
+    'hepa_cost': 400,
+    'hepa_cadr': 300,
+    'cap_cost': 200,
+    'uses': 1,
+}
+default_chunk_size = 500000  # room-candidate evaluations per batch
+
+
+# Get the candidate upgrades as a dictionary of flat arrays, one entry per combination of the given levels.
+# The first candidate is always "no upgrade".
+def get_option_grid(ach_steps=None, merv_levels=None, hepa_units=None, cap_fractions=None):
+    levels = [option_ach_steps if ach_steps is None else ach_steps,
+              option_merv_levels if merv_levels is None else merv_levels,
+              option_hepa_units if hepa_units is None else hepa_units,
+              option_cap_fractions if cap_fractions is None else cap_fractions]
+    if 0 not in levels[0] or 0 not in levels[1] or 0 not in levels[2] or 1 not in levels[3]:
+        raise ValueError("Candidate levels must include no upgrade (0 ACH, MERV 0, 0 HEPA units, cap fraction 1)")
+    # Put the "no upgrade" level of each lever first
+    levels = [sorted(levels[0]), sorted(levels[1]), sorted(levels[2]), sorted(levels[3], reverse=True)]
+    grid = numpy.meshgrid(*levels, indexing='ij')
+    return {
+        'ach_increase': grid[0].ravel().astype(float),
+        'merv': grid[1].ravel().astype(float),
+        'hepa_units': grid[2].ravel().astype(float),
+        'cap_fraction': grid[3].ravel().astype(float),
+    }
+
+
+# Returns a per-room column of the given cost (or other per-room input) for rooms[room_slice]
+def get_room_column(value, room_slice):
+    if numpy.ndim(value) == 0:
+        return value
+    return numpy.asarray(value)[room_slice, numpy.newaxis]
+
+
+# Evaluate the cost and risk of every candidate upgrade (see get_option_grid) for every room.
+# rooms_model: batch model with one entry per room (see Indoors.copy_with_params)
+# merv: current MERV rating of each room, n_max: typical occupancy, exp_time: typical exposure time (hours)
+# costs: dictionary of per-room costs (arrays or scalars, see default_costs)
+# Returns the cost and risk (expected transmissions, weighted by uses), both indexed by [room, candidate].
+def evaluate_options(rooms_model, merv, n_max, exp_time, costs, options, risk_type='conditional',
+                     chunk_size=default_chunk_size):
+    costs = dict(default_costs, **costs)
+    n_rooms = len(numpy.atleast_1d(n_max))
+    n_options = len(options['merv'])
+    merv = numpy.broadcast_to(merv, (n_rooms,))
+    n_max = numpy.broadcast_to(n_max, (n_rooms,))
+    exp_time = numpy.broadcast_to(exp_time, (n_rooms,))
+    aerosol_radius = rooms_model.physio_params[1]
+
+    cost = numpy.empty((n_rooms, n_options))
+    risk = numpy.empty((n_rooms, n_options))
+    rooms_per_chunk = max(chunk_size // n_options, 1)
+    for start in range(0, n_rooms, rooms_per_chunk):
+        room_slice = slice(start, min(start + rooms_per_chunk, n_rooms))
+        params = rooms_model.get_room_params(room_slice)
+        floor_area = params.get('floor_area', rooms_model.physical_params[0])
+        ceiling_height = params.get('mean_ceiling_height', rooms_model.physical_params[1])
+        air_exch_rate = params.get('air_exch_rate', rooms_model.physical_params[2])
+        outdoor_air_fraction = params.get('primary_outdoor_air_fraction', rooms_model.physical_params[3])
+        filtration_eff = params.get('aerosol_filtration_eff', rooms_model.physical_params[4])
+        room_merv = merv[room_slice, numpy.newaxis]
+        room_n_max = n_max[room_slice, numpy.newaxis]
+
+        # Outdoor air: added ACH, with the recirculation rate (/hr) held fixed
+        recirc_ach = air_exch_rate * (1 / outdoor_air_fraction - 1)
+        new_air_exch_rate = air_exch_rate + options['ach_increase']
+
+        # Filtration: a better filter only replaces the current one if it has a higher MERV rating
+        upgrade_merv = options['merv'] > room_merv
+        new_filtration_eff = numpy.where(upgrade_merv, Indoors.merv_to_eff_array(options['merv'], aerosol_radius),
+                                         filtration_eff)
+
+        # Portable HEPA units add their clean air delivery rate to the filtered recirculation, so the combined
+        # recirculation keeps the model's filtration rate (efficiency * recirculation ACH) exact
+        hepa_ach = options['hepa_units'] * get_room_column(costs['hepa_cadr'], room_slice) * 60 / (
+                floor_area * ceiling_height)
+        new_recirc_ach = recirc_ach + hepa_ach
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            new_filtration_eff = numpy.where(new_recirc_ach > 0,
+                                             (new_filtration_eff * recirc_ach + hepa_ach) / new_recirc_ach,
+                                             new_filtration_eff)
+
+        # Occupancy caps: whole people, at least one
+        new_n_max = numpy.maximum(numpy.floor(room_n_max * options['cap_fraction']), 1)
+
+        params.update(air_exch_rate=new_air_exch_rate,
+                      primary_outdoor_air_fraction=new_air_exch_rate / (new_air_exch_rate + new_recirc_ach),
+                      aerosol_filtration_eff=new_filtration_eff)
+        option_model = rooms_model.copy_with_params(**params)
+        risk[room_slice] = get_room_column(costs['uses'], room_slice) * option_model.calc_exp_trans(
+            new_n_max, exp_time[room_slice, numpy.newaxis], risk_type)
+        cost[room_slice] = (get_room_column(costs['ach_cost'], room_slice) * options['ach_increase'] +
+                            get_room_column(costs['merv_cost'], room_slice) * upgrade_merv * (
+                                    options['merv'] - room_merv) +
+                            get_room_column(costs['hepa_cost'], room_slice) * options['hepa_units'] +
+                            get_room_column(costs['cap_cost'], room_slice) * (room_n_max - new_n_max))
+
+    return cost, risk
+
+
+# Prune each room's candidates to its Pareto set: sorted by cost, keeping only candidates that strictly lower the risk
+# of every cheaper candidate. Vectorized across rooms.
+# Returns the room, candidate, cost and risk of every kept candidate, grouped by room and sorted by cost.
+def prune_options(cost, risk):
+    order = numpy.lexsort((risk, cost))
+    sorted_cost = numpy.take_along_axis(cost, order, axis=1)
+    sorted_risk = numpy.take_along_axis(risk, order, axis=1)
+    prev_min_risk = numpy.minimum.accumulate(sorted_risk, axis=1)
+    prev_min_risk = numpy.concatenate((numpy.full((len(risk), 1), numpy.inf), prev_min_risk[:, :-1]), axis=1)
+    keep = sorted_risk < prev_min_risk
+
+    room, rank = numpy.nonzero(keep)
+    return room, order[room, rank], sorted_cost[room, rank], sorted_risk[room, rank]
+
+
+# Get the lower convex hull (indices into the given arrays) of one room's Pareto set, sorted by cost. Along the hull,
+# the risk reduction per unit cost strictly decreases.
+def calc_lower_hull(cost, risk):
+    hull = []
+    for index in range(len(cost)):
+        while len(hull) >= 2:
+            first, second = hull[-2], hull[-1]
+            cross = ((cost[second] - cost[first]) * (risk[index] - risk[first]) -
+                     (risk[second] - risk[first]) * (cost[index] - cost[first]))
+            if cross > 0:
+                break
+            hull.pop()
+        hull.append(index)
+    return hull
+
+
+# Calculate the Pareto frontier of total cost against total risk reduction across a portfolio of rooms.
+# See evaluate_options for the inputs; options defaults to get_option_grid().
+# Returns a dictionary with
+#     'frontier': DataFrame with one row per step (row 0 is the cheapest allocation), giving the total cost, total risk,
+#                 risk reduction, and the room upgraded at that step with its new upgrades, cost and risk
+#     'options': the candidate grid, and 'merv': the current MERV rating of each room
+#     'start_option', 'start_cost', 'start_risk', 'baseline_risk': per-room arrays for the cheapest allocation and for
+#                 no upgrades at all
+def optimize_portfolio(rooms_model, merv, n_max, exp_time, costs, options=None, risk_type='conditional',
+                       chunk_size=default_chunk_size):
+    if options is None:
+        options = get_option_grid()
+    cost, risk = evaluate_options(rooms_model, merv, n_max, exp_time, costs, options, risk_type, chunk_size)
+    if numpy.any(cost < 0):
+        raise ValueError("Upgrade costs must not be negative")
+    room, option, option_cost, option_risk = prune_options(cost, risk)
+
+    # Convex hull segments of every room, merged by marginal risk reduction per unit cost
+    n_rooms = len(cost)
+    room_starts = numpy.searchsorted(room, numpy.arange(n_rooms + 1))
+    start_index = room_starts[:-1]
+    step_rooms = []
+    step_indices = []
+    for room_index in range(n_rooms):
+        first, last = room_starts[room_index], room_starts[room_index + 1]
+        hull = calc_lower_hull(option_cost[first:last], option_risk[first:last])
+        step_rooms.extend([room_index] * (len(hull) - 1))
+        step_indices.extend(first + index for index in hull[1:])
+    step_rooms = numpy.array(step_rooms, dtype=int)
+    step_indices = numpy.array(step_indices, dtype=int)
+    prev_indices = numpy.concatenate(([-1], step_indices[:-1]))
+    prev_indices = numpy.where(numpy.concatenate(([False], step_rooms[1:] == step_rooms[:-1])), prev_indices,
+                               start_index[step_rooms])
+    delta_cost = option_cost[step_indices] - option_cost[prev_indices]
+    delta_risk = option_risk[prev_indices] - option_risk[step_indices]
+    step_order = numpy.lexsort((step_indices, -delta_risk / delta_cost))
+    step_rooms = step_rooms[step_order]
+    step_indices = step_indices[step_order]
+
+    baseline_risk = risk[:, 0]
+    start_cost = option_cost[start_index]
+    start_risk = option_risk[start_index]
+    total_cost = start_cost.sum() + numpy.concatenate(([0], numpy.cumsum(delta_cost[step_order])))
+    total_risk = start_risk.sum() - numpy.concatenate(([0], numpy.cumsum(delta_risk[step_order])))
+    step_options = numpy.concatenate(([0], option[step_indices]))
+    frontier = pd.DataFrame({
+        'cost': total_cost,
+        'risk': total_risk,
+        'risk_reduction': baseline_risk.sum() - total_risk,
+        'room': numpy.concatenate(([-1], step_rooms)),
+        'ach_increase': options['ach_increase'][step_options],
+        'merv': options['merv'][step_options],
+        'hepa_units': options['hepa_units'][step_options],
+        'cap_fraction': options['cap_fraction'][step_options],
+        'room_cost': numpy.concatenate(([0], option_cost[step_indices])),
+        'room_risk': numpy.concatenate(([0], option_risk[step_indices])),
+    })
+    frontier.loc[0, ['ach_increase', 'merv', 'hepa_units', 'cap_fraction']] = numpy.nan
+    merv = numpy.broadcast_to(merv, (n_rooms,))
+    frontier.loc[1:, 'merv'] = numpy.maximum(frontier['merv'].to_numpy()[1:], merv[step_rooms])
+
+    return {
+        'frontier': frontier,
+        'options': options,
+        'merv': merv,
+        'start_option': option[start_index],
+        'start_cost': start_cost,
+        'start_risk': start_risk,
+        'baseline_risk': baseline_risk,
+    }
+
+
+# Get the upgrades chosen for each room when the frontier is followed up to the given total budget.
+# Returns a DataFrame with one row per room.
+def get_allocation(result, budget):
+    frontier = result['frontier']
+    steps = frontier.iloc[1:]
+    steps = steps[steps['cost'] <= budget]
+    chosen_option = result['start_option'].copy()
+    room_cost = result['start_cost'].copy()
+    room_risk = result['start_risk'].copy()
+
+    last_steps = steps.drop_duplicates('room', keep='last')
+    rooms = last_steps['room'].to_numpy()
+    room_cost[rooms] = last_steps['room_cost'].to_numpy()
+    room_risk[rooms] = last_steps['room_risk'].to_numpy()
+    options = result['options']
+    allocation = pd.DataFrame({
+        'room': numpy.arange(len(chosen_option)),
+        'ach_increase': options['ach_increase'][chosen_option],
+        'merv': numpy.maximum(options['merv'][chosen_option], result['merv']),
+        'hepa_units': options['hepa_units'][chosen_option],
+        'cap_fraction': options['cap_fraction'][chosen_option],
+        'cost': room_cost,
+        'risk': room_risk,
+        'baseline_risk': result['baseline_risk'],
+    })
+    allocation.loc[rooms, ['ach_increase', 'merv', 'hepa_units', 'cap_fraction']] = \
+        last_steps[['ach_increase', 'merv', 'hepa_units', 'cap_fraction']].to_numpy()
+    return allocation
+
+
+# Export the frontier of an optimize_portfolio result (or, if a budget is given, the allocation at that budget) to
+# CSV. Returns the CSV text if path_or_buf is None, as pandas does.
+def frontier_to_csv(result, path_or_buf=None, budget=None):
+    if budget is None:
+        return result['frontier'].to_csv(path_or_buf, index=False)
+    return get_allocation(result, budget).to_csv(path_or_buf, index=False)
@@ -0,0 +1,194 @@
+import json
+
+import dash.development.base_component
+import plotly.utils
+
+from app import app
+import index
+from apps import default, advanced
+import essentials as ess
+
+"""
+payloads.py builds the requests the Dash renderer sends to /_dash-update-component, from the callbacks registered on
+the app (app.callback_map) and the values in the page layouts, so callbacks can be exercised through the Flask
+server as a browser would (see benchmark.py and loadtest.py).
+
+A session replays user actions on a page, like the renderer: the callbacks that take a changed property as an input
+are called, their responses update the page values, and callbacks taking the properties they changed are called in
+turn. Every request made is recorded, to be replayed later.
+
+Properties:
+Pages
+Session Actions
+
+Methods:
+def get_layout_values: Get the property values of every component in a layout.
+def get_page_values: Get the property values of a page as first loaded.
+def get_callback_key: Get the callback_map key of the callback with an output.
+def get_page_callbacks: Get the callbacks whose outputs, inputs and states are all on a page.
+def make_payload: Build the request body of one callback call.
+def apply_response: Update page values from a callback response.
+def post_payload: Send a request body to the server.
+def run_session: Replay user actions on a page, recording every request made.
+def get_session_actions: Get the user actions of a realistic session on a page.
+"""
+
+# Pages
+page_layouts = {'basic': default.layout, 'advanced': advanced.layout}
+page_paths = {'basic': '/', 'advanced': '/apps/advanced'}
+page_prefixes = {'basic': '', 'advanced': 'adv-'}  # of the ids of the page's components
+update_path = '/_dash-update-component'
+base_url = 'https://localhost'  # the server redirects plain http to https (see app.py)
+default_window_width = 1300
+
+# Session Actions
+# Languages switched between, room and human behavior presets changed to, and slider positions dragged over
+session_languages = ['en', 'fr', 'hi', 'hu', 'sv']
+session_sliders = {
+    'relative-humidity': [0.3, 0.4, 0.5, 0.6, 0.7, 0.8],
+    'mask-fit': [0.5, 0.6, 0.7, 0.8, 0.9, 0.95],
+}
+max_waves = 10  # rounds of chained callbacks followed per action
+
+
+# Returns the property values of every component with an id in a layout, as a dictionary of (id, property) to value
+# (every component has its 'id', so components without set properties are found too)
+def get_layout_values(layout, values=None):
+    if values is None:
+        values = {}
+    if isinstance(layout, (list, tuple)):
+        for child in layout:
+            get_layout_values(child, values)
+    elif isinstance(layout, dash.development.base_component.Component):
+        component_id = getattr(layout, 'id', None)
+        if isinstance(component_id, str):
+            values[component_id, 'id'] = component_id
+            for prop in layout._prop_names:
+                if prop != 'id' and hasattr(layout, prop):
+                    values[component_id, prop] = getattr(layout, prop)
+        get_layout_values(getattr(layout, 'children', None), values)
+    return values
+
+
+# Returns the property values of a page ('basic' or 'advanced') as first loaded with the given URL search string
+def get_page_values(mode, search='', window_width=default_window_width):
+    values = get_layout_values(index.app.layout)
+    get_layout_values(page_layouts[mode], values)
+    values['url', 'pathname'] = page_paths[mode]
+    values['url', 'search'] = search
+    values['url-read', 'search'] = search
+    values['window-width', 'children'] = str(window_width)
+    return values
+
+
+# Returns the callback_map key of the callback with the given output ('id.property')
+def get_callback_key(output):
+    for key in app.callback_map:
+        if output in key.strip('.').split('...'):
+            return key
+    raise KeyError(output)
+
+
+# Returns the callback_map keys of the server callbacks whose outputs, inputs and states are all on the page (given
+# its values)
+def get_page_callbacks(values):
+    component_ids = {component_id for component_id, _ in values}
+    keys = []
+    for key, callback in app.callback_map.items():
+        if 'callback' not in callback or '{' in key:
+            continue  # clientside or pattern-matching
+        outputs = [output.rsplit('.', 1)[0] for output in key.strip('.').split('...')]
+        dependencies = [dependency['id'] for dependency in callback['inputs'] + callback['state']]
+        if all(component_id in component_ids for component_id in outputs + dependencies):
+            keys.append(key)
+    return keys
+
+
+# Returns the request body of a call of the callback (a callback_map key) with the given page values, triggered by
+# the changed properties ('id.property')
+def make_payload(key, values, changed=()):
+    callback = app.callback_map[key]
+    outputs = [dict(zip(['id', 'property'], output.rsplit('.', 1))) for output in key.strip('.').split('...')]
+    return {
+        'output': key,
+        'outputs': outputs if key.startswith('..') else outputs[0],
+        'inputs': [dict(dependency, value=values.get((dependency['id'], dependency['property'])))
+                   for dependency in callback['inputs']],
+        'state': [dict(dependency, value=values.get((dependency['id'], dependency['property'])))
+                  for dependency in callback['state']],
+        'changedPropIds': list(changed),
+    }
+
+
+# Update the page values from a callback response (its JSON text). Returns the properties ('id.property') whose
+# values changed.
+def apply_response(values, response_text):
+    if not response_text:
+        return []  # PreventUpdate
+    changed = []
+    for component_id, props in json.loads(response_text)['response'].items():
+        for prop, value in props.items():
+            if values.get((component_id, prop)) != value:
+                values[component_id, prop] = value
+                changed.append('{}.{}'.format(component_id, prop))
+    return changed
+
+
+# Send a request body to the server (a Flask test client) and return the response
+def post_payload(client, payload):
+    return client.post(update_path, data=json.dumps(payload, cls=plotly.utils.PlotlyJSONEncoder),
+                       content_type='application/json', base_url=base_url)
+
+
+# Replay user actions on a page through the server (a Flask test client), as the renderer would. The page first loads
+# (every callback is called), then each action (a dictionary of (id, property) to value) sets its values and the
+# callbacks depending on them are called, following chained callbacks. Returns the recorded requests: a list of
+# (action index, -1 for the page load, callback key, request body).
+def run_session(client, mode, actions, search=''):
+    values = get_page_values(mode, search)
+    keys = get_page_callbacks(values)
+    recorded = []
+
+    def run_wave(action_index, triggered_keys, changed):
+        wave_changed = []
+        for key in triggered_keys:
+            callback = app.callback_map[key]
+            inputs = {'{}.{}'.format(dependency['id'], dependency['property']) for dependency in callback['inputs']}
+            payload = make_payload(key, values, [prop for prop in changed if prop in inputs])
+            recorded.append((action_index, key, payload))
+            response = post_payload(client, payload)
+            if response.status_code == 200:
+                wave_changed += apply_response(values, response.get_data(as_text=True))
+        return wave_changed
+
+    def run_chain(action_index, changed):
+        for _ in range(max_waves):
+            if len(changed) == 0:
+                break
+            triggered_keys = [key for key in keys if any(
+                '{}.{}'.format(dependency['id'], dependency['property']) in changed
+                for dependency in app.callback_map[key]['inputs'])]
+            changed = run_wave(action_index, triggered_keys, changed)
+
+    run_chain(-1, run_wave(-1, keys, []))
+    for action_index, action in enumerate(actions):
+        changed = []
+        for (component_id, prop), value in action.items():
+            if values.get((component_id, prop)) != value:
+                values[component_id, prop] = value
+                changed.append('{}.{}'.format(component_id, prop))
+        run_chain(action_index, changed)
+    return recorded
+
+
+# Returns the user actions of a realistic session on a page ('basic' or 'advanced'): changing to each room and human
+# behavior preset, dragging the sliders, and switching between languages
+def get_session_actions(mode):
+    prefix = page_prefixes[mode]
+    actions = [{(prefix + 'presets', 'value'): preset} for preset in ess.room_preset_settings]
+    actions += [{(prefix + 'presets-human', 'value'): preset} for preset in ess.human_preset_settings]
+    for slider, positions in session_sliders.items():
+        actions += [{(prefix + slider, 'value'): position} for position in positions]
+    actions += [{('url', 'search'): '' if language == 'en' else '?lang=' + language}
+                for language in session_languages[1:] + session_languages[:1]]
+    return actions
@@ -0,0 +1,250 @@
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+import plotly
+import plotly.utils
+
+"""
+presets.py precomputes the outputs of Basic Mode (apps/default.py def update_figure) for every combination of the
+built-in presets: room (essentials.py room_preset_settings), human behavior (human_preset_settings), age group and
+viral strain (descriptions.py presets_age and presets_strain), with the default occupancy and exposure time, in both
+unit systems and every enabled language. They are stored in a compact on-disk table, so update_figure serves these
+combinations, its most common requests, without running the model or building the figure.
+
+The table is a SQLite file (PRESET_TABLE environment variable, preset_results.db by default) of the outputs of each
+combination as JSON, compressed with a dictionary shared by all entries (the figure template and texts repeat across
+entries). It records a signature of the code and library versions it was built with, and is only used while these
+match, so a stale table is ignored rather than serving outdated outputs. It is built by running this file, which
+bin/post_compile does when the app is built on Heroku, and loaded into memory once per server (see warmup.py, and
+gunicorn.conf.py, which warns when there is no current table).
+
+Usage: python presets.py [--processes N]
+
+Properties:
+Preset Table Settings
+Preset Combinations
+
+Methods:
+def get_signature: Get the signature of the code and versions the outputs depend on.
+def get_preset_table_path: Get the path of the table.
+def get_preset_key: Get the table key of Basic Mode inputs, if they are a preset combination.
+def get_combinations: Get every preset combination.
+def calc_preset_outputs: Calculate the outputs of one preset combination.
+def calc_preset_outputs_batch: Calculate the outputs of several preset combinations.
+def build_preset_table: Calculate every preset combination and write the table.
+def load_preset_table: Load the table into memory.
+def get_preset_outputs: Look up the outputs of Basic Mode inputs in the table.
+"""
+
+# Preset Table Settings
+env_preset_table = 'PRESET_TABLE'
+default_preset_table = 'preset_results.db'
+compression_level = 9
+max_dictionary_size = 32768  # bytes, the most zlib uses
+# Files whose code the outputs depend on (with the plotly and dash versions, see get_signature)
+signature_files = ['indoors.py', 'essentials.py', 'presets.py', os.path.join('apps', 'default.py')]
+
+# Preset Combinations
+table_units = ['british', 'metric']
+default_n_max = 10  # the occupancy and exposure time Basic Mode opens with (see apps/default.py layout)
+default_exp_time = 4  # hours
+
+schema = """
+CREATE TABLE IF NOT EXISTS preset_meta (
+    name TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS preset_outputs (
+    room TEXT NOT NULL,
+    human TEXT NOT NULL,
+    age REAL NOT NULL,
+    strain REAL NOT NULL,
+    units TEXT NOT NULL,
+    language TEXT NOT NULL,
+    outputs BLOB NOT NULL,
+    PRIMARY KEY (room, human, age, strain, units, language)
+) WITHOUT ROWID;
+"""
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The table in memory: its compression dictionary and compressed outputs by key (see load_preset_table), or None if
+# there is no usable table
+preset_table = None
+preset_table_lock = threading.Lock()
+preset_table_loaded = False
+
+
+# Returns the signature of what the precomputed outputs depend on: the code of signature_files and of the description
+# modules, and the plotly and dash versions
+def get_signature():
+    import dash
+    digest = hashlib.sha1()
+    file_names = signature_files + sorted(file_name for file_name in os.listdir(repo_dir)
+                                          if file_name.startswith('descriptions') and file_name.endswith('.py'))
+    for file_name in file_names:
+        with open(os.path.join(repo_dir, file_name), 'rb') as source:
+            digest.update(file_name.encode() + b'\0' + source.read() + b'\0')
+    digest.update('plotly {} dash {}'.format(plotly.__version__, dash.__version__).encode())
+    return digest.hexdigest()
+
+
+# Returns the path of the table: the PRESET_TABLE environment variable, or preset_results.db in the repository
+def get_preset_table_path():
+    return os.environ.get(env_preset_table) or os.path.join(repo_dir, default_preset_table)
+
+
+# Returns the table key (room, human, age, strain, units, language) of Basic Mode inputs, or None if they are not a
+# precomputed combination. room_preset and human_preset are the preset dropdown values the inputs match.
+def get_preset_key(room_preset, human_preset, sr_age_factor, sr_strain_factor, n_max_input, exp_time_input, units,
+                   language):
+    if room_preset == 'custom' or human_preset == 'custom' or units not in table_units:
+        return None
+    if n_max_input != default_n_max or exp_time_input != default_exp_time:
+        return None
+    return room_preset, human_preset, float(sr_age_factor), float(sr_strain_factor), units, language
+
+
+# Returns every preset combination: a list of (room, human, age, strain, units, language)
+def get_combinations():
+    import descriptions as desc
+    import essentials as ess
+    import warmup
+    return list(itertools.product(ess.room_preset_settings, ess.human_preset_settings,
+                                  [float(option['value']) for option in desc.presets_age],
+                                  [float(option['value']) for option in desc.presets_strain],
+                                  table_units, warmup.get_enabled_languages()))
+
+
+# Returns the outputs of Basic Mode's update_figure for one preset combination (a table key), as JSON
+def calc_preset_outputs(key):
+    import essentials as ess
+    from apps import default
+    room, human, age, strain, units, language = key
+    room_settings = ess.room_preset_settings[room]
+    human_settings = ess.human_preset_settings[human]
+    if units == 'british':
+        floor_area, ceiling_height = room_settings['floor-area'], room_settings['ceiling-height']
+    else:
+        floor_area = round(room_settings['floor-area-metric'], 2)
+        ceiling_height = round(room_settings['ceiling-height-metric'], 2)
+    search_terms = (['units=metric'] if units == 'metric' else []) + (['lang=' + language] if language != 'en' else [])
+    search = '?' + '&'.join(search_terms) if search_terms else ''
+    # No unit texts: the units are not being switched
+    outputs = default.update_figure.__wrapped__(
+        floor_area, ceiling_height, room_settings['ventilation'], room_settings['recirc-rate'],
+        room_settings['filtration'], room_settings['rh'], human_settings['exertion'], human_settings['expiratory'],
+        human_settings['masks'], human_settings['mask-fit'], age, strain, default_n_max, default_exp_time, search,
+        None, None)
+    return json.dumps(list(outputs), cls=plotly.utils.PlotlyJSONEncoder)
+
+
+# Calculates the outputs of the given preset combinations (in a building process, where update_figure must not look
+# them up in an existing table)
+def calc_preset_outputs_batch(keys):
+    global preset_table, preset_table_loaded
+    preset_table, preset_table_loaded = None, True
+    return [calc_preset_outputs(key) for key in keys]
+
+
+# Calculate every preset combination, in parallel processes, and write the table to path (replacing it). Returns the
+# number of combinations.
+def build_preset_table(path, processes=None):
+    keys = get_combinations()
+    processes = processes or os.cpu_count() or 1
+    batches = [keys[index::processes * 4] for index in range(processes * 4)]
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            batch_outputs = pool.map(calc_preset_outputs_batch, batches)
+    else:
+        batch_outputs = [calc_preset_outputs_batch(batch) for batch in batches]
+    outputs = {key: batch_output for batch, batch_result in zip(batches, batch_outputs)
+               for key, batch_output in zip(batch, batch_result)}
+
+    # The first entry of each language as the compression dictionary: entries share its template and most texts
+    first_keys = {}
+    for key in keys:
+        first_keys.setdefault(key[-1], key)
+    dictionary = ''.join(outputs[key] for key in first_keys.values()).encode()[-max_dictionary_size:]
+    rows = []
+    for key in keys:
+        compressor = zlib.compressobj(compression_level, zdict=dictionary)
+        rows.append(key + (compressor.compress(outputs[key].encode()) + compressor.flush(),))
+
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+    with sqlite3.connect(path + '.tmp') as connection:
+        connection.executescript(schema)
+        connection.executemany('INSERT INTO preset_meta VALUES (?, ?)',
+                               [('signature', get_signature().encode()), ('dictionary', dictionary),
+                                ('built', str(time.time()).encode())])
+        connection.executemany('INSERT INTO preset_outputs VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    connection.close()
+    os.replace(path + '.tmp', path)
+    return len(keys)
+
+
+# Loads the table at the path in the PRESET_TABLE environment variable (preset_results.db by default) into memory, if
+# it exists and was built from the current code (see get_signature); otherwise lookups find nothing. Returns the
+# number of combinations loaded.
+def load_preset_table():
+    global preset_table, preset_table_loaded
+    path = get_preset_table_path()
+    table = None
+    if os.path.exists(path):
+        connection = sqlite3.connect(path)
+        try:
+            meta = dict(connection.execute('SELECT name, value FROM preset_meta'))
+            if meta.get('signature', b'').decode() == get_signature():
+                table = (meta['dictionary'], {tuple(row[:6]): row[6] for row in connection.execute(
+                    'SELECT room, human, age, strain, units, language, outputs FROM preset_outputs')})
+        except sqlite3.Error:
+            table = None
+        finally:
+            connection.close()
+    with preset_table_lock:
+        preset_table = table
+        preset_table_loaded = True
+    return 0 if table is None else len(table[1])
+
+
+# Returns the precomputed outputs of Basic Mode's update_figure for its inputs (see get_preset_key), or None if they
+# are not in the table. The table is loaded on first use if warmup has not loaded it.
+def get_preset_outputs(room_preset, human_preset, sr_age_factor, sr_strain_factor, n_max_input, exp_time_input,
+                       units, language):
+    key = get_preset_key(room_preset, human_preset, sr_age_factor, sr_strain_factor, n_max_input, exp_time_input,
+                         units, language)
+    if key is None:
+        return None
+    if not preset_table_loaded:
+        load_preset_table()
+    table = preset_table
+    if table is None or key not in table[1]:
+        return None
+    decompressor = zlib.decompressobj(zdict=table[0])
+    return json.loads(decompressor.decompress(table[1][key]) + decompressor.flush())
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+    sys.path.insert(0, repo_dir)
+    os.environ.setdefault('SCENARIO_DB', os.path.join(tempfile.gettempdir(), 'presets_scenarios.db'))
+
+    parser = argparse.ArgumentParser(description="Precompute Basic Mode's outputs for every preset combination.")
+    parser.add_argument('--processes', type=int, default=None, help='parallel processes (default: one per CPU)')
+    args = parser.parse_args()
+    build_start = time.perf_counter()
+    import presets  # the module apps/default.py uses, rather than this script's copy
+    table_path = presets.get_preset_table_path()
+    count = presets.build_preset_table(table_path, args.processes)
+    print('Precomputed {} preset combinations in {:.1f} s: {} ({:.1f} MiB)'.format(
+        count, time.perf_counter() - build_start, table_path, os.path.getsize(table_path) / 2 ** 20))
@@ -0,0 +1,261 @@
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+import flask
+
+from app import app
+import memory
+import metrics
+
+"""
+profiling.py profiles Dash callback requests on the running server with cProfile, so a slow scenario can be examined
+where it is slow. It is off unless the PROFILE_TOKEN environment variable is set, and every profiling endpoint
+requires that token (in the X-Profile-Token header, or the token query parameter).
+
+A callback request is profiled when it carries the token (X-Profile-Token header), or at random with the probability
+in the PROFILE_RATE environment variable (e.g. 0.01 to profile 1% of requests in production; 0 by default). The
+PROFILE_CALLBACKS environment variable limits random profiling to some callbacks (comma-separated names, see
+metrics.py def get_callback_name). One request is profiled at a time per worker: a request arriving while another is
+profiled is served normally.
+
+Profiles are stored in the PROFILE_DIR directory (profiles by default) as pstats files, with a JSON file describing the
+request; the oldest are removed beyond max_profiles. They are listed at /profiles, and each can be downloaded as a
+pstats file (for pstats, snakeviz) or in the collapsed stack format read by flamegraph.pl and speedscope. The memory of
+the worker answering is reported at /memory (see memory.py).
+
+Properties:
+Profiling Settings
+
+Methods:
+def get_profile_settings: Get the profiling settings from the environment.
+def is_authorized: Check the profiling token of a request.
+def get_profile_dir: Get the directory profiles are stored in.
+def start_profile: Flask before_request hook starting the profile of a callback request.
+def save_profile: Flask after_request hook stopping and storing a profile.
+def remove_old_profiles: Remove the oldest profiles beyond max_profiles.
+def get_collapsed_stacks: Convert a profile to collapsed stacks.
+def list_profiles: GET /profiles - Stored profiles, newest first
+def get_profile: GET /profiles/<name> - A stored profile as a pstats file
+def get_profile_collapsed: GET /profiles/<name>/collapsed - A stored profile as collapsed stacks
+def get_memory: GET /memory - RSS and top allocators of the worker answering
+"""
+
+# Profiling Settings
+env_token = 'PROFILE_TOKEN'
+env_rate = 'PROFILE_RATE'
+env_callbacks = 'PROFILE_CALLBACKS'
+env_profile_dir = 'PROFILE_DIR'
+default_profile_dir = 'profiles'
+token_header = 'X-Profile-Token'
+max_profiles = 200  # profiles kept per directory
+max_stack_depth = 200  # frames followed in collapsed stacks
+min_stack_time = 1e-6  # seconds; shorter calls are left out of collapsed stacks
+profile_name_pattern = re.compile(r'^[\w.-]+$')
+
+# One profile at a time per worker (cProfile cannot run twice at once)
+profile_lock = threading.Lock()
+profile_count = 0
+
+
+# Returns the profiling settings from the environment: the token (None if profiling is off), the rate of random
+# profiling and the callbacks profiled at random (None for all)
+def get_profile_settings():
+    token = os.environ.get(env_token) or None
+    try:
+        rate = min(max(float(os.environ.get(env_rate, 0)), 0), 1)
+    except ValueError:
+        rate = 0
+    callbacks = os.environ.get(env_callbacks)
+    callbacks = {name.strip() for name in callbacks.split(',') if name.strip()} if callbacks else None
+    return token, rate, callbacks
+
+
+# Returns whether the current request carries the profiling token (never if profiling is off)
+def is_authorized():
+    token = get_profile_settings()[0]
+    given = flask.request.headers.get(token_header) or flask.request.args.get('token')
+    return token is not None and given is not None and hmac.compare_digest(given.encode(), token.encode())
+
+
+# Returns the directory profiles are stored in: the PROFILE_DIR environment variable, or profiles
+def get_profile_dir():
+    return os.environ.get(env_profile_dir) or default_profile_dir
+
+
+# Starts profiling a Dash callback request if it carries the token, or is drawn at random (a Flask before_request hook)
+@app.server.before_request
+def start_profile():
+    if flask.request.path != metrics.update_path:
+        return
+    token, rate, callbacks = get_profile_settings()
+    if token is None:
+        return
+    requested = is_authorized()
+    if not requested:
+        if rate == 0 or random.random() >= rate:
+            return
+        if callbacks is not None:
+            body = flask.request.get_json(silent=True)
+            if not isinstance(body, dict) or metrics.get_callback_name(body.get('output')) not in callbacks:
+                return
+    if not profile_lock.acquire(blocking=False):
+        return  # another request is being profiled
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        profile_lock.release()  # another profiler (e.g. a debugger's) is active
+        return
+    flask.g.profile = (profiler, time.time(), time.perf_counter(), requested)
+
+
+# Stops the profile of a request, if it was profiled, and stores it with a description of the request (a Flask
+# after_request hook)
+@app.server.after_request
+def save_profile(response):
+    global profile_count
+    profile = flask.g.pop('profile', None)
+    if profile is None:
+        return response
+    profiler, started, start, requested = profile
+    try:
+        profiler.disable()
+        wall = time.perf_counter() - start
+        body = flask.request.get_json(silent=True)
+        callback = metrics.get_callback_name(body.get('output')) if isinstance(body, dict) else 'unknown'
+        profile_count += 1
+        name = '{}-{}-{}-{}'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime(started)), os.getpid(),
+                                    profile_count, callback)
+        profile_dir = get_profile_dir()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, name + '.prof'))
+        with open(os.path.join(profile_dir, name + '.json'), 'w') as info_file:
+            json.dump({'name': name, 'callback': callback, 'time': started, 'seconds': wall,
+                       'status': response.status_code, 'requested': requested}, info_file)
+        remove_old_profiles(profile_dir)
+    except OSError:
+        pass  # profiling must not fail the request
+    finally:
+        profile_lock.release()
+    return response
+
+
+# Remove the oldest profiles of a directory beyond max_profiles
+def remove_old_profiles(profile_dir):
+    names = sorted((os.path.getmtime(os.path.join(profile_dir, file_name)), file_name[:-len('.json')])
+                   for file_name in os.listdir(profile_dir) if file_name.endswith('.json'))
+    for _, name in names[:-max_profiles]:
+        for extension in ['.json', '.prof']:
+            try:
+                os.remove(os.path.join(profile_dir, name + extension))
+            except OSError:
+                pass
+
+
+# Returns a profile (a pstats.Stats) as collapsed stacks: one line per call stack, its functions from the outermost
+# separated by ';', followed by the time spent in the innermost function (microseconds). cProfile records callers
+# rather than whole stacks, so the time of a function called from several places is split among them in proportion
+# to the time of each call site, as flame graph tools for cProfile do.
+def get_collapsed_stacks(stats):
+    entries = stats.stats  # function: (primitive calls, calls, own time, cumulative time, callers)
+    callees = {}
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(function)
+
+    def get_label(function):
+        file_name, line, function_name = function
+        if file_name == '~':
+            return function_name  # built-in
+        return '{}:{}:{}'.format(os.path.basename(file_name), function_name, line)
+
+    totals = {}
+
+    def walk(function, stack, ratio):
+        stack = stack + [get_label(function)]
+        own_time = entries[function][2] * ratio
+        if own_time > 0:
+            key = ';'.join(stack)
+            totals[key] = totals.get(key, 0) + own_time
+        if len(stack) >= max_stack_depth:
+            return
+        for callee in callees.get(function, []):
+            if get_label(callee) in stack:
+                continue  # recursion: its time is counted at its outermost call
+            call_time = entries[callee][4][function][3] * ratio  # of the calls from this stack
+            if call_time >= min_stack_time:
+                walk(callee, stack, call_time / entries[callee][3])
+
+    for function, entry in entries.items():
+        if len(entry[4]) == 0:
+            walk(function, [], 1.0)
+    return '\n'.join('{} {}'.format(key, int(round(seconds * 1e6))) for key, seconds in sorted(totals.items())
+                     if seconds >= min_stack_time) + '\n'
+
+
+# Returns the path of a stored profile's file with the given extension, or None if the name is not valid
+def get_profile_path(name, extension):
+    if not profile_name_pattern.match(name):
+        return None
+    path = os.path.join(get_profile_dir(), name + extension)
+    return path if os.path.exists(path) else None
+
+
+# Stored profiles, newest first. Requires the profiling token.
+@app.server.route('/profiles')
+def list_profiles():
+    if not is_authorized():
+        flask.abort(404)
+    profile_dir = get_profile_dir()
+    profiles = []
+    for file_name in os.listdir(profile_dir) if os.path.isdir(profile_dir) else []:
+        if file_name.endswith('.json'):
+            try:
+                with open(os.path.join(profile_dir, file_name)) as info_file:
+                    profiles.append(json.load(info_file))
+            except (OSError, ValueError):
+                continue  # being removed
+    profiles.sort(key=lambda profile: profile['time'], reverse=True)
+    return flask.jsonify({'profiles': profiles})
+
+
+# A stored profile as a pstats file. Requires the profiling token.
+@app.server.route('/profiles/<name>')
+def get_profile(name):
+    path = get_profile_path(name, '.prof') if is_authorized() else None
+    if path is None:
+        flask.abort(404)
+    with open(path, 'rb') as profile_file:
+        response = flask.Response(profile_file.read(), mimetype='application/octet-stream')
+    response.headers['Content-Disposition'] = 'attachment; filename={}.prof'.format(name)
+    return response
+
+
+# A stored profile as collapsed stacks (for flamegraph.pl or speedscope). Requires the profiling token.
+@app.server.route('/profiles/<name>/collapsed')
+def get_profile_collapsed(name):
+    path = get_profile_path(name, '.prof') if is_authorized() else None
+    if path is None:
+        flask.abort(404)
+    return flask.Response(get_collapsed_stacks(pstats.Stats(path)), mimetype='text/plain')
+
+
+# RSS of the worker answering and, if tracemalloc is tracing (PYTHONTRACEMALLOC), its memory by subsystem and top
+# allocating lines. Requires the profiling token.
+# Query parameters: top (number of allocating lines)
+@app.server.route('/memory')
+def get_memory():
+    if not is_authorized():
+        flask.abort(404)
+    try:
+        top = min(max(int(flask.request.args.get('top', memory.default_top)), 1), 1000)
+    except ValueError:
+        top = memory.default_top
+    return flask.jsonify(memory.get_memory_report(top))
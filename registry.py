@@ -0,0 +1,229 @@
+import json
+import os
+
+import numpy
+import pandas as pd
+
+import essentials as ess
+
+"""
+registry.py keeps a persistent portfolio of rooms in columnar form: one NumPy structured array with a record per room
+(metadata, model inputs, and precomputed model rates), saved to disk and memory-mapped on load, together with sorted
+indexes for queries.
+
+Occupancy queries ("which rooms can host n people for t hours?") are answered from the precomputed columns rather than
+by evaluating the model per room. For each risk type the guideline holds when
+
+    risk_rate * occupancy_factor(n) * t / (1 + 1 / (conc_relax_rate * t)) <= 1
+
+with risk_rate = percentage_sus * airb_trans_rate / risk_tolerance (conditional), prevalence * airb_trans_rate /
+risk_tolerance (personal) or prevalence * percentage_sus * airb_trans_rate / risk_tolerance (prevalence), and
+occupancy_factor = n - 1 (n^2 for prevalence). Since the transient factor lies between its value at the registry's
+lowest conc_relax_rate and 1, two binary searches of the rooms sorted by risk_rate find the rooms that certainly pass
+and those that certainly fail; only the few in between are checked exactly.
+
+Properties:
+Registry Columns
+Registry Files
+
+Methods:
+class RoomRegistry: A persistent, indexed registry of rooms.
+def get_occupancy_factor: Get the occupancy factor of the guideline for a risk type.
+def get_transient_factor: Get the fraction of steady-state exposure reached over an exposure time.
+def get_room_registry: Get the registry served by the app.
+"""
+
+# Registry Columns
+# Metadata of each room, model inputs (see essentials.room_fields and room_extra_fields), and precomputed rates (/hr)
+metadata_columns = [('name', 'U64'), ('building', 'U64'), ('floor', 'U16'), ('room_type', 'U32'), ('seats', 'f8')]
+input_columns = [(name, 'f8') for name in list(ess.room_fields) + list(ess.room_extra_fields)]
+rate_columns = [('conc_relax_rate', 'f8'), ('airb_trans_rate', 'f8'), ('risk_rate_conditional', 'f8'),
+                ('risk_rate_prevalence', 'f8'), ('risk_rate_personal', 'f8')]
+registry_dtype = numpy.dtype(metadata_columns + input_columns + rate_columns)
+indexed_columns = ['building', 'floor', 'room_type', 'risk_rate_conditional', 'risk_rate_prevalence',
+                   'risk_rate_personal']
+risk_types = ['conditional', 'prevalence', 'personal']
+
+# Registry Files (in the registry directory)
+rooms_file = 'rooms.npy'
+index_file = 'index_{}.npy'
+info_file = 'registry.json'
+registry_version = 1
+
+# Environment variable with the directory of the registry served by the app (see get_room_registry)
+env_registry = 'ROOM_REGISTRY'
+room_registry = None
+
+
+# Returns the occupancy factor of the guideline for n people: n - 1, or n^2 for prevalence risk
+def get_occupancy_factor(n, risk_type):
+    n = numpy.asarray(n, dtype=float)
+    return n * n if risk_type == 'prevalence' else n - 1
+
+
+# Returns the transient factor 1 / (1 + 1 / (conc_relax_rate * exp_time)): the fraction of steady-state exposure
+# reached over exp_time hours, starting from clean air
+def get_transient_factor(conc_relax_rate, exp_time):
+    return 1 / (1 + 1 / (conc_relax_rate * exp_time))
+
+
+class RoomRegistry:
+    # path: registry directory, loaded (memory-mapped) if it exists and created on save
+    def __init__(self, path):
+        self.path = path
+        self.rooms = numpy.zeros(0, dtype=registry_dtype)
+        self.indexes = {column: numpy.zeros(0, dtype=int) for column in indexed_columns}
+        self.sorted_keys = {}
+        if os.path.exists(os.path.join(path, rooms_file)):
+            self.load()
+
+    # Load the rooms and indexes, memory-mapped so that only the pages a query touches are read
+    def load(self):
+        with open(os.path.join(self.path, info_file)) as registry_info:
+            info = json.load(registry_info)
+        if info.get('version') != registry_version:
+            raise ValueError("Unsupported room registry version {}".format(info.get('version')))
+        self.rooms = numpy.load(os.path.join(self.path, rooms_file), mmap_mode='r')
+        self.indexes = {column: numpy.load(os.path.join(self.path, index_file.format(column)), mmap_mode='r')
+                        for column in indexed_columns}
+        self.sorted_keys = {}
+
+    # Save the rooms and indexes. Each file is written next to its target and then renamed over it, so readers never
+    # see a partly written file.
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        files = [(rooms_file, self.rooms)] + [(index_file.format(column), self.indexes[column])
+                                             for column in indexed_columns]
+        for file_name, values in files:
+            target = os.path.join(self.path, file_name)
+            with open(target + '.tmp', 'wb') as temp_file:
+                numpy.save(temp_file, values)
+            os.replace(target + '.tmp', target)
+        with open(os.path.join(self.path, info_file + '.tmp'), 'w') as registry_info:
+            json.dump({'version': registry_version, 'n_rooms': len(self.rooms), 'columns': registry_dtype.names},
+                      registry_info)
+        os.replace(os.path.join(self.path, info_file + '.tmp'), os.path.join(self.path, info_file))
+
+    # Add rooms (a list of room dictionaries, see essentials.get_rooms_model, or a DataFrame with one room per row),
+    # each with a 'name' and optional 'building', 'floor', 'room_type' and 'seats'. Rooms with the name of a registered
+    # room replace it. Rates and indexes are recalculated; call save to persist the registry.
+    def add_rooms(self, rooms):
+        if isinstance(rooms, pd.DataFrame):
+            rooms = rooms.to_dict(orient='records')
+        new_rooms = numpy.zeros(len(rooms), dtype=registry_dtype)
+        _, columns = ess.get_rooms_model(rooms, {'seats': numpy.inf}, target_fields=())
+        for name, _ in input_columns:
+            new_rooms[name] = columns[name]
+        new_rooms['seats'] = columns['seats']
+        for name in ['name', 'building', 'floor', 'room_type']:
+            new_rooms[name] = [str(room.get(name, '')) for room in rooms]
+        self.calc_rates(new_rooms)
+
+        # Later rooms replace earlier rooms of the same name
+        names = numpy.concatenate((self.rooms['name'], new_rooms['name']))
+        _, last = numpy.unique(names[::-1], return_index=True)
+        keep = numpy.sort(len(names) - 1 - last)
+        self.rooms = numpy.concatenate((numpy.asarray(self.rooms), new_rooms))[keep]
+        self.build_indexes()
+
+    # Remove the rooms with the given names
+    def remove_rooms(self, names):
+        self.rooms = numpy.asarray(self.rooms)[~numpy.isin(self.rooms['name'], list(names))]
+        self.build_indexes()
+
+    # Calculate the precomputed rate columns of the given rooms (in place)
+    @staticmethod
+    def calc_rates(rooms):
+        rooms_model = ess.get_columns_model({name: rooms[name] for name, _ in input_columns})
+        airb_trans_rate = numpy.broadcast_to(rooms_model.airb_trans_rate, rooms.shape)
+        rooms['conc_relax_rate'] = numpy.broadcast_to(rooms_model.conc_relax_rate, rooms.shape)
+        rooms['airb_trans_rate'] = airb_trans_rate
+        risk_tolerance = rooms['risk_tolerance']
+        rooms['risk_rate_conditional'] = rooms['percentage_sus'] * airb_trans_rate / risk_tolerance
+        rooms['risk_rate_prevalence'] = rooms['prevalence'] * rooms['percentage_sus'] * airb_trans_rate / risk_tolerance
+        rooms['risk_rate_personal'] = rooms['prevalence'] * airb_trans_rate / risk_tolerance
+
+    # Rebuild the sorted index (permutation) of every indexed column
+    def build_indexes(self):
+        self.indexes = {column: numpy.argsort(self.rooms[column], kind='stable') for column in indexed_columns}
+        self.sorted_keys = {}
+
+    # Returns the values of an indexed column in index order (cached with other derived values until the rooms change,
+    # as memory-mapped columns are gathered on use)
+    def get_sorted_keys(self, column):
+        if column not in self.sorted_keys:
+            self.sorted_keys[column] = numpy.asarray(self.rooms[column])[self.indexes[column]]
+        return self.sorted_keys[column]
+
+    # Returns the lowest conc_relax_rate (/hr) of any room (cached; inf for an empty registry)
+    def get_lowest_conc_relax_rate(self):
+        if 'conc_relax_rate' not in self.sorted_keys:
+            self.sorted_keys['conc_relax_rate'] = numpy.min(self.rooms['conc_relax_rate'], initial=numpy.inf)
+        return self.sorted_keys['conc_relax_rate']
+
+    # Returns the rows (sorted) of the rooms whose metadata column equals value, by binary search of its index
+    def get_label_rows(self, column, value):
+        sorted_keys = self.get_sorted_keys(column)
+        start = numpy.searchsorted(sorted_keys, str(value), side='left')
+        stop = numpy.searchsorted(sorted_keys, str(value), side='right')
+        return numpy.sort(self.indexes[column][start:stop])
+
+    # Find the rows of the rooms that can host n people for exp_time hours under the guideline (and that have at least
+    # n seats), optionally only those in a building, on a floor, or of a room type, ordered from the lowest risk rate
+    def find_rows(self, n, exp_time, risk_type='conditional', building=None, floor=None, room_type=None):
+        if risk_type not in risk_types:
+            raise ValueError("Unknown risk type '{}'".format(risk_type))
+        column = 'risk_rate_' + risk_type
+        limit = 1 / (get_occupancy_factor(n, risk_type) * exp_time)  # risk_rate * transient factor must not exceed
+        sorted_keys = self.get_sorted_keys(column)
+        order = self.indexes[column]
+
+        # Rooms with risk_rate <= limit pass at any conc_relax_rate (the transient factor is at most 1); rooms above
+        # limit / (transient factor at the lowest conc_relax_rate) fail at any
+        lowest_factor = get_transient_factor(self.get_lowest_conc_relax_rate(), exp_time)
+        certain, possible = numpy.searchsorted(sorted_keys, [limit, limit / lowest_factor], side='right')
+        band = numpy.asarray(order[certain:possible])
+        band_pass = sorted_keys[certain:possible] * get_transient_factor(
+            numpy.asarray(self.rooms['conc_relax_rate'])[band], exp_time) <= limit
+        rows = numpy.concatenate((order[:certain], band[band_pass]))  # in index order
+
+        keep = numpy.asarray(self.rooms['seats'])[rows] >= n
+        for label_column, value in [('building', building), ('floor', floor), ('room_type', room_type)]:
+            if value is not None:
+                label_rows = numpy.zeros(len(self.rooms), dtype=bool)
+                label_rows[self.get_label_rows(label_column, value)] = True
+                keep &= label_rows[rows]
+        return rows[keep]
+
+    # Find the rooms that can host n people for exp_time hours (see find_rows). Returns a DataFrame of their metadata
+    # and rates, with the maximum occupancy (n_max) of each for exp_time hours, ordered from the lowest risk rate.
+    def find_rooms(self, n, exp_time, risk_type='conditional', building=None, floor=None, room_type=None):
+        return self.get_rooms_frame(self.find_rows(n, exp_time, risk_type, building, floor, room_type), exp_time,
+                                    risk_type)
+
+    # Returns a DataFrame of the metadata and rates of the given rows, with the maximum occupancy for exp_time hours
+    def get_rooms_frame(self, rows, exp_time, risk_type='conditional'):
+        rooms_frame = pd.DataFrame({name: numpy.asarray(self.rooms[name])[rows]
+                                    for name, _ in metadata_columns + rate_columns})
+        allowed = 1 / (rooms_frame['risk_rate_' + risk_type].to_numpy() * exp_time *
+                       get_transient_factor(rooms_frame['conc_relax_rate'].to_numpy(), exp_time))
+        with numpy.errstate(invalid='ignore'):
+            rooms_frame['n_max'] = numpy.floor(numpy.sqrt(allowed) if risk_type == 'prevalence' else 1 + allowed)
+        return rooms_frame
+
+    # Returns a batch model (see Indoors.copy_with_params) of the given rows (all rooms by default)
+    def get_rooms_model(self, rows=slice(None)):
+        rooms = self.rooms[rows]
+        return ess.get_columns_model({name: numpy.asarray(rooms[name]) for name, _ in input_columns})
+
+
+# Returns the registry served by the app, from the directory in the ROOM_REGISTRY environment variable (loaded on first
+# use), or None if no registry is configured
+def get_room_registry():
+    global room_registry
+    path = os.environ.get(env_registry)
+    if not path:
+        return None
+    if room_registry is None or room_registry.path != path:
+        room_registry = RoomRegistry(path)
+    return room_registry
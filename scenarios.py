@@ -0,0 +1,429 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy
+import pandas as pd
+import plotly.utils
+
+import essentials as ess
+import uncertainty
+
+"""
+scenarios.py saves Advanced Mode scenarios (every input of apps/advanced.py def update_figure) to a local SQLite
+database, together with their computed results: the model rates, the maximum exposure time and occupancy of each risk
+type, and the displayed outputs of the page in each language they were shown in. A saved scenario therefore reloads
+without recalculating the model, and saved scenarios can be listed, filtered and compared without evaluating it.
+
+Scenarios are indexed by room and human behavior type (their preset, or 'custom'), by the key room parameters, and
+their results by risk type. Saving many scenarios evaluates them as one batch model and writes them in one transaction.
+
+Properties:
+Scenario Inputs
+Database Schema
+
+Methods:
+class ScenarioStore: A SQLite database of saved scenarios.
+def normalize_inputs: Get the complete inputs of a scenario, with numbers as floats.
+def get_inputs_key: Get the key identifying the inputs of a scenario.
+def calc_scenario_results: Calculate the results of many scenarios at once.
+def dump_outputs: Serialize displayed outputs (figures and components) as JSON.
+def get_scenario_store: Get the store used by the app.
+"""
+
+# Scenario Inputs
+# Inputs of a scenario, named as the parameters of apps/advanced.py def update_figure, with their Advanced Mode defaults.
+# Floor area and ceiling height are in the scenario's units (square feet and feet, or square meters and meters).
+scenario_defaults = {
+    'floor_area': 900,
+    'ceiling_height': 12,
+    'air_exchange_rate': 3,
+    'recirc_rate': 1,
+    'merv': 6,
+    'relative_humidity': 0.6,
+    'breathing_flow_rate': 0.49,
+    'infectiousness': 72,
+    'mask_eff': 0.9,
+    'mask_fit': 0.95,
+    'risk_tolerance': 0.1,
+    'sr_age_factor': 0.68,
+    'sr_strain_factor': 1,
+    'pim_input': 0,
+    'def_aerosol_radius': 2,
+    'max_viral_deact_rate': 0.6,
+    'n_max_input': 10,
+    'exp_time_input': 4,
+    'n_max_input_b': 10,
+    'exp_time_input_b': 4,
+    'n_max_input_c': 10,
+    'exp_time_input_c': 4,
+    'prevalence_b': 100,
+    'prevalence_c': 100,
+    'mc_enable': [],
+    'mc_cq_gsd': 2,
+    'mc_qb_gsd': 1.3,
+    'mc_mask_fit_range': 0.15,
+    'mc_deact_min': 0.3,
+    'mc_deact_max': 1.0,
+    'mc_samples': uncertainty.default_n_samples,
+}
+scenario_inputs = list(scenario_defaults)
+list_inputs = ['mc_enable']
+
+# Occupancy, exposure time and prevalence (per 100,000) inputs of each risk type
+risk_type_inputs = {
+    'conditional': ('n_max_input', 'exp_time_input', None),
+    'prevalence': ('n_max_input_b', 'exp_time_input_b', 'prevalence_b'),
+    'personal': ('n_max_input_c', 'exp_time_input_c', 'prevalence_c'),
+}
+
+# Database Schema
+# Indexed parameter columns of the scenarios table; floor_area and ceiling_height are stored in feet
+param_columns = ['floor_area', 'ceiling_height', 'air_exchange_rate', 'recirc_rate', 'merv', 'relative_humidity',
+                 'mask_eff', 'mask_fit']
+schema = """
+CREATE TABLE IF NOT EXISTS scenarios (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    created REAL NOT NULL,
+    inputs_key TEXT NOT NULL,
+    units TEXT NOT NULL,
+    room_type TEXT NOT NULL,
+    human_type TEXT NOT NULL,
+    floor_area REAL, ceiling_height REAL, air_exchange_rate REAL, recirc_rate REAL, merv REAL,
+    relative_humidity REAL, mask_eff REAL, mask_fit REAL,
+    conc_relax_rate REAL, airb_trans_rate REAL,
+    inputs TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scenarios_type ON scenarios (room_type, human_type);
+CREATE INDEX IF NOT EXISTS scenarios_params ON scenarios (air_exchange_rate, merv, floor_area, ceiling_height);
+CREATE INDEX IF NOT EXISTS scenarios_inputs_key ON scenarios (inputs_key);
+CREATE TABLE IF NOT EXISTS scenario_results (
+    scenario_id INTEGER NOT NULL REFERENCES scenarios (id) ON DELETE CASCADE,
+    risk_type TEXT NOT NULL,
+    n REAL, t REAL, prevalence REAL, max_time REAL, n_max REAL,
+    PRIMARY KEY (scenario_id, risk_type)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scenario_results_n_max ON scenario_results (risk_type, n_max);
+CREATE INDEX IF NOT EXISTS scenario_results_max_time ON scenario_results (risk_type, max_time);
+CREATE TABLE IF NOT EXISTS scenario_outputs (
+    inputs_key TEXT NOT NULL,
+    language TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    PRIMARY KEY (inputs_key, language)
+) WITHOUT ROWID;
+"""
+
+# Environment variable with the path of the database used by the app (see get_scenario_store)
+env_scenarios = 'SCENARIO_DB'
+default_scenarios_path = 'scenarios.db'
+scenario_store = None
+scenario_store_lock = threading.Lock()
+
+# Comparison results (limits and n_max curve of one risk type, see ScenarioStore.compare_scenarios) of each scenario,
+# keyed by (inputs key, risk type, exposure times of the curve). Oldest entries are dropped first once the cache is
+# full.
+comparison_cache = {}
+comparison_cache_size = 1024
+max_compared_scenarios = 50
+
+
+class ScenarioStore:
+    # path: SQLite database file, created if it does not exist
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # one connection per thread
+        with self.connect() as connection:
+            connection.executescript(schema)
+
+    # Returns this thread's connection to the database (a forked worker opens its own, as SQLite connections must not
+    # be shared across processes)
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')  # readers are not blocked by a save in another worker
+            connection.execute('PRAGMA foreign_keys=ON')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    # Save scenarios (dictionaries with a 'name', 'inputs' (see scenario_defaults; missing inputs take their defaults)
+    # and 'units', and optionally the 'language' and displayed 'outputs' (a list, see dump_outputs) they were shown
+    # with). All scenarios are evaluated as one batch and written in one transaction. Returns their ids.
+    def save_scenarios(self, scenarios):
+        if len(scenarios) == 0:
+            return []
+        inputs_list = [normalize_inputs(scenario.get('inputs', {})) for scenario in scenarios]
+        units_list = [scenario.get('units', 'british') for scenario in scenarios]
+        results = calc_scenario_results(inputs_list, units_list)
+        columns = results['columns']
+        created = time.time()
+
+        scenario_rows = []
+        for index, (scenario, inputs, units) in enumerate(zip(scenarios, inputs_list, units_list)):
+            room_type = ess.get_room_preset_dd_value(inputs['floor_area'], inputs['ceiling_height'],
+                                                     inputs['air_exchange_rate'], inputs['recirc_rate'],
+                                                     inputs['merv'], inputs['relative_humidity'], units)
+            human_type = ess.get_human_preset_dd_value(inputs['breathing_flow_rate'], inputs['infectiousness'],
+                                                       inputs['mask_eff'], inputs['mask_fit'], units)
+            scenario_rows.append([str(scenario['name']), created, get_inputs_key(inputs, units), units, room_type,
+                                  human_type] + [float(columns[name][index]) for name in param_columns] +
+                                 [float(results['conc_relax_rate'][index]), float(results['airb_trans_rate'][index]),
+                                  json.dumps(inputs)])
+        output_rows = [(row[2], scenario['language'], scenario['outputs'] if isinstance(scenario['outputs'], str)
+                        else dump_outputs(scenario['outputs']))
+                       for row, scenario in zip(scenario_rows, scenarios)
+                       if scenario.get('outputs') is not None and scenario.get('language')]
+
+        connection = self.connect()
+        with connection:
+            # Ids are assigned up front (under the write lock) so every table is written with executemany
+            connection.execute('BEGIN IMMEDIATE')
+            first_id = connection.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM scenarios').fetchone()[0]
+            ids = list(range(first_id, first_id + len(scenarios)))
+            connection.executemany(
+                'INSERT INTO scenarios (id, name, created, inputs_key, units, room_type, human_type, {}, '
+                'conc_relax_rate, airb_trans_rate, inputs) VALUES ({})'.format(
+                    ', '.join(param_columns), ', '.join(['?'] * (len(param_columns) + 10))),
+                [[scenario_id] + row for scenario_id, row in zip(ids, scenario_rows)])
+            connection.executemany(
+                'INSERT INTO scenario_results (scenario_id, risk_type, n, t, prevalence, max_time, n_max) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(scenario_id, risk_type, float(results[risk_type]['n'][index]),
+                  float(results[risk_type]['t'][index]), float(results[risk_type]['prevalence'][index]),
+                  get_db_number(results[risk_type]['max_time'][index]),
+                  get_db_number(results[risk_type]['n_max'][index]))
+                 for index, scenario_id in enumerate(ids) for risk_type in risk_type_inputs])
+            connection.executemany('INSERT OR REPLACE INTO scenario_outputs (inputs_key, language, outputs) '
+                                   'VALUES (?, ?, ?)', output_rows)
+        return ids
+
+    # Cache the displayed outputs (a list, see dump_outputs) of the given inputs in a language, if a saved scenario has
+    # those inputs. Returns whether they were cached.
+    def cache_outputs(self, inputs_key, language, outputs):
+        connection = self.connect()
+        if connection.execute('SELECT 1 FROM scenarios WHERE inputs_key = ? LIMIT 1', (inputs_key,)).fetchone() is None:
+            return False
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO scenario_outputs (inputs_key, language, outputs) '
+                               'VALUES (?, ?, ?)', (inputs_key, language, dump_outputs(outputs)))
+        return True
+
+    # Returns the displayed outputs (a list) cached for the given inputs in a language, or None
+    def get_outputs(self, inputs_key, language):
+        row = self.connect().execute('SELECT outputs FROM scenario_outputs WHERE inputs_key = ? AND language = ?',
+                                     (inputs_key, language)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # List saved scenarios, newest first, with their key parameters and the results of one risk type, optionally only
+    # those of a room type or human behavior type. Returns a DataFrame with one scenario per row.
+    def list_scenarios(self, risk_type='conditional', room_type=None, human_type=None, limit=None):
+        conditions = ['r.risk_type = ?']
+        values = [risk_type]
+        for column, value in [('room_type', room_type), ('human_type', human_type)]:
+            if value is not None:
+                conditions.append('s.{} = ?'.format(column))
+                values.append(value)
+        query = 'SELECT s.id, s.name, s.created, s.units, s.room_type, s.human_type, {}, s.conc_relax_rate, ' \
+                's.airb_trans_rate, r.risk_type, r.n, r.t, r.prevalence, r.max_time, r.n_max ' \
+                'FROM scenarios s JOIN scenario_results r ON r.scenario_id = s.id WHERE {} ORDER BY s.id DESC'.format(
+                    ', '.join('s.' + name for name in param_columns), ' AND '.join(conditions))
+        if limit is not None:
+            query += ' LIMIT {:d}'.format(int(limit))
+        return pd.read_sql_query(query, self.connect(), params=values)
+
+    # Returns a saved scenario as a dictionary (id, name, created, units, room_type, human_type, inputs_key, inputs,
+    # and results: a dictionary of the results of each risk type), or None if there is no such scenario
+    def get_scenario(self, scenario_id):
+        connection = self.connect()
+        row = connection.execute('SELECT id, name, created, units, room_type, human_type, inputs_key, inputs, '
+                                 'conc_relax_rate, airb_trans_rate FROM scenarios WHERE id = ?',
+                                 (int(scenario_id),)).fetchone()
+        if row is None:
+            return None
+        scenario = dict(zip(['id', 'name', 'created', 'units', 'room_type', 'human_type', 'inputs_key', 'inputs',
+                             'conc_relax_rate', 'airb_trans_rate'], row))
+        scenario['inputs'] = json.loads(scenario['inputs'])
+        scenario['results'] = {
+            risk_type: {'n': n, 't': t, 'prevalence': prevalence, 'max_time': get_result_number(max_time),
+                        'n_max': get_result_number(n_max)}
+            for risk_type, n, t, prevalence, max_time, n_max in connection.execute(
+                'SELECT risk_type, n, t, prevalence, max_time, n_max FROM scenario_results WHERE scenario_id = ?',
+                (scenario['id'],))}
+        return scenario
+
+    # Compare two saved scenarios. Returns a DataFrame of the inputs and results that differ (field, a, b), with
+    # results named risk_type.result; floor area and ceiling height are compared in feet.
+    def diff_scenarios(self, scenario_id_a, scenario_id_b):
+        fields = []
+        for scenario_id in [scenario_id_a, scenario_id_b]:
+            scenario = self.get_scenario(scenario_id)
+            if scenario is None:
+                raise KeyError(scenario_id)
+            values = dict(scenario['inputs'])
+            if scenario['units'] == 'metric':
+                values['floor_area'] = values['floor_area'] * ess.m_to_ft * ess.m_to_ft
+                values['ceiling_height'] = values['ceiling_height'] * ess.m_to_ft
+            values['room_type'] = scenario['room_type']
+            values['human_type'] = scenario['human_type']
+            values['conc_relax_rate'] = scenario['conc_relax_rate']
+            values['airb_trans_rate'] = scenario['airb_trans_rate']
+            for risk_type, results in scenario['results'].items():
+                for name in ['max_time', 'n_max']:
+                    values['{}.{}'.format(risk_type, name)] = results[name]
+            fields.append(values)
+        names = [name for name in fields[0] if not is_same_value(fields[0][name], fields[1].get(name))]
+        return pd.DataFrame({'field': names, 'a': [fields[0][name] for name in names],
+                             'b': [fields[1].get(name) for name in names]})
+
+    # Compare saved scenarios under one risk type. Scenarios whose results are not cached (see comparison_cache) are
+    # evaluated together as one batch. Returns a dictionary with a DataFrame of the scenarios (id, name, n, t,
+    # max_time, n_max, and the relative change of max_time and n_max from the first scenario), the exposure times
+    # (hours) of the curves, and the curves of n_max over them (one row per scenario).
+    def compare_scenarios(self, scenario_ids, risk_type='conditional', exp_times=ess.graph_exp_times):
+        scenario_ids = [int(scenario_id) for scenario_id in scenario_ids]
+        times_key = tuple(numpy.asarray(exp_times, dtype=float).ravel().tolist())
+        rows = {row[0]: row for row in self.connect().execute(
+            'SELECT id, name, units, inputs_key, inputs FROM scenarios WHERE id IN ({})'.format(
+                ', '.join(['?'] * len(scenario_ids))), scenario_ids)}
+        for scenario_id in scenario_ids:
+            if scenario_id not in rows:
+                raise KeyError(scenario_id)
+
+        # Evaluate every scenario missing from the cache in one batch
+        missing = {rows[scenario_id][3]: rows[scenario_id] for scenario_id in scenario_ids
+                   if (rows[scenario_id][3], risk_type, times_key) not in comparison_cache}
+        if len(missing) > 0:
+            missing_rows = list(missing.values())
+            results = calc_scenario_results([json.loads(row[4]) for row in missing_rows],
+                                            [row[2] for row in missing_rows], exp_times)[risk_type]
+            for index, row in enumerate(missing_rows):
+                if len(comparison_cache) >= comparison_cache_size:
+                    comparison_cache.pop(next(iter(comparison_cache)))
+                comparison_cache[row[3], risk_type, times_key] = {name: numpy.array(values[index])
+                                                       for name, values in results.items()}
+
+        compared = [comparison_cache[rows[scenario_id][3], risk_type, times_key] for scenario_id in scenario_ids]
+        comparison = pd.DataFrame({
+            'id': scenario_ids,
+            'name': [rows[scenario_id][1] for scenario_id in scenario_ids],
+            'n': [float(result['n']) for result in compared],
+            't': [float(result['t']) for result in compared],
+            'max_time': [float(result['max_time']) for result in compared],
+            'n_max': [float(result['n_max']) for result in compared],
+        })
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for name in ['max_time', 'n_max']:
+                comparison[name + '_change'] = comparison[name] / comparison[name].iloc[0] - 1
+        return {
+            'scenarios': comparison,
+            'exp_times': numpy.asarray(exp_times),
+            'curves': numpy.array([result['curve'] for result in compared]).reshape(len(compared), len(exp_times)),
+        }
+
+    # Delete saved scenarios by id (with their results; cached outputs no scenario uses any more are dropped too)
+    def delete_scenarios(self, scenario_ids):
+        connection = self.connect()
+        with connection:
+            connection.executemany('DELETE FROM scenarios WHERE id = ?', [(int(scenario_id),)
+                                                                          for scenario_id in scenario_ids])
+            connection.execute('DELETE FROM scenario_outputs WHERE inputs_key NOT IN '
+                               '(SELECT inputs_key FROM scenarios)')
+
+
+# Returns the complete inputs of a scenario: defaults for missing inputs, numbers as floats and lists sorted
+def normalize_inputs(inputs):
+    normalized = {}
+    for name, default in scenario_defaults.items():
+        value = inputs.get(name, default)
+        normalized[name] = sorted(value) if name in list_inputs else float(value)
+    return normalized
+
+
+# Returns the key (a hash) identifying the given inputs (see normalize_inputs) in the given units
+def get_inputs_key(inputs, units):
+    inputs = normalize_inputs(inputs)
+    key_text = json.dumps([units] + [inputs[name] for name in scenario_inputs])
+    return hashlib.sha1(key_text.encode('utf-8')).hexdigest()
+
+
+# Calculate the results of many scenarios (lists of normalized inputs and their units) with one batch model.
+# Returns a dictionary with the per-scenario input columns (floor area and ceiling height in feet), the
+# conc_relax_rate and airb_trans_rate, and for each risk type the n, t, prevalence (per 100,000), max_time and n_max.
+# If exp_times are given, each risk type also has the curve of n_max over them (one row per scenario).
+def calc_scenario_results(inputs_list, units_list, exp_times=None):
+    columns = {name: numpy.array([inputs[name] for inputs in inputs_list], dtype=float)
+               for name in scenario_inputs if name not in list_inputs}
+    metric = numpy.array([units == 'metric' for units in units_list])
+    columns['floor_area'] = numpy.where(metric, columns['floor_area'] * ess.m_to_ft * ess.m_to_ft,
+                                        columns['floor_area'])
+    columns['ceiling_height'] = numpy.where(metric, columns['ceiling_height'] * ess.m_to_ft, columns['ceiling_height'])
+
+    scenarios_model = ess.get_indoor_model(columns['floor_area'], columns['ceiling_height'],
+                                           columns['air_exchange_rate'], columns['recirc_rate'], columns['merv'],
+                                           columns['relative_humidity'], columns['breathing_flow_rate'],
+                                           columns['infectiousness'], columns['mask_eff'], columns['mask_fit'],
+                                           columns['risk_tolerance'], columns['sr_age_factor'],
+                                           columns['sr_strain_factor'], columns['def_aerosol_radius'],
+                                           columns['max_viral_deact_rate'], 1 - columns['pim_input'])
+    shape = columns['floor_area'].shape
+    results = {
+        'columns': columns,
+        'conc_relax_rate': numpy.broadcast_to(scenarios_model.conc_relax_rate, shape),
+        'airb_trans_rate': numpy.broadcast_to(scenarios_model.airb_trans_rate, shape),
+    }
+    for risk_type, (n_name, t_name, prevalence_name) in risk_type_inputs.items():
+        prevalence = numpy.zeros(shape) if prevalence_name is None else columns[prevalence_name]
+        if prevalence_name is not None:
+            scenarios_model.prevalence = prevalence / 100000
+            scenarios_model.percentage_sus = 1 - (prevalence / 100000 + columns['pim_input'])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            results[risk_type] = {
+                'n': columns[n_name],
+                't': columns[t_name],
+                'prevalence': prevalence,
+                'max_time': numpy.broadcast_to(scenarios_model.calc_max_time(columns[n_name], risk_type), shape),
+                'n_max': numpy.broadcast_to(scenarios_model.calc_n_max(columns[t_name], risk_type), shape),
+            }
+            if exp_times is not None:
+                curves = scenarios_model.calc_n_max(numpy.asarray(exp_times)[:, numpy.newaxis], risk_type)
+                results[risk_type]['curve'] = numpy.broadcast_to(curves, (len(exp_times),) + shape).T
+    return results
+
+
+# Serialize displayed outputs (figures, components and text) as JSON. Loaded back, components are plain dictionaries,
+# which Dash renders the same way.
+def dump_outputs(outputs):
+    return json.dumps(list(outputs), cls=plotly.utils.PlotlyJSONEncoder)
+
+
+# Returns a result for the database: infinite results (e.g. no time limit) are stored as NULL
+def get_db_number(value):
+    return float(value) if numpy.isfinite(value) else None
+
+
+# Returns a result from the database, with NULL as infinity
+def get_result_number(value):
+    return numpy.inf if value is None else value
+
+
+# Returns whether two scenario values are the same (numbers within rounding)
+def is_same_value(value_a, value_b):
+    if isinstance(value_a, float) and isinstance(value_b, float):
+        return bool(numpy.isclose(value_a, value_b, rtol=1e-9, atol=0)) or value_a == value_b
+    return value_a == value_b
+
+
+# Returns the store used by the app, at the path in the SCENARIO_DB environment variable (scenarios.db by default),
+# opened on first use
+def get_scenario_store():
+    global scenario_store
+    path = os.environ.get(env_scenarios, default_scenarios_path)
+    with scenario_store_lock:
+        if scenario_store is None or scenario_store.path != path:
+            scenario_store = ScenarioStore(path)
+    return scenario_store
@@ -0,0 +1,119 @@
+import numpy
+import pandas as pd
+
+"""
+scheduler.py assigns meetings to rooms so that every meeting meets the guideline of the model (indoors.py): a meeting
+of h people lasting d hours may only use a room if calc_n_max(d) >= h for that room, under the chosen risk type (and
+if the room has at least h seats).
+
+Feasibility is precomputed as a room x meeting matrix in one vectorized pass (in chunks of meetings, to bound memory).
+Meetings are then assigned greedily in order of start time, each to the free feasible room with the least spare
+capacity (best fit), which keeps the larger and better ventilated rooms free for the meetings that need them. Exact
+assignment is an integer program that does not scale to interactive use at 10k meetings x 1k rooms, so the greedy
+best fit is used instead.
+
+Methods:
+def calc_feasibility: Calculate the spare capacity of every room for every meeting (room x meeting matrix).
+def assign_meetings: Assign meetings to rooms by greedy best fit, in order of start time.
+def get_room_utilization: Get the booked hours and utilization of each room.
+def schedule_meetings: Calculate feasibility, assign meetings, and summarize the schedule.
+"""
+
+default_chunk_size = 2000000  # room-meeting pairs per batch
+
+
+# Calculate the spare capacity (calc_n_max(duration) - headcount, in people) of every room for every meeting.
+# rooms_model: batch model with one entry per room (see Indoors.copy_with_params)
+# headcount, duration (hours): one entry per meeting
+# seats: optional number of seats in each room (meetings larger than a room's seats are infeasible)
+# Returns a float32 matrix indexed by [room, meeting], with inf where the meeting may not use the room.
+def calc_feasibility(rooms_model, headcount, duration, risk_type='conditional', seats=None,
+                     chunk_size=default_chunk_size):
+    headcount = numpy.asarray(headcount, dtype=float)
+    duration = numpy.asarray(duration, dtype=float)
+    room_model = rooms_model.copy_with_params(**rooms_model.get_room_params())
+    n_rooms = max(numpy.size(room_model.conc_relax_rate), numpy.size(room_model.airb_trans_rate))
+    n_meetings = len(headcount)
+
+    spare = numpy.empty((n_rooms, n_meetings), dtype=numpy.float32)
+    meetings_per_chunk = max(chunk_size // n_rooms, 1)
+    for start in range(0, n_meetings, meetings_per_chunk):
+        meeting_slice = slice(start, min(start + meetings_per_chunk, n_meetings))
+        with numpy.errstate(divide='ignore'):
+            chunk_spare = room_model.calc_n_max(duration[meeting_slice], risk_type) - headcount[meeting_slice]
+        chunk_spare = numpy.broadcast_to(chunk_spare, (n_rooms, meeting_slice.stop - start))
+        infeasible = chunk_spare < 0
+        if seats is not None:
+            infeasible = infeasible | (numpy.reshape(seats, (-1, 1)) < headcount[meeting_slice])
+        spare[:, meeting_slice] = numpy.where(infeasible, numpy.inf, chunk_spare)
+
+    return spare
+
+
+# Assign meetings to rooms given their spare capacity matrix (see calc_feasibility). Meetings are taken in order of
+# start time (among meetings starting together, those with the fewest feasible rooms first, then the longest), and
+# each goes to the free feasible room with the least spare capacity. A room is free once its previous meeting ends.
+# Returns the room of each meeting (-1 if no feasible room is free).
+def assign_meetings(spare, start, duration):
+    start = numpy.asarray(start, dtype=float)
+    end = start + numpy.asarray(duration, dtype=float)
+    n_rooms, n_meetings = spare.shape
+    # Rows of the transpose are contiguous, so each meeting reads its rooms in one pass
+    meeting_spare = numpy.ascontiguousarray(spare.T)
+    meeting_order = numpy.lexsort((-end, numpy.isfinite(meeting_spare).sum(axis=1), start))
+
+    assignment = numpy.full(n_meetings, -1)
+    # Times stay float64: float32 rounds epoch hours (about 5e5) to 2 minutes, so a meeting could take a busy room
+    room_free_at = numpy.full(n_rooms, -numpy.inf)
+    busy_spare = numpy.empty(n_rooms, dtype=numpy.float32)
+    for meeting in meeting_order:
+        numpy.copyto(busy_spare, meeting_spare[meeting])
+        busy_spare[room_free_at > numpy.float64(start[meeting])] = numpy.inf
+        room = busy_spare.argmin()
+        if busy_spare[room] < numpy.inf:
+            assignment[meeting] = room
+            room_free_at[room] = end[meeting]
+
+    return assignment
+
+
+# Get the booked hours and utilization (booked hours over the scheduling horizon) of each room.
+def get_room_utilization(assignment, start, duration, n_rooms):
+    start = numpy.asarray(start, dtype=float)
+    duration = numpy.asarray(duration, dtype=float)
+    assigned = assignment >= 0
+    booked_hours = numpy.bincount(assignment[assigned], weights=duration[assigned], minlength=n_rooms)
+    horizon = (start + duration).max() - start.min() if len(start) > 0 else 0
+    return pd.DataFrame({
+        'room': numpy.arange(n_rooms),
+        'booked_hours': booked_hours,
+        'utilization': booked_hours / horizon if horizon > 0 else numpy.zeros(n_rooms),
+    })
+
+
+# Calculate feasibility, assign meetings to rooms, and summarize the schedule.
+# start, duration: start times and durations (hours) of the meetings, on any common clock
+# Returns a dictionary with
+#     'meetings': DataFrame with the room, start, end and headcount of each meeting (room -1 if unassigned)
+#     'rooms': DataFrame of booked hours and utilization per room (see get_room_utilization)
+#     'n_feasible_rooms': number of rooms each meeting may use, regardless of timing
+#     'assigned', 'booked_hours', 'utilization': totals across the schedule
+def schedule_meetings(rooms_model, headcount, duration, start, risk_type='conditional', seats=None):
+    spare = calc_feasibility(rooms_model, headcount, duration, risk_type, seats)
+    assignment = assign_meetings(spare, start, duration)
+    rooms = get_room_utilization(assignment, start, duration, spare.shape[0])
+    meetings = pd.DataFrame({
+        'meeting': numpy.arange(len(assignment)),
+        'room': assignment,
+        'start': start,
+        'end': numpy.asarray(start, dtype=float) + numpy.asarray(duration, dtype=float),
+        'headcount': headcount,
+    })
+    return {
+        'meetings': meetings,
+        'rooms': rooms,
+        'n_feasible_rooms': numpy.isfinite(spare).sum(axis=0),
+        'assigned': int((assignment >= 0).sum()),
+        'booked_hours': float(rooms['booked_hours'].sum()),
+        'utilization': float(rooms['utilization'].mean()),
+    }
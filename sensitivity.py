@@ -0,0 +1,156 @@
+import numpy
+
+from indoors import Indoors
+
+"""
+sensitivity.py performs global sensitivity analysis of the model (indoors.py), to tell which lever matters most for a
+given room: ventilation, filtration, masks, humidity or occupancy. It computes first-order and total Sobol indices of
+the (log) maximum exposure time, using Saltelli sampling on a quasi-random Sobol sequence. All samples are evaluated
+in a single vectorized pass through the model.
+
+Properties:
+Sobol Sequence Setup
+Factors
+
+Methods:
+def get_direction_numbers: Get the Sobol sequence direction numbers for one dimension.
+def sobol_sequence: Generate points of the Sobol low-discrepancy sequence in the unit hypercube.
+def get_factor_ranges: Get the default range of each factor around the current settings of a room.
+def calc_factor_output: Evaluate the model output for a batch of factor values in the unit hypercube.
+def calc_sobol_indices: Calculate first-order and total Sobol indices of each factor.
+"""
+
+# Sobol Sequence Setup
+# Direction numbers (degree s, coefficients a, initial m values) for dimensions 2 and up, from S. Joe and F. Y. Kuo,
+# "Constructing Sobol sequences with better two-dimensional projections" (new-joe-kuo-6.21201).
+sobol_bits = 32
+sobol_params = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+]
+sobol_max_dims = len(sobol_params) + 1
+
+# Factors
+# Levers varied in the analysis, and the output is log10 of the maximum exposure time for the given occupancy.
+factor_names = ['ventilation', 'filtration', 'masks', 'humidity', 'occupancy']
+default_n_base = 1024
+
+
+# Get the direction numbers of the Sobol sequence for the given dimension (0-indexed), scaled to sobol_bits bits.
+def get_direction_numbers(dim):
+    if dim == 0:
+        m = [1] * sobol_bits
+    else:
+        s, a, m = sobol_params[dim - 1]
+        m = list(m)
+        for k in range(s, sobol_bits):
+            new_m = m[k - s] ^ (m[k - s] << s)
+            for j in range(1, s):
+                if (a >> (s - 1 - j)) & 1:
+                    new_m ^= m[k - j] << j
+            m.append(new_m)
+
+    return numpy.array([m[k] << (sobol_bits - 1 - k) for k in range(sobol_bits)], dtype=numpy.uint64)
+
+
+# Generate n_points points of the Sobol sequence in [0, 1)^n_dims, skipping the first `skip` points.
+# Returns a 2D array indexed by [point, dimension].
+def sobol_sequence(n_points, n_dims, skip=1):
+    if n_dims > sobol_max_dims:
+        raise ValueError("Sobol sequence supports at most {} dimensions".format(sobol_max_dims))
+
+    index = numpy.arange(skip, skip + n_points, dtype=numpy.uint64)
+    gray = index ^ (index >> numpy.uint64(1))
+    points = numpy.zeros((n_points, n_dims))
+    for dim in range(n_dims):
+        direction = get_direction_numbers(dim)
+        x = numpy.zeros(n_points, dtype=numpy.uint64)
+        for bit in range(sobol_bits):
+            x ^= ((gray >> numpy.uint64(bit)) & numpy.uint64(1)) * direction[bit]
+        points[:, dim] = x / 2.0 ** sobol_bits
+
+    return points
+
+
+# Get the default range (low, high) of each factor around the current settings of the room.
+# ventilation: outdoor ACH (/hr), filtration: MERV, masks: mask passage probability, humidity: relative humidity,
+# occupancy: number of people.
+def get_factor_ranges(indoor_model, n_max):
+    air_exch_rate = indoor_model.physical_params[2]
+    return {
+        'ventilation': (max(air_exch_rate / 4, 0.25), air_exch_rate * 4),
+        'filtration': (0, 17),
+        'masks': (0.05, 1),
+        'humidity': (0.2, 0.8),
+        'occupancy': (2, max(2 * n_max, 3)),
+    }
+
+
+# Evaluate log10 of the maximum exposure time (hours) for a batch of factor values in the unit hypercube.
+# factor_vals: 2D array indexed by [sample, factor] (factor order as in factor_names)
+# The recirculation rate (/hr) of the room is held fixed while the ventilation rate varies.
+def calc_factor_output(indoor_model, factor_vals, ranges, risk_type='conditional'):
+    scaled = {}
+    for index, name in enumerate(factor_names):
+        low, high = ranges[name]
+        scaled[name] = low + factor_vals[:, index] * (high - low)
+
+    air_exch_rate = indoor_model.physical_params[2]
+    recirc_ach = air_exch_rate * (1 / indoor_model.physical_params[3] - 1)  # /hr
+    batch_model = indoor_model.copy_with_params(
+        air_exch_rate=scaled['ventilation'],
+        primary_outdoor_air_fraction=scaled['ventilation'] / (scaled['ventilation'] + recirc_ach),
+        aerosol_filtration_eff=Indoors.merv_to_eff_array(scaled['filtration'], indoor_model.physio_params[1]),
+        mask_passage_prob=scaled['masks'],
+        relative_humidity=scaled['humidity'])
+    return numpy.log10(batch_model.calc_max_time(scaled['occupancy'], risk_type))
+
+
+# Calculate first-order and total Sobol indices of each factor, with Saltelli sampling (n_base * (k + 2) model
+# evaluations for k factors) and the Saltelli (2010) / Jansen estimators.
+# ranges: dictionary of factor name to (low, high); defaults to get_factor_ranges
+# Returns a dictionary with the factor names, first-order indices, total indices and number of evaluations.
+def calc_sobol_indices(indoor_model, n_max, risk_type='conditional', n_base=default_n_base, ranges=None):
+    if ranges is None:
+        ranges = get_factor_ranges(indoor_model, n_max)
+
+    n_factors = len(factor_names)
+    points = sobol_sequence(n_base, 2 * n_factors)
+    mat_a = points[:, :n_factors]
+    mat_b = points[:, n_factors:]
+
+    # Stack A, B and every AB_i (A with column i taken from B) into one batch
+    batch = [mat_a, mat_b]
+    for index in range(n_factors):
+        mat_ab = mat_a.copy()
+        mat_ab[:, index] = mat_b[:, index]
+        batch.append(mat_ab)
+    output = calc_factor_output(indoor_model, numpy.concatenate(batch), ranges, risk_type).reshape(-1, n_base)
+
+    out_a = output[0]
+    out_b = output[1]
+    out_ab = output[2:]
+    variance = numpy.var(numpy.concatenate((out_a, out_b)))
+    if variance == 0:
+        first_order = numpy.zeros(n_factors)
+        total = numpy.zeros(n_factors)
+    else:
+        first_order = numpy.mean(out_b * (out_ab - out_a), axis=1) / variance
+        total = 0.5 * numpy.mean((out_a - out_ab) ** 2, axis=1) / variance
+
+    return {
+        'factors': list(factor_names),
+        'first_order': first_order,
+        'total': total,
+        'n_evals': output.size,
+    }
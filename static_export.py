@@ -0,0 +1,296 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from html import escape
+
+import plotly.offline
+import plotly.utils
+
+"""
+static_export.py renders the Basic Mode page of every room and human behavior preset, in both unit systems and every
+enabled language, to static files, so the most visited views can be served by a plain web server or CDN with no Python
+at all (for example during high-traffic events). The interactive app stays available for custom inputs, and every
+exported page links to it.
+
+Each page is rendered from the same outputs as the app: Basic Mode's update_figure for the preset (from the preset
+table when it is built and current, see presets.py) and the localized texts of essentials.py and the description
+modules. The age group and viral strain are those Basic Mode opens with. The export directory holds:
+
+    index.html                                  redirects to the default page
+    assets/                                     the app's assets and plotly.js
+    <language>/texts.json                       localized texts, by output (id.property, as the app's callbacks)
+    <language>/<units>/<room>/<human>/index.html    the page, with its figure inline
+    <language>/<units>/<room>/<human>/figure.json   the figure
+    <language>/<units>/<room>/<human>/texts.json    the model outputs, by output
+
+Links between pages are relative, so the directory can be served from any path.
+
+Usage: python static_export.py [--out DIR] [--app-url URL]
+
+Properties:
+Export Settings
+
+Methods:
+def get_output_ids: Get the outputs of a callback.
+def get_pages: Get the key of every exported page.
+def get_page_path: Get the directory of a page.
+def get_page_outputs: Get the outputs of Basic Mode for a page.
+def render_component: Render a Dash component as HTML.
+def render_page: Render the HTML of a page.
+def export_pages: Export every page to a directory.
+"""
+
+# Export Settings
+default_out_dir = 'static'
+default_app_url = 'https://indoor-covid-safety.herokuapp.com/'
+default_age = 0.68  # the age group and viral strain Basic Mode opens with (see apps/default.py layout)
+default_strain = 1
+default_room = 'classroom'
+default_human = 'masks-2'
+text_width = 1300  # pixels; texts are rendered for a wide display (see essentials.py mobile_width)
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Dash component properties rendered as HTML attributes
+html_attributes = {'id': 'id', 'className': 'class', 'href': 'href', 'target': 'target', 'src': 'src', 'alt': 'alt',
+                   'title': 'title', 'rel': 'rel'}
+void_tags = ['br', 'hr', 'img']
+
+page_template = '''<!DOCTYPE html>
+<html lang="{language}">
+    <head>
+        <meta charset="utf-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>COVID-19 Indoor Safety Guideline</title>
+        <link rel="icon" href="{root}assets/favicon.ico">
+{stylesheets}
+        <style>
+            .static-links a {{ margin-right: 1em; white-space: nowrap; }}
+            .static-links .selected {{ font-weight: bold; }}
+        </style>
+    </head>
+    <body>
+        <div class="grid-header">
+            <div class="card-header">{header}</div>
+            <div class="card-header">
+                <div class="grid-settings">
+                    <div class="card-settings"><div class="settings-header">{language_header}</div>
+                        <div class="static-links">{language_links}</div></div>
+                    <div class="card-settings"><div class="settings-header">{units_header}</div>
+                        <div class="static-links">{units_links}</div></div>
+                </div>
+            </div>
+        </div>
+        <div class="grid">
+            <div class="card">
+                <h4>{room_header}</h4>
+                <div class="static-links">{room_links}</div>
+                <br>
+                <h4>{human_header}</h4>
+                <div class="static-links">{human_links}</div>
+                <br>
+                <div><a href="{app_link}">{custom_inputs}</a></div>
+            </div>
+            <div class="card">
+                <div class="output-content">
+                    <div class="panel-main-output">
+                        <h3>{main_panel}</h3>
+{model_texts}
+                        <br>
+                        <h4 style="color: #000000">{six_ft}</h4>
+                    </div>
+                    <br>
+                    <div class="panel-airb-desc">{airborne_disclaimer}</div>
+                    <div class="panel-airb-desc">{other_risk_modes}</div>
+                </div>
+            </div>
+        </div>
+        <div id="safety-graph"></div>
+        {footer}
+        <script src="{root}assets/plotly.min.js"></script>
+        <script>
+            var figure = {figure};
+            Plotly.newPlot('safety-graph', figure.data, figure.layout, {{responsive: true}});
+        </script>
+    </body>
+</html>
+'''
+
+redirect_template = '''<!DOCTYPE html>
+<html>
+    <head>
+        <meta charset="utf-8">
+        <meta http-equiv="refresh" content="0; url={url}">
+        <title>COVID-19 Indoor Safety Guideline</title>
+    </head>
+    <body><a href="{url}">COVID-19 Indoor Safety Guideline</a></body>
+</html>
+'''
+
+
+# Returns the outputs (id.property) of the app's callback with the given output, in the order it returns them
+def get_output_ids(output):
+    import index
+    for key in index.app.callback_map:
+        output_ids = key.strip('.').split('...')
+        if output in output_ids:
+            return output_ids
+    raise KeyError(output)
+
+
+# Returns the key (language, units, room, human) of every exported page
+def get_pages(languages):
+    import essentials as ess
+    import presets
+    return [(language, units, room, human) for language in languages for units in presets.table_units
+            for room in ess.room_preset_settings for human in ess.human_preset_settings]
+
+
+# Returns the directory of a page, relative to the export directory
+def get_page_path(page):
+    return '/'.join(page)
+
+
+# Returns the outputs of Basic Mode's update_figure for a page: from the preset table, or calculated
+def get_page_outputs(page):
+    import presets
+    language, units, room, human = page
+    outputs = presets.get_preset_outputs(room, human, default_age, default_strain, presets.default_n_max,
+                                         presets.default_exp_time, units, language)
+    if outputs is None:
+        key = (room, human, float(default_age), float(default_strain), units, language)
+        outputs = json.loads(presets.calc_preset_outputs(key))
+    return outputs
+
+
+# Returns a Dash component (or its JSON, a string, a number or a list of these) as HTML. Components of
+# dash_html_components become their tag; others (e.g. dash_core_components) are rendered as their children.
+def render_component(component):
+    if component is None or isinstance(component, bool):
+        return ''
+    if isinstance(component, (list, tuple)):
+        return ''.join(render_component(child) for child in component)
+    if hasattr(component, 'to_plotly_json'):
+        component = component.to_plotly_json()
+    if not isinstance(component, dict):
+        return escape(str(component))
+    props = component.get('props', {})
+    children = render_component(props.get('children'))
+    if component.get('namespace') != 'dash_html_components':
+        return children
+    tag = component['type'].lower()
+    attributes = ''.join(' {}="{}"'.format(attribute, escape(str(props[prop])))
+                         for prop, attribute in html_attributes.items() if props.get(prop) is not None)
+    if props.get('style'):
+        style = '; '.join('{}: {}'.format(''.join('-' + char.lower() if char.isupper() else char for char in name),
+                                           value) for name, value in props['style'].items())
+        attributes += ' style="{}"'.format(escape(style))
+    if tag in void_tags:
+        return '<{}{}>'.format(tag, attributes)
+    return '<{0}{1}>{2}</{0}>'.format(tag, attributes, children)
+
+
+# Returns the HTML of a page from its outputs (see get_page_outputs)
+def render_page(page, outputs, app_url, languages):
+    import descriptions as desc
+    import essentials as ess
+    import index
+    import presets
+    language, units, room, human = page
+    desc_file = ess.get_desc_file(language)
+    header, language_header, units_header, _, unit_settings, _, footer = ess.get_header_and_footer_text(language)
+    root = '../' * len(page)
+
+    # Links to the pages differing from this one in the given position, for the options exported there
+    def get_links(options, position, values):
+        links = []
+        for option in options:
+            if option['value'] in values:
+                target = page[:position] + (option['value'],) + page[position + 1:]
+                selected = ' class="selected"' if target == page else ''
+                links.append('<a href="{}{}/index.html"{}>{}</a>'.format(root, get_page_path(target), selected,
+                                                                         escape(option['label'])))
+        return ' '.join(links)
+
+    figure_outputs = dict(zip(get_output_ids('safety-graph.figure'), outputs))
+    model_texts = '\n'.join('                        <h4 class="model-output-text">{}</h4>'.format(
+        escape(figure_outputs['model-text-{}.children'.format(index_text)])) for index_text in range(1, 6))
+    six_ft = '{}<span style="color: #de1616">{}</span>{}<span style="color: #de1616">{}</span>{}'.format(
+        render_component(desc_file.main_panel_six_ft_1), escape(figure_outputs['six-ft-output.children']),
+        render_component(desc_file.main_panel_six_ft_2), escape(figure_outputs['six-ft-output-t.children']),
+        render_component(getattr(desc_file, 'main_panel_six_ft_3', '')))
+    app_search = '&'.join((['units=metric'] if units == 'metric' else []) + (['lang=' + language] if language != 'en'
+                                                                             else []))
+    stylesheets = '\n'.join('        <link rel="stylesheet" href="{}assets/{}">'.format(root, file_name)
+                            for file_name in sorted(os.listdir(os.path.join(repo_dir, 'assets')))
+                            if file_name.endswith('.css'))
+    return page_template.format(
+        language=language, root=root, stylesheets=stylesheets, header=render_component(header),
+        language_header=escape(language_header), language_links=get_links(index.languages, 0, languages),
+        units_header=escape(units_header), units_links=get_links(unit_settings, 1, presets.table_units),
+        room_header=escape(desc_file.curr_room_header),
+        room_links=get_links(desc_file.presets, 2, ess.room_preset_settings),
+        human_header=escape(desc_file.curr_human_header),
+        human_links=get_links(desc_file.presets_human, 3, ess.human_preset_settings),
+        app_link=escape(app_url + ('?' + app_search if app_search else '')),
+        custom_inputs=escape(getattr(desc_file, 'static_custom_inputs', desc.static_custom_inputs)),
+        main_panel=render_component(desc_file.main_panel_s1), model_texts=model_texts, six_ft=six_ft,
+        airborne_disclaimer=render_component(desc_file.main_airb_trans_only_disc_basic),
+        other_risk_modes=render_component(desc_file.other_risk_modes_desc), footer=render_component(footer),
+        figure=json.dumps(figure_outputs['safety-graph.figure'], separators=(',', ':')).replace('</', '<\\/'))
+
+
+# Exports every page (see get_pages) in the enabled languages, with the assets they use, to out_dir (replacing its
+# pages). app_url is the interactive app the pages link to for custom inputs. Returns the number of pages.
+def export_pages(out_dir, app_url):
+    import essentials as ess
+    import warmup
+    languages = warmup.get_enabled_languages()
+
+    asset_dir = os.path.join(out_dir, 'assets')
+    shutil.rmtree(asset_dir, ignore_errors=True)
+    shutil.copytree(os.path.join(repo_dir, 'assets'), asset_dir)
+    with open(os.path.join(asset_dir, 'plotly.min.js'), 'w', encoding='utf-8') as script:
+        script.write(plotly.offline.get_plotlyjs())
+
+    text_ids = get_output_ids('curr-room-header.children')
+    for language in languages:
+        shutil.rmtree(os.path.join(out_dir, language), ignore_errors=True)
+        os.makedirs(os.path.join(out_dir, language))
+        with open(os.path.join(out_dir, language, 'texts.json'), 'w', encoding='utf-8') as texts:
+            json.dump(dict(zip(text_ids, ess.get_lang_text_basic(language, text_width))), texts,
+                      cls=plotly.utils.PlotlyJSONEncoder, ensure_ascii=False)
+
+    pages = get_pages(languages)
+    figure_ids = get_output_ids('safety-graph.figure')
+    for page in pages:
+        outputs = get_page_outputs(page)
+        page_dir = os.path.join(out_dir, *page)
+        os.makedirs(page_dir, exist_ok=True)
+        with open(os.path.join(page_dir, 'figure.json'), 'w', encoding='utf-8') as figure:
+            json.dump(outputs[0], figure, separators=(',', ':'))
+        with open(os.path.join(page_dir, 'texts.json'), 'w', encoding='utf-8') as texts:
+            json.dump(dict(zip(figure_ids[1:], outputs[1:])), texts, ensure_ascii=False)
+        with open(os.path.join(page_dir, 'index.html'), 'w', encoding='utf-8') as page_file:
+            page_file.write(render_page(page, outputs, app_url, languages))
+
+    with open(os.path.join(out_dir, 'index.html'), 'w', encoding='utf-8') as root_page:
+        root_page.write(redirect_template.format(
+            url=get_page_path(('en', 'british', default_room, default_human)) + '/index.html'))
+    return len(pages)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, repo_dir)
+    import tempfile
+    os.environ.setdefault('SCENARIO_DB', os.path.join(tempfile.gettempdir(), 'static_export_scenarios.db'))
+
+    parser = argparse.ArgumentParser(description="Export Basic Mode's preset pages to static files.")
+    parser.add_argument('--out', default=default_out_dir, help='export directory (default: static)')
+    parser.add_argument('--app-url', default=default_app_url, help='the interactive app, linked for custom inputs')
+    args = parser.parse_args()
+    export_start = time.perf_counter()
+    count = export_pages(args.out, args.app_url)
+    print('Exported {} pages in {:.1f} s to {}'.format(count, time.perf_counter() - export_start, args.out))
@@ -0,0 +1,20 @@
+import json
+
+import api
+import index
+
+client = index.app.server.test_client()
+
+
+# Returns the response of a POST of a JSON body to an API endpoint
+def post_json(path, body):
+    return client.post(path, data=json.dumps(body), content_type='application/json', base_url='https://localhost')
+
+
+# Optimization has a lower room limit than solving: every room evaluates every candidate upgrade
+def test_optimize_room_limit():
+    room = {'room': 'classroom', 'human': 'masks-2', 'n': 10, 't': 4}
+    response = post_json('/api/optimize', {'rooms': [room] * (api.max_optimize_rooms + 1)})
+    assert response.status_code == 400
+    assert str(api.max_optimize_rooms) in json.loads(response.get_data())['error']
+    assert post_json('/api/optimize', {'rooms': [room] * 2}).status_code == 200
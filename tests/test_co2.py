@@ -0,0 +1,36 @@
+import datetime
+import io
+import json
+
+import numpy
+import pandas as pd
+
+import co2
+
+
+# Returns a CO2 log (CSV text) of one room decaying after occupancy, with datetime timestamps at the given UTC offset
+# (hours)
+def get_decay_log(utc_offset):
+    utc_offset = datetime.timezone(datetime.timedelta(hours=utc_offset))
+    times = pd.date_range('2021-03-01T08:00:00', periods=120, freq='2min', tz='UTC').tz_convert(utc_offset)
+    hours = numpy.arange(120) / 30
+    co2_values = numpy.where(hours < 2, 420 + 800 * hours / 2, 420 + 800 * numpy.exp(-2 * (hours - 2)))
+    return pd.DataFrame({'room': '101', 'timestamp': [time.isoformat() for time in times],
+                         'co2': co2_values}).to_csv(index=False)
+
+
+# Timestamps with a UTC offset fit the same as the same instants in UTC
+def test_read_co2_log_utc_offset():
+    fits = co2.read_co2_log(io.StringIO(get_decay_log(1)))
+    utc_fits = co2.read_co2_log(io.StringIO(get_decay_log(0)))
+    assert fits['n_decays'][0] > 0
+    assert numpy.isclose(fits['air_exch_rate'][0], utc_fits['air_exch_rate'][0])
+
+
+# An upload with offset timestamps is fitted, not a server error
+def test_post_co2_utc_offset():
+    import index
+    client = index.app.server.test_client()
+    response = client.post('/api/co2', data=get_decay_log(1), base_url='https://localhost')
+    assert response.status_code == 200
+    assert json.loads(response.get_data())['rooms']['n_decays'] == [1]
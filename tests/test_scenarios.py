@@ -0,0 +1,12 @@
+import scenarios
+
+
+# Comparisons over different exposure times do not share cached curves
+def test_compare_scenarios_exp_times(tmp_path):
+    store = scenarios.ScenarioStore(str(tmp_path / 'scenarios.db'))
+    ids = store.save_scenarios([{'name': 'a', 'inputs': {}}, {'name': 'b', 'inputs': {'air_exchange_rate': 6}}])
+    default = store.compare_scenarios(ids)
+    short = store.compare_scenarios(ids, exp_times=[1, 2, 4])
+    assert short['curves'].shape == (2, 3)
+    assert default['curves'].shape == (2, len(default['exp_times']))
+    assert (short['curves'][:, 2] == store.compare_scenarios(ids, exp_times=[4])['curves'][:, 0]).all()
@@ -0,0 +1,19 @@
+import numpy
+
+import scheduler
+
+
+# Meetings overlapping by less than float32's resolution at epoch-hours start times must not share a room
+def test_assign_meetings_large_start_times():
+    spare = numpy.zeros((2, 2), dtype=numpy.float32)
+    start = [493000, 493000.99]
+    assignment = scheduler.assign_meetings(spare, start, [1, 1])
+    assert assignment[0] != assignment[1]
+    assert (assignment >= 0).all()
+
+
+# A room is free again once its previous meeting ends
+def test_assign_meetings_reuses_freed_room():
+    spare = numpy.zeros((1, 2), dtype=numpy.float32)
+    assignment = scheduler.assign_meetings(spare, [493000, 493001], [1, 1])
+    assert assignment.tolist() == [0, 0]
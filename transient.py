@@ -0,0 +1,130 @@
+import numpy
+
+"""
+transient.py simulates the well-mixed room of the model (indoors.py) through a day with changing occupancy,
+infectors and HVAC settings. Schedules are piecewise constant: within each segment the occupancy, number of infectors,
+outdoor air exchange rate, recirculation rate and filtration efficiency are fixed, and the concentration of infectious
+aerosol relaxes exponentially towards its steady state. Each segment is solved exactly,
+
+    C(t) = C_ss + (C_0 - C_ss) exp(-conc_relax_rate * t),   C_ss = infectors * emission / (room_vol * conc_relax_rate)
+
+so there is no ODE stepping, only one vectorized update per segment across every room and day in the batch.
+
+With one infector arriving at a clean room and constant settings, the expected transmissions approach
+Indoors.calc_exp_trans over long exposures (calc_n_max uses a simpler approximation of the startup transient).
+
+Methods:
+def get_room_value: Reshape a per-room model value to broadcast against schedules.
+def get_schedule_rates: Calculate the concentration relaxation rate and source strength of every segment.
+def simulate_schedule: Simulate concentration, dose and expected transmissions through piecewise-constant schedules.
+def sample_concentration: Evaluate the exact concentration at arbitrary times within a simulated schedule.
+"""
+
+
+# Reshapes per-room arrays of a batch model (one entry per room) so they broadcast against schedules of the given
+# number of dimensions, indexed by [room, ..., segment]. Scalars are returned unchanged.
+def get_room_value(value, n_dims):
+    if numpy.ndim(value) == 0:
+        return value
+    return numpy.reshape(value, (-1,) + (1,) * (n_dims - 1))
+
+
+# Calculate the concentration relaxation rate (/hr) of every segment, and the source strength (quanta/m3/hr) of one
+# infector. Schedules of air_exch_rate and recirc_rate (/hr) and aerosol_filtration_eff default to the model's values;
+# viral deactivation and settling are taken from the model.
+def get_schedule_rates(indoor_model, n_dims, air_exch_rate=None, recirc_rate=None, aerosol_filtration_eff=None):
+    model_air_exch_rate = indoor_model.physical_params[2]  # /hr
+    model_recirc_rate = model_air_exch_rate * (1 / indoor_model.physical_params[3] - 1)  # /hr
+    model_filtration_eff = indoor_model.physical_params[4]
+    other_rate = indoor_model.conc_relax_rate - model_air_exch_rate - indoor_model.air_filt_rate  # /hr
+    if air_exch_rate is None:
+        air_exch_rate = get_room_value(model_air_exch_rate, n_dims)
+    if recirc_rate is None:
+        recirc_rate = get_room_value(model_recirc_rate, n_dims)
+    if aerosol_filtration_eff is None:
+        aerosol_filtration_eff = get_room_value(model_filtration_eff, n_dims)
+    conc_relax_rate = numpy.asarray(air_exch_rate) + numpy.asarray(aerosol_filtration_eff) * numpy.asarray(
+        recirc_rate) + get_room_value(other_rate, n_dims)  # /hr
+
+    # One infector exhales through their mask (breathing flow rate * mask passage * infectiousness)
+    room_vol_m = 0.0283168 * indoor_model.room_vol  # m3
+    emission = indoor_model.physio_params[0] * indoor_model.prec_params[0] * indoor_model.disease_params[0] * \
+        indoor_model.relative_sus  # quanta/hr
+    return conc_relax_rate, get_room_value(emission / room_vol_m, n_dims)
+
+
+# Simulate a piecewise-constant schedule. Every schedule array is indexed by [..., segment] and broadcasts against
+# the others, so the leading dimensions can hold rooms, days or scenarios (if the model has one entry per room, rooms
+# must be the first dimension).
+# durations: segment lengths (hours), occupancy: people present (including infectors), infectors: infected people
+# present, air_exch_rate, recirc_rate (/hr), aerosol_filtration_eff: optional HVAC schedules
+# initial_conc: concentration (quanta/m3) at the start of the schedule (0 for a clean room)
+# Returns a dictionary of arrays indexed by [..., segment]:
+#     'start_time', 'end_time': segment bounds (hours)
+#     'start_conc', 'end_conc', 'mean_conc': concentration (quanta/m3) at the start, end and averaged over each segment
+#     'dose': quanta inhaled (through the mask, scaled by relative susceptibility) by one susceptible person present
+#             for the whole segment, and 'cumulative_dose' up to the end of each segment
+#     'exp_trans': expected transmissions among the susceptible people present, and 'cumulative_exp_trans'
+#     plus the 'conc_relax_rate' and 'steady_conc' of each segment
+def simulate_schedule(indoor_model, durations, occupancy, infectors, air_exch_rate=None, recirc_rate=None,
+                      aerosol_filtration_eff=None, initial_conc=0):
+    durations, occupancy, infectors = numpy.broadcast_arrays(*[numpy.asarray(value, dtype=float) for value in
+                                                               [durations, occupancy, infectors]])
+    n_dims = durations.ndim
+    conc_relax_rate, source = get_schedule_rates(indoor_model, n_dims, air_exch_rate, recirc_rate,
+                                                 aerosol_filtration_eff)
+    shape = numpy.broadcast(durations, conc_relax_rate, source).shape
+    conc_relax_rate = numpy.broadcast_to(conc_relax_rate, shape)
+    steady_conc = numpy.broadcast_to(infectors * source, shape) / conc_relax_rate
+    durations = numpy.broadcast_to(durations, shape)
+
+    # Exact solution of each segment; only the starting concentration carries over between segments
+    decay = numpy.exp(-conc_relax_rate * durations)
+    relax_frac = -numpy.expm1(-conc_relax_rate * durations) / conc_relax_rate  # integral of exp(-rate t) over segment
+    start_conc = numpy.empty(shape)
+    conc = numpy.broadcast_to(numpy.asarray(initial_conc, dtype=float), shape[:-1]).copy()
+    for segment in range(shape[-1]):
+        start_conc[..., segment] = conc
+        conc = steady_conc[..., segment] + (conc - steady_conc[..., segment]) * decay[..., segment]
+    end_conc = steady_conc + (start_conc - steady_conc) * decay
+    conc_integral = steady_conc * durations + (start_conc - steady_conc) * relax_frac  # quanta hr/m3
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_conc = numpy.where(durations > 0, conc_integral / durations, start_conc)
+
+    # Susceptible people inhale through their masks; relative susceptibility is already in the infectiousness
+    inhale_rate = get_room_value(indoor_model.physio_params[0] * indoor_model.prec_params[0], n_dims)  # m3/hr
+    dose = inhale_rate * conc_integral
+    susceptible = numpy.maximum(occupancy - infectors, 0) * get_room_value(indoor_model.percentage_sus, n_dims)
+    exp_trans = susceptible * dose
+    end_time = numpy.cumsum(durations, axis=-1)
+
+    return {
+        'start_time': end_time - durations,
+        'end_time': end_time,
+        'start_conc': start_conc,
+        'end_conc': end_conc,
+        'mean_conc': mean_conc,
+        'dose': dose,
+        'cumulative_dose': numpy.cumsum(dose, axis=-1),
+        'exp_trans': exp_trans,
+        'cumulative_exp_trans': numpy.cumsum(exp_trans, axis=-1),
+        'conc_relax_rate': conc_relax_rate,
+        'steady_conc': steady_conc,
+    }
+
+
+# Evaluate the exact concentration (quanta/m3) of a simulated schedule (see simulate_schedule) at the given times
+# (hours from the start of the schedule; times past the end continue the last segment). Returns an array indexed by
+# [..., time].
+def sample_concentration(result, times):
+    times = numpy.asarray(times, dtype=float)
+    start_time = result['start_time']
+    n_segments = start_time.shape[-1]
+    # Segment of each time, from the segment bounds
+    segment = numpy.clip((times[..., numpy.newaxis] >= start_time[..., numpy.newaxis, :]).sum(axis=-1) - 1,
+                         0, n_segments - 1)
+    elapsed = times - numpy.take_along_axis(start_time, segment, axis=-1)
+    start_conc = numpy.take_along_axis(result['start_conc'], segment, axis=-1)
+    steady_conc = numpy.take_along_axis(result['steady_conc'], segment, axis=-1)
+    conc_relax_rate = numpy.take_along_axis(result['conc_relax_rate'], segment, axis=-1)
+    return steady_conc + (start_conc - steady_conc) * numpy.exp(-conc_relax_rate * elapsed)
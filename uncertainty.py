@@ -0,0 +1,301 @@
+import numpy
+import multiprocessing
+from multiprocessing import shared_memory, util
+
+from indoors import Indoors
+
+"""
+uncertainty.py propagates uncertainty in the model parameters (indoors.py) through to the model outputs, using Monte
+Carlo sampling. Samples are drawn from user-specified distributions and evaluated in vectorized chunks over the same
+equations as the point estimate (calc_n_max / calc_max_time). Outputs are accumulated in a streaming log-histogram, so
+memory stays bounded no matter how many samples are drawn.
+
+Distribution specifications (spec): dictionary of parameter name (see Indoors.param_locations) to a tuple of
+    ('fixed', value)
+    ('uniform', low, high)
+    ('normal', mean, standard deviation)
+    ('lognormal', median, geometric standard deviation)
+    ('triangular', low, mode, high)
+
+Properties:
+Histogram Setup
+Default Settings
+Parallel Settings
+
+Methods:
+def sample_params: Draws samples of each parameter in a distribution specification.
+def calc_n_max_samples: Calculate maximum occupancy for every sample across a range of exposure times.
+def calc_max_time_samples: Calculate maximum exposure time for every sample across a range of occupancies.
+def add_samples_to_hist: Draw, evaluate and histogram samples chunk by chunk.
+def run_monte_carlo: Run a Monte Carlo study, returning the requested percentiles of the output.
+def run_monte_carlo_parallel: Run Monte Carlo studies of many rooms across a process pool, sharing buffers between
+                              processes through shared memory.
+def init_worker: Attach a pool worker to the shared buffers of a parallel run.
+def run_worker_block: Evaluate one block of samples of one room in a pool worker.
+
+class LogHistogram: Streaming, mergeable histogram of positive values on a logarithmic grid, used to estimate
+                    quantiles in bounded memory.
+"""
+
+# Histogram Setup
+# Bins cover 1e-4 to 1e8 with 200 bins per decade (~1.2% relative resolution), plus an underflow and overflow bin.
+hist_min_exp = -4
+hist_max_exp = 8
+hist_bins_per_decade = 200
+
+# Default Settings
+default_n_samples = 20000
+default_chunk_size = 10000
+default_percentiles = [5, 25, 50, 75, 95]
+
+# Parallel Settings
+# Each room's samples are split into this many blocks per worker, so faster workers pick up the slack.
+blocks_per_worker = 4
+
+# Shared buffers of a parallel run, as seen from inside a pool worker (see init_worker)
+worker_state = {}
+
+# Valid range of sampled parameters. Samples outside the range are clipped.
+param_bounds = {
+    'primary_outdoor_air_fraction': (1e-6, 1),
+    'aerosol_filtration_eff': (0, 1),
+    'relative_humidity': (0.01, 0.99),
+    'mask_passage_prob': (0, 1),
+    'percentage_sus': (0, 1),
+    'prevalence': (1e-9, 1),
+}
+
+
+class LogHistogram:
+    """
+    Streaming histogram of positive values on a fixed logarithmic grid, with one histogram per output column.
+    Histograms with the same shape can be merged by adding their counts, so partial results from different chunks or
+    processes combine exactly.
+    """
+
+    def __init__(self, n_cols, counts=None):
+        self.edges = numpy.logspace(hist_min_exp, hist_max_exp,
+                                    (hist_max_exp - hist_min_exp) * hist_bins_per_decade + 1)
+        self.n_bins = len(self.edges) + 1
+        self.n_cols = n_cols
+        if counts is None:
+            counts = numpy.zeros((n_cols, self.n_bins), dtype=numpy.int64)
+        self.counts = counts
+
+    # Add a 2D array of values (samples x columns) to the histogram
+    def add(self, values):
+        # Bin i holds values in (edges[i - 1], edges[i]], so the index follows directly from the log of the value
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            bin_pos = numpy.ceil((numpy.log10(values) - hist_min_exp) * hist_bins_per_decade)
+        bin_pos = numpy.nan_to_num(bin_pos, nan=len(self.edges), neginf=0)
+        bin_ind = numpy.clip(bin_pos, 0, len(self.edges)).astype(numpy.int64)
+        bin_ind += numpy.arange(self.n_cols) * self.n_bins
+        self.counts += numpy.bincount(bin_ind.ravel(), minlength=self.n_cols * self.n_bins).reshape(self.counts.shape)
+
+    # Merge the counts of another histogram with the same shape into this one
+    def merge(self, other):
+        self.counts += other.counts
+
+    # Get the total number of values added to each column
+    def get_count(self):
+        return self.counts.sum(axis=1)
+
+    # Get the given percentiles (0-100) of each column, interpolating geometrically within bins.
+    # Returns a 2D array indexed by [percentile, column].
+    def get_percentiles(self, percentiles):
+        cum_counts = numpy.cumsum(self.counts, axis=1)
+        total = cum_counts[:, -1:]
+        log_edges = numpy.log10(self.edges)
+        # Bin i holds values in (edges[i - 1], edges[i]]; the outer bins are clamped to the grid limits
+        log_lower = numpy.concatenate(([log_edges[0]], log_edges))
+        log_upper = numpy.concatenate((log_edges, [log_edges[-1]]))
+
+        output = numpy.zeros((len(percentiles), self.n_cols))
+        for index, percentile in enumerate(percentiles):
+            target = total * percentile / 100
+            bin_ind = numpy.argmax(cum_counts >= numpy.maximum(target, 1), axis=1)
+            cols = numpy.arange(self.n_cols)
+            below = cum_counts[cols, bin_ind] - self.counts[cols, bin_ind]
+            frac = (target[:, 0] - below) / numpy.maximum(self.counts[cols, bin_ind], 1)
+            frac = numpy.clip(frac, 0, 1)
+            output[index] = 10 ** (log_lower[bin_ind] + frac * (log_upper[bin_ind] - log_lower[bin_ind]))
+
+        output[:, total[:, 0] == 0] = numpy.nan
+        return output
+
+
+# Draws n_samples samples of each parameter in the given distribution specification.
+# rng: numpy.random.Generator
+# Returns a dictionary of parameter name to a 1D array of samples.
+def sample_params(spec, n_samples, rng):
+    samples = {}
+    for name in spec:
+        dist = spec[name]
+        if dist[0] == 'fixed':
+            values = numpy.full(n_samples, float(dist[1]))
+        elif dist[0] == 'uniform':
+            values = rng.uniform(dist[1], dist[2], n_samples)
+        elif dist[0] == 'normal':
+            values = rng.normal(dist[1], dist[2], n_samples)
+        elif dist[0] == 'lognormal':
+            values = dist[1] * numpy.exp(numpy.log(dist[2]) * rng.standard_normal(n_samples))
+        elif dist[0] == 'triangular':
+            values = rng.triangular(dist[1], dist[2], dist[3], n_samples)
+        else:
+            raise ValueError("Unknown distribution '{}' for parameter '{}'".format(dist[0], name))
+
+        low, high = param_bounds.get(name, (0, numpy.inf))
+        samples[name] = numpy.clip(values, low, high)
+
+    return samples
+
+
+# Calculate maximum people allowed in the room for every sample, across the given exposure times (hours).
+# Returns a 2D array indexed by [sample, exposure time].
+def calc_n_max_samples(indoor_model, samples, exp_times, risk_type='conditional'):
+    sample_model = indoor_model.copy_with_params(**{name: samples[name][:, numpy.newaxis] for name in samples})
+    n_max = sample_model.calc_n_max(numpy.asarray(exp_times, dtype=float)[numpy.newaxis, :], risk_type)
+    return numpy.broadcast_to(n_max, (len(next(iter(samples.values()))), len(exp_times)))
+
+
+# Calculate maximum exposure time (hours) for every sample, across the given occupancies.
+# Returns a 2D array indexed by [sample, occupancy].
+def calc_max_time_samples(indoor_model, samples, n_maxes, risk_type='conditional'):
+    sample_model = indoor_model.copy_with_params(**{name: samples[name][:, numpy.newaxis] for name in samples})
+    max_time = sample_model.calc_max_time(numpy.asarray(n_maxes, dtype=float)[numpy.newaxis, :], risk_type)
+    return numpy.broadcast_to(max_time, (len(next(iter(samples.values()))), len(n_maxes)))
+
+
+# Draw n_samples samples from the given specification, evaluate them chunk by chunk and add the output to hist.
+def add_samples_to_hist(indoor_model, spec, x_vals, output, risk_type, n_samples, rng, hist,
+                        chunk_size=default_chunk_size):
+    n_done = 0
+    while n_done < n_samples:
+        n_chunk = min(chunk_size, n_samples - n_done)
+        samples = sample_params(spec, n_chunk, rng)
+        if output == 'n_max':
+            hist.add(calc_n_max_samples(indoor_model, samples, x_vals, risk_type))
+        else:
+            hist.add(calc_max_time_samples(indoor_model, samples, x_vals, risk_type))
+        n_done += n_chunk
+
+
+# Run a Monte Carlo study of the model. Samples are drawn and evaluated chunk by chunk, and only the histogram of the
+# output is kept between chunks.
+# output: 'n_max' (x_vals are exposure times, hours) or 'max_time' (x_vals are occupancies)
+# Returns a dictionary of percentile to a 1D array of output values across x_vals.
+def run_monte_carlo(indoor_model, spec, x_vals, output='n_max', risk_type='conditional',
+                    n_samples=default_n_samples, percentiles=None, seed=None, chunk_size=default_chunk_size):
+    if percentiles is None:
+        percentiles = default_percentiles
+
+    hist = LogHistogram(len(x_vals))
+    add_samples_to_hist(indoor_model, spec, x_vals, output, risk_type, n_samples, numpy.random.default_rng(seed),
+                        hist, chunk_size)
+
+    output_vals = hist.get_percentiles(percentiles)
+    return {percentile: output_vals[index] for index, percentile in enumerate(percentiles)}
+
+
+# Run Monte Carlo studies of many rooms (a list of Indoors models) across a pool of worker processes.
+# Nothing but block indices is pickled per task: the room parameters are read from, and the output histograms are
+# written to, shared memory, and samples are drawn directly inside the workers. Every block of every room draws from
+# its own random stream (spawned from seed), so results are reproducible regardless of which worker runs which block.
+# n_samples: number of samples per room
+# n_workers: number of processes (default: number of CPUs)
+# Returns a list with one dictionary of percentile to output values per room, and a list of the merged histograms.
+def run_monte_carlo_parallel(indoor_models, spec, x_vals, output='n_max', risk_type='conditional',
+                             n_samples=default_n_samples, percentiles=None, seed=None, n_workers=None,
+                             chunk_size=default_chunk_size):
+    if percentiles is None:
+        percentiles = default_percentiles
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    param_names = list(Indoors.param_locations)
+    n_cols = len(x_vals)
+    n_bins = LogHistogram(0).n_bins
+    n_blocks = n_workers * blocks_per_worker
+    block_sizes = numpy.full(n_blocks, n_samples // n_blocks)
+    block_sizes[:n_samples % n_blocks] += 1
+    root_seed = numpy.random.SeedSequence(seed).entropy
+
+    room_shm = shared_memory.SharedMemory(create=True, size=max(len(indoor_models) * len(param_names) * 8, 1))
+    hist_shm = shared_memory.SharedMemory(create=True, size=n_workers * n_cols * n_bins * 8)
+    try:
+        room_params = numpy.ndarray((len(indoor_models), len(param_names)), dtype=numpy.float64, buffer=room_shm.buf)
+        for room_ind, indoor_model in enumerate(indoor_models):
+            room_params[room_ind] = [indoor_model.get_param(name) for name in param_names]
+        hist_counts = numpy.ndarray((n_workers, n_cols, n_bins), dtype=numpy.int64, buffer=hist_shm.buf)
+
+        room_percentiles = []
+        room_hists = []
+        # Histogram slots not claimed by a live worker. A worker gives its slot back when it exits, so a worker the pool
+        # starts in its place claims the same slot (there are never more than n_workers live workers).
+        free_slots = multiprocessing.SimpleQueue()
+        for slot in range(n_workers):
+            free_slots.put(slot)
+        init_args = (free_slots, room_shm.name, len(indoor_models), hist_shm.name, n_workers, spec,
+                     numpy.asarray(x_vals, dtype=float), output, risk_type, chunk_size, root_seed)
+        with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=init_args) as pool:
+            for room_ind in range(len(indoor_models)):
+                hist_counts[:] = 0
+                tasks = [(room_ind, block_ind, int(block_sizes[block_ind])) for block_ind in range(n_blocks)]
+                pool.map(run_worker_block, tasks, chunksize=1)
+
+                # Merge step: the per-worker histograms add up to the histogram of the whole room
+                hist = LogHistogram(n_cols, hist_counts.sum(axis=0))
+                output_vals = hist.get_percentiles(percentiles)
+                room_percentiles.append({percentile: output_vals[index]
+                                         for index, percentile in enumerate(percentiles)})
+                room_hists.append(hist)
+
+        del room_params, hist_counts
+    finally:
+        room_shm.close()
+        room_shm.unlink()
+        hist_shm.close()
+        hist_shm.unlink()
+
+    return room_percentiles, room_hists
+
+
+# Attach a pool worker to the shared buffers of a parallel run, and claim a free histogram slot, given back when the
+# worker exits. The counts a replaced worker left in its slot stay there, and are merged with those of the others.
+def init_worker(free_slots, room_shm_name, n_rooms, hist_shm_name, n_workers, spec, x_vals, output, risk_type,
+                chunk_size, root_seed):
+    slot = free_slots.get()
+    util.Finalize(None, free_slots.put, args=(slot,), exitpriority=10)
+
+    param_names = list(Indoors.param_locations)
+    room_shm = shared_memory.SharedMemory(name=room_shm_name)
+    hist_shm = shared_memory.SharedMemory(name=hist_shm_name)
+    hist = LogHistogram(len(x_vals))
+    worker_state.update({
+        'room_shm': room_shm,
+        'hist_shm': hist_shm,
+        'room_params': numpy.ndarray((n_rooms, len(param_names)), dtype=numpy.float64, buffer=room_shm.buf),
+        'hist_counts': numpy.ndarray((n_workers, len(x_vals), hist.n_bins), dtype=numpy.int64,
+                                     buffer=hist_shm.buf)[slot],
+        'param_names': param_names,
+        'base_model': Indoors(),
+        'spec': spec,
+        'x_vals': x_vals,
+        'output': output,
+        'risk_type': risk_type,
+        'chunk_size': chunk_size,
+        'root_seed': root_seed,
+    })
+
+
+# Evaluate one block of samples of one room, adding the output to this worker's shared histogram slot.
+# task: (room index, block index, number of samples)
+def run_worker_block(task):
+    room_ind, block_ind, n_samples = task
+    state = worker_state
+    room_model = state['base_model'].copy_with_params(**dict(zip(state['param_names'],
+                                                                 state['room_params'][room_ind])))
+    rng = numpy.random.default_rng(numpy.random.SeedSequence(state['root_seed'], spawn_key=(room_ind, block_ind)))
+    hist = LogHistogram(len(state['x_vals']), state['hist_counts'])
+    add_samples_to_hist(room_model, state['spec'], state['x_vals'], state['output'], state['risk_type'], n_samples,
+                        rng, hist, state['chunk_size'])
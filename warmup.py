@@ -0,0 +1,161 @@
+import gc
+import json
+import os
+import re
+import sys
+import time
+
+"""
+warmup.py prepares a server process before gunicorn forks its workers (see gunicorn.conf.py, which preloads the app),
+so that every worker starts with what its first requests need, shared copy-on-write with the master: the localized
+texts of every enabled language (essentials.py lang_text_cache), plotly's figure template and the validators plotly
+creates on first use, the precomputed outputs of Basic Mode's presets (presets.py), the serialized page layouts, the
+compressed layout, callback graph and scripts (app.py static_responses), and the code paths of every callback, run by
+loading both pages in every language and changing to each preset.
+
+What this saves a new worker's first page load depends on the runtime, and on one CPU it is within the run-to-run
+variation. Measured with python warmup.py on one CPU, the first Advanced Mode page load took 202-313 ms (median 242 ms)
+with warmup and 277-331 ms (median 302 ms) without on Python 3.8 with the pinned requirements (six runs), and 215-218 ms
+with warmup and 217-234 ms without on Python 3.11 (three runs).
+
+Once warm, the objects built are moved out of the garbage collector's reach (gc.freeze), so collections in the workers
+do not write to the pages they share with the master.
+
+Usage: python warmup.py - warm up, then compare the first requests of a forked worker with later ones (the timings vary
+from run to run, so compare several runs)
+
+Properties:
+Warmup Settings
+
+Methods:
+def get_enabled_languages: Get the languages offered in the language dropdown.
+def warm_up: Build what workers share before forking.
+def freeze: Keep the objects built so far out of garbage collection.
+def time_forked_session: Time the first page loads of a forked process.
+"""
+
+# Warmup Settings
+warmup_widths = [1000, 1300]  # a narrow and a wide display (see essentials.py mobile_width)
+
+
+# Returns the values of the languages offered in the language dropdown (see index.py languages)
+def get_enabled_languages():
+    import index
+    return [language['value'] for language in index.languages if not language.get('disabled', False)]
+
+
+# Build what workers share before forking: localized texts, figure templates, the preset table, serialized layouts,
+# compressed static responses, and the callbacks of both pages in every enabled language and for every preset
+# (through the Flask test client, as the renderer calls them). Callback metrics are not recorded meanwhile. Returns
+# the seconds spent on each step.
+def warm_up():
+    import plotly.io
+    import plotly.utils
+
+    import app
+    import essentials as ess
+    import index
+    import metrics
+    import payloads
+    import presets
+
+    timings = {}
+    languages = get_enabled_languages()
+    metrics.callback_metrics.recording = False
+    try:
+        start = time.perf_counter()
+        for language in languages:
+            ess.get_header_and_footer_text(language)
+            for width in warmup_widths:
+                ess.get_lang_text_basic(language, width)
+                ess.get_lang_text_adv(language, width)
+        timings['texts'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        plotly.io.templates[plotly.io.templates.default]
+        model = ess.get_preset_model('classroom', 'masks-2')
+        for language in languages:
+            ess.get_model_figure(model, language).to_plotly_json()
+        timings['figures'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        presets.load_preset_table()
+        timings['presets'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        client = index.app.server.test_client()
+        for path in ['/_dash-layout', '/_dash-dependencies']:
+            client.get(path, base_url=payloads.base_url)
+        for layout in payloads.page_layouts.values():
+            json.dumps(layout, cls=plotly.utils.PlotlyJSONEncoder)
+        timings['layouts'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        page = client.get('/', base_url=payloads.base_url).get_data(as_text=True)
+        for path in app.static_paths + re.findall(r'src="(/_dash-component-suites/[^"]+)"', page):
+            for encoding in app.encodings:
+                client.get(path, base_url=payloads.base_url, headers={'Accept-Encoding': encoding})
+        timings['compression'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for mode in payloads.page_layouts:
+            for language in languages:
+                payloads.run_session(client, mode, [], '' if language == 'en' else '?lang=' + language)
+            preset_actions = [action for action in payloads.get_session_actions(mode)
+                              if next(iter(action))[0].startswith(payloads.page_prefixes[mode] + 'presets')]
+            payloads.run_session(client, mode, preset_actions)
+        timings['callbacks'] = time.perf_counter() - start
+    finally:
+        metrics.callback_metrics.reset()
+        metrics.callback_metrics.recording = True
+    return timings
+
+
+# Collects garbage and moves every object built so far to the permanent generation (Python 3.7+), so the workers'
+# collections do not touch, and copy, the memory they share with the master
+def freeze():
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+# Loads a page (its page load session, in French) twice in a forked process, as in a new gunicorn worker. Returns the
+# seconds taken by the first load and by the second.
+def time_forked_session(mode):
+    import index
+    import payloads
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        client = index.app.server.test_client()
+        times = []
+        for _ in range(2):
+            start = time.perf_counter()
+            payloads.run_session(client, mode, [], '?lang=fr')
+            times.append(time.perf_counter() - start)
+        with os.fdopen(write_fd, 'w') as pipe:
+            json.dump(times, pipe)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        times = json.load(pipe)
+    os.waitpid(pid, 0)
+    return times
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import tempfile
+    os.environ.setdefault('SCENARIO_DB', os.path.join(tempfile.gettempdir(), 'warmup_scenarios.db'))
+    import index  # noqa: F401 (imported before timing, as gunicorn preloads it)
+
+    cold = time_forked_session('advanced')
+    warm_up_start = time.perf_counter()
+    for step, seconds in warm_up().items():
+        print('Warmed up {:<11} {:.2f} s'.format(step, seconds))
+    freeze()
+    print('Warmup took {:.2f} s'.format(time.perf_counter() - warm_up_start))
+    warm = time_forked_session('advanced')
+    print('Advanced Mode page load in a new worker, first and second: {:.0f} ms and {:.0f} ms without warmup, '
+          '{:.0f} ms and {:.0f} ms with warmup'.format(*[seconds * 1000 for seconds in cold + warm]))